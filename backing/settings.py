@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.1/ref/settings/
 """
 import os
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -72,11 +73,45 @@ WSGI_APPLICATION = 'backing.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# CRM_DB_ENGINE selects the profile: "sqlite" (default) or "postgresql" (needs psycopg2)
+CRM_DB_ENGINE = os.environ.get("CRM_DB_ENGINE", "sqlite")
+
+if CRM_DB_ENGINE == "postgresql":
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get("CRM_DB_NAME", "crm"),
+            'USER': os.environ.get("CRM_DB_USER", "crm"),
+            'PASSWORD': os.environ.get("CRM_DB_PASSWORD", ""),
+            'HOST': os.environ.get("CRM_DB_HOST", "localhost"),
+            'PORT': os.environ.get("CRM_DB_PORT", "5432"),
+            # no connection pool: every worker thread keeps its own connection open for CONN_MAX_AGE seconds
+            # instead of connecting per request. The server sees one connection per worker thread, put PgBouncer
+            # in front to pool them and set CRM_DB_CONN_MAX_AGE=0
+            'CONN_MAX_AGE': int(os.environ.get("CRM_DB_CONN_MAX_AGE", 600)),
+            # PgBouncer in transaction mode can't keep the server side cursors of .iterator() open across
+            # transactions, CRM_DB_PGBOUNCER=1 turns them off
+            'DISABLE_SERVER_SIDE_CURSORS': os.environ.get("CRM_DB_PGBOUNCER", "") == "1",
+            'OPTIONS': {'connect_timeout': 5},
+        }
     }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get("CRM_DB_NAME", BASE_DIR / 'db.sqlite3'),
+            'CONN_MAX_AGE': int(os.environ.get("CRM_DB_CONN_MAX_AGE", 600)),
+        }
+    }
+
+# applied to every new SQLite connection by crm.db, WAL lets the readers work while an import writes
+CRM_SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 20000,  # milliseconds a connection waits for the write lock before "database is locked"
+    "mmap_size": 256 * 2 ** 20,
+    "cache_size": -64 * 2 ** 10,  # KiB
+    "temp_store": "MEMORY",
 }
 
 # Password validation
@@ -121,3 +156,32 @@ MEDIA_URL = "/media/"
 MEDIA_ROOT = os.path.join(SITE_ROOT, 'media')
 DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
 
+# currency of the cached order totals, other currencies are converted with crm.ExchangeRate
+CRM_REPORTING_CURRENCY = os.environ.get("CRM_REPORTING_CURRENCY", "UAH")
+
+# snapshots of crm.catalog shared by the worker processes, must be the same directory for all of them
+CRM_CATALOG_CACHE_DIR = os.environ.get("CRM_CATALOG_CACHE_DIR", os.path.join(tempfile.gettempdir(), "crm-catalog"))
+
+
+# tag of this host in the generated order and group names, followed by a random tag of the worker process;
+# only the random tag when empty
+CRM_NODE_ID = os.environ.get("CRM_NODE_ID", "")
+
+# queue of the admin revisions written by the flush_revisions command, written in the request when empty
+CRM_REVISION_QUEUE_DIR = os.environ.get("CRM_REVISION_QUEUE_DIR", "")
+
+# the API payloads are cached until a catalog change invalidates them, the cache has to be shared by all the
+# worker processes or the others keep serving the old payloads: a file cache on one host, memcached for more
+CACHES = {
+    "default": {
+        "BACKEND": os.environ.get("CRM_CACHE_BACKEND", "django.core.cache.backends.filebased.FileBasedCache"),
+        "LOCATION": os.environ.get("CRM_CACHE_LOCATION", os.path.join(tempfile.gettempdir(), "crm-cache")),
+    }
+}
+# seconds an API payload is served at most, should an invalidation be missed
+CRM_API_CACHE_TIMEOUT = int(os.environ.get("CRM_API_CACHE_TIMEOUT", 3600))
+
+# seconds a catalog change is held back from the delta sync, longer than the catalog write transactions:
+# PostgreSQL can commit them out of id order, SQLite commits in order and needs no delay
+CRM_CHANGES_SETTLE_SECONDS = int(os.environ.get("CRM_CHANGES_SETTLE_SECONDS",
+                                                60 if CRM_DB_ENGINE == "postgresql" else 0))
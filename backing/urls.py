@@ -16,11 +16,12 @@ Including another URLconf
 
 from django.conf import settings
 from django.contrib import admin
-from django.urls import path, re_path
+from django.urls import include, path, re_path
 from django.conf.urls.static import static
 from django.views.generic import RedirectView
 
 urlpatterns = [
                 path('admin/', admin.site.urls),
+                path('api/', include('crm.urls')),
                 re_path(r'', RedirectView.as_view(url='/admin/crm/', permanent=False), name='index')
               ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
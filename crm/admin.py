@@ -1,15 +1,40 @@
+import math
 import re
-
-from django.contrib import admin
+from contextlib import contextmanager
+
+from django.conf import settings
+from django import forms
+from django.contrib import admin, messages
+from django.contrib.admin.helpers import ActionForm
+from django.contrib.admin.utils import quote, unquote
+from django.core.exceptions import ValidationError
+from django.db.models import F, Max, Min, Q
 from django.forms import ModelForm
-from django.urls import reverse
+from django.shortcuts import get_object_or_404
+from django.urls import re_path, reverse
+from django.utils.translation import gettext as _
 from django.utils.html import format_html_join, format_html
 from django.utils.safestring import mark_safe
+import reversion
 from reversion.admin import VersionAdmin
-
+from reversion.models import Version
+
+from crm.capacity import line_capacity, reducer_capacity, reducer_fill_volume
+from crm.catalog import catalog_cache
+from crm.export import FORMATS, catalog_rows, export_response, order_rows
+from crm.importer.parser import RecordParser
+from crm.orders import duplicate_group, move_orders, update_items, update_orders
+from crm import revisions
 from crm.models import OrderBucket, SpoolModel, Line, Price, ReelManufacturer, ReelModel, ReducerModel, OrderGroup, \
     SpoolModelImage, \
-    ReducerModelImage, OrderItem, SpoolDimension, ReducerDimension
+    ReducerModelImage, OrderItem, SpoolDimension, ReducerDimension, ExchangeRate, CompactRevision, VersionCopy
+from crm.search import search_index
+from crm.totals import group_currency_totals
+
+# VersionAdmin registers the models of the inlines without following their relations, OrderGroupAdmin would
+# register the orders that way before OrderAdmin: the orders are versioned with their items
+reversion.register(OrderItem)
+reversion.register(OrderBucket, follow=['orderitem_set'])
 
 
 def get_admin_url(instance):
@@ -26,14 +51,196 @@ def format_list(inst_list):
     ) or mark_safe("<span class='errors'>Empty</span>")
 
 
+def image_preview_html(instance, width, height=100):
+    """Preview from the thumbnails of the image, the original scaled in HTML until they are rendered."""
+    thumbnail = instance.thumbnail_url()
+    if not thumbnail:
+        return format_html('<a href="{url}"><img src="{url}" width="{width}" height="{height}" /></a>',
+                           url=instance.image.url, width=width, height=height)
+    return format_html('<a href="{url}"><picture><source srcset="{webp}" type="image/webp" />'
+                       '<img src="{jpg}" width="{width}" height="{height}" /></picture></a>',
+                       url=instance.image.url, webp=instance.thumbnail_url("webp") or thumbnail, jpg=thumbnail,
+                       width=width, height=height)
+
+
 def camel_to_snake(string):
     groups = re.findall('([A-z0-9][a-z]*)', string)
     return '_'.join([i.lower() for i in groups])
 
 
-@admin.register(OrderItem, Line, Price)
-class CrmAdmin(admin.ModelAdmin):
-    pass
+def format_currency_totals(totals):
+    return format_html_join(
+        mark_safe('<br>'),
+        '{}: {} ({} {})',
+        ((row['price__currency'], row['total'], "-" if row['converted'] is None else round(row['converted']),
+          settings.CRM_REPORTING_CURRENCY) for row in totals),
+    ) or mark_safe("<span class='errors'>No orders.</span>")
+
+
+def export_action(fmt, name, rows):
+    """Admin action streaming the export of the selected rows, `rows` maps the queryset to the export rows."""
+
+    def action(modeladmin, request, queryset):
+        return export_response(rows(queryset.values('pk')), fmt, name)
+
+    action.__name__ = "export_{}_{}".format(name, fmt)
+    action.short_description = "Export {} of selected as {}".format(name, fmt.upper())
+    return action
+
+
+def catalog_export_actions(owner_field):
+    return [export_action(fmt, "catalog", lambda pks: catalog_rows(ReducerModel.objects.filter(
+        **{owner_field + "__in": pks}))) for fmt in FORMATS]
+
+
+def order_export_actions(owner_field):
+    return [export_action(fmt, "orders", lambda pks: order_rows(OrderItem.objects.filter(
+        **{owner_field + "__in": pks}))) for fmt in FORMATS]
+
+
+def order_update_action(name, description, orders=lambda queryset: queryset, **fields):
+    """Admin action setting `fields` of the selected orders (or of the orders of the selected groups)."""
+
+    def action(modeladmin, request, queryset):
+        updated = update_orders(orders(queryset), request.user, description, **fields)
+        modeladmin.message_user(request, "{}: {} orders".format(description, updated))
+
+    action.__name__ = name
+    action.short_description = description
+    return action
+
+
+def item_update_action(name, description, **fields):
+    def action(modeladmin, request, queryset):
+        updated = update_items(queryset, request.user, description, **fields)
+        modeladmin.message_user(request, "{}: {} items".format(description, updated))
+
+    action.__name__ = name
+    action.short_description = description
+    return action
+
+
+def _group_orders(groups):
+    return OrderBucket.objects.filter(order_group__in=groups.values('pk'))
+
+
+class MoveOrdersForm(ActionForm):
+    order_group = forms.ModelChoiceField(OrderGroup.objects.order_by('-created'), required=False,
+                                         label="Move to group")
+
+
+def move_to_group(modeladmin, request, queryset):
+    # the changelist validated the action, only the extra field of the action form is left
+    try:
+        group = MoveOrdersForm.base_fields['order_group'].clean(request.POST.get('order_group'))
+    except ValidationError:
+        group = None
+    if group is None:
+        modeladmin.message_user(request, "Select the group to move the orders to", messages.WARNING)
+        return
+    moved = move_orders(queryset, group, request.user, "Moved to {}".format(group))
+    modeladmin.message_user(request, "Moved {} orders to {}".format(moved, group))
+
+
+move_to_group.short_description = "Move selected orders to the group"
+
+
+def duplicate_groups(modeladmin, request, queryset):
+    copies = [duplicate_group(group, request.user) for group in queryset]
+    modeladmin.message_user(request, "Created {}".format(", ".join(str(copy) for copy in copies)))
+
+
+duplicate_groups.short_description = "Duplicate selected groups with their orders"
+
+
+ORDER_ACTIONS = [
+    ("mark_payed", "Mark as payed", {"payed": True}),
+    ("mark_not_payed", "Mark as not payed", {"payed": False}),
+    ("mark_sent", "Mark as sent", {"sent": True}),
+    ("mark_not_sent", "Mark as not sent", {"sent": False}),
+]
+
+
+# joins of the __str__ chains, the spools, reducers and order items have a cached display_name instead
+LABEL_RELATED = {
+    ReelModel: ['reel_manufacturer'],
+}
+
+
+class LabelRelatedMixin:
+    """Labels of the rows, of the autocomplete results and of the selected foreign keys in one joined query.
+
+    The foreign keys are picked with autocomplete_fields, the widget renders only the selected option
+    and its __str__ would otherwise cost a query per hop of the chain.
+    """
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related(*LABEL_RELATED.get(self.model, []))
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        related = LABEL_RELATED.get(db_field.related_model)
+        if related and 'queryset' not in kwargs:
+            kwargs['queryset'] = db_field.related_model._default_manager.select_related(*related)
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
+
+
+def _number(term):
+    try:
+        return float(term)
+    except ValueError:
+        return None
+
+
+@admin.register(OrderItem)
+class CrmAdmin(LabelRelatedMixin, admin.ModelAdmin):
+    autocomplete_fields = ['reducer_model', 'price']
+    list_display = ['__str__', 'order', 'printed']
+    list_filter = ['printed']
+    actions = [item_update_action("mark_printed", "Mark as printed", printed=True),
+               item_update_action("mark_not_printed", "Mark as not printed", printed=False)]
+
+
+@admin.register(Line)
+class LineAdmin(admin.ModelAdmin):
+    search_fields = ['name']
+
+    def get_search_results(self, request, queryset, search_term):
+        # "0.3-150" is a line spec, a number is its length or diameter, anything else a part of its name
+        for term in search_term.split():
+            if "-" in term and all(_number(part) is not None for part in term.split("-", 1)):
+                length, diameter = RecordParser.parse_line(term)
+                queryset = queryset.filter(length=length, diameter=diameter)
+            elif _number(term) is not None:
+                queryset = queryset.filter(Q(diameter=_number(term)) | Q(length=_number(term)))
+            else:
+                queryset = queryset.filter(name__icontains=term)
+        return queryset, False
+
+
+@admin.register(Price)
+class PriceAdmin(admin.ModelAdmin):
+    list_display = ['price', 'currency']
+    list_filter = ['currency']
+    search_fields = ['currency']
+
+    def get_search_results(self, request, queryset, search_term):
+        for term in search_term.split():
+            number = _number(term)
+            queryset = queryset.filter(currency__iexact=term) if number is None else queryset.filter(price=number)
+        return queryset, False
+
+
+@admin.register(ExchangeRate)
+class ExchangeRateAdmin(admin.ModelAdmin):
+    list_display = ['currency', 'date', 'rate']
+    list_filter = ['currency']
+
+    def get_deleted_objects(self, objs, request):
+        # the delete view and the delete action refuse to delete the protected objects
+        to_delete, model_count, perms_needed, protected = super().get_deleted_objects(objs, request)
+        protected = list(protected) + ["The orders in {} need an exchange rate".format(currency)
+                                       for currency in ExchangeRate.required(objs)]
+        return to_delete, model_count, perms_needed, protected
 
 
 class ReelManufacturerInline(admin.TabularInline):
@@ -48,7 +255,8 @@ class ReelManufacturerInline(admin.TabularInline):
         False
 
     def _url(self, inst):
-        return mark_safe('<a href="{url}">{name}</a>'.format(url=get_admin_url(inst), name=str(inst)))
+        return mark_safe('<a href="{url}">{name}</a>'.format(url=get_admin_url(inst),
+                                                             name=catalog_cache.label(inst)))
 
     _url.short_description = "Reel Model"
 
@@ -56,6 +264,7 @@ class ReelManufacturerInline(admin.TabularInline):
 @admin.register(ReelManufacturer)
 class ReelManufacturerAdmin(admin.ModelAdmin):
     inlines = [ReelManufacturerInline]
+    search_fields = ['name']
 
 
 class ReelModelInline(admin.TabularInline):
@@ -70,12 +279,15 @@ class ReelModelInline(admin.TabularInline):
         False
 
     def _url(self, inst):
+        # the stored display_name, no queries
         return mark_safe('<a href="{url}">{name}</a>'.format(url=get_admin_url(inst), name=str(inst)))
 
 
 @admin.register(ReelModel)
-class ReelModelAdmin(admin.ModelAdmin):
+class ReelModelAdmin(LabelRelatedMixin, admin.ModelAdmin):
     inlines = [ReelModelInline]
+    autocomplete_fields = ['reel_manufacturer']
+    search_fields = ['name', 'reel_manufacturer__name']
 
 
 class SpoolModelImageInline(admin.TabularInline):
@@ -97,11 +309,7 @@ class SpoolModelImageInline(admin.TabularInline):
 
     def image_preview(self, instance):
         if instance.image:
-            return mark_safe(
-                '<a href={url}><img src="{url}" width="{width}" height="100" /></a>'.format(url=instance.image.url,
-                                                                                            width=self._scale_width(
-                                                                                                instance.img_width,
-                                                                                                instance.img_height)))
+            return image_preview_html(instance, self._scale_width(instance.img_width, instance.img_height))
         else:
             return '(No image)'
 
@@ -128,7 +336,7 @@ class SpoolModelDimInline(admin.TabularInline):
     #     return mark_safe('<a href="{url}">{name}</a>'.format(url=get_admin_url(inst), name=str(inst)))
 
 
-class SpoolModelReducerInline(admin.TabularInline):
+class SpoolModelReducerInline(LabelRelatedMixin, admin.TabularInline):
     extra = 0
     model = ReducerModel
     verbose_name = ''
@@ -147,18 +355,103 @@ class SpoolModelReducerInline(admin.TabularInline):
         return False
 
     def name(self, inst):
-        return mark_safe('<a href="{url}">{name}</a>'.format(url=get_admin_url(inst), name=str(inst)))
+        return mark_safe('<a href="{url}">{name}</a>'.format(url=get_admin_url(inst),
+                                                             name=catalog_cache.label(inst)))
+
+
+class QueuedVersionAdmin(VersionAdmin):
+    """With settings.CRM_REVISION_QUEUE_DIR the revisions are queued and written by the flush_revisions command,
+    the request only serializes the saved objects.
+
+    The history lists the copies of the object (crm.models.VersionCopy) next to its versions, a revision is
+    reverted with its copies.
+    """
+
+    def get_urls(self):
+        info = self.model._meta.app_label, self.model._meta.model_name
+        return [
+            re_path(r"^([^/]+)/history/copy/(\d+)/$", self.admin_site.admin_view(self.copy_revision_view),
+                    name='%s_%s_revision_copy' % info),
+        ] + super().get_urls()
+
+    def history_view(self, request, object_id, extra_context=None):
+        opts = self.model._meta
+        url = "{}:{}_{}_revision".format(self.admin_site.name, opts.app_label, opts.model_name)
+        versions = Version.objects.get_for_object_reference(self.model, unquote(object_id))
+        actions = [(version.revision, reverse(url, args=(quote(version.object_id), version.pk)))
+                   for version in versions.select_related('revision__user')]
+        actions += [(copy.revision, reverse(url + "_copy", args=(quote(copy.version.object_id), copy.pk)))
+                    for copy in VersionCopy.objects.filter(version__in=versions).select_related('revision__user',
+                                                                                                 'version')]
+        actions.sort(key=lambda action: action[0].pk, reverse=self.history_latest_first)
+        context = {"action_list": [{"revision": revision, "url": url} for revision, url in actions]}
+        context.update(extra_context or {})
+        return super().history_view(request, object_id, context)
+
+    def copy_revision_view(self, request, object_id, copy_id, extra_context=None):
+        copy = get_object_or_404(VersionCopy.objects.select_related('version'), pk=copy_id,
+                                 version__object_id=unquote(object_id))
+        version = copy.resolve()
+        context = {"title": _("Revert %(name)s") % {"name": version.object_repr}, "revert": True}
+        context.update(extra_context or {})
+        return self._reversion_revisionform_view(
+            request, version, self.revision_form_template or self._reversion_get_template_list("revision_form.html"),
+            context)
+
+    def _reversion_revisionform_view(self, request, version, template_name, extra_context=None):
+        # the revert of the revision restores its copies too
+        version.revision = CompactRevision.objects.get(pk=version.revision_id)
+        return super()._reversion_revisionform_view(request, version, template_name, extra_context)
+
+    @contextmanager
+    def create_revision(self, request):
+        if not revisions.revision_queue.enabled:
+            with super().create_revision(request):
+                yield
+            return
+        with revisions.deferred_revision(request.user):
+            yield
+
+    def log_addition(self, request, object, message):
+        entry = super().log_addition(request, object, message)
+        if revisions.is_capturing():
+            revisions.set_comment(entry.get_change_message())
+        return entry
+
+    def log_change(self, request, object, message):
+        entry = super().log_change(request, object, message)
+        if revisions.is_capturing():
+            revisions.set_comment(entry.get_change_message())
+        return entry
+
+
+class SearchIndexAdmin(QueuedVersionAdmin):
+    """Changelist search through the crm.search full-text index instead of icontains over `search_fields`."""
+
+    search_kind = None
+    # only shows the search box, the terms are looked up in the index
+    search_fields = ['name']
+
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term.strip():
+            return queryset, False
+        # a subquery of the matching ids, every match is on one of the changelist pages
+        return search_index.filter(queryset, search_term, self.search_kind), False
 
 
 @admin.register(SpoolModel)
-class SpoolModelAdmin(VersionAdmin):
+class SpoolModelAdmin(LabelRelatedMixin, SearchIndexAdmin):
+    search_kind = "spool"
+    autocomplete_fields = ['reel_model']
+    actions = catalog_export_actions("spool_model")
     inlines = [SpoolModelDimInline, SpoolModelReducerInline, SpoolModelImageInline]
     fieldsets = [
         ("SpoolModel", {'fields': ['reel_model', 'name', 'size']}),
         # ("Dimensions", {'fields': ['D1', 'D2', 'H1']}),
         # ('Relations', {'fields': ['relation_list']}),
     ]
-    list_display = ["__str__"]
+    # the cached name, sorted by its index
+    list_display = ["display_name"]
 
 
 class ReducerModelImageInline(admin.TabularInline):
@@ -180,11 +473,7 @@ class ReducerModelImageInline(admin.TabularInline):
 
     def image_preview(self, instance):
         if instance.image:
-            return mark_safe(
-                '<a href={url}><img src="{url}" width="{width}" height="100" /></a>'.format(url=instance.image.url,
-                                                                                            width=self._scale_width(
-                                                                                                instance.img_width,
-                                                                                                instance.img_height)))
+            return image_preview_html(instance, self._scale_width(instance.img_width, instance.img_height))
         else:
             return '(No image)'
 
@@ -196,70 +485,130 @@ class ReducerModelDimInline(admin.TabularInline):
     model = ReducerDimension
 
 
+class DimensionRangeFilter(admin.SimpleListFilter):
+    """Filters the changelist by ranges of an annotated dimension, the ranges split the min..max of the column."""
+    ranges = 5
+
+    def lookups(self, request, model_admin):
+        bounds = model_admin.get_queryset(request).aggregate(low=Min(self.parameter_name),
+                                                             high=Max(self.parameter_name))
+        low, high = bounds["low"], bounds["high"]
+        if low is None:
+            return []
+        step = (high - low) / self.ranges or 1
+        edges = [low + step * i for i in range(self.ranges)] + [high]
+        return [("{!r}-{!r}".format(lo, hi), "{:g} - {:g}".format(lo, hi)) for lo, hi in zip(edges, edges[1:])]
+
+    def queryset(self, request, queryset):
+        if not self.value():
+            return queryset
+        try:
+            low, high = map(float, self.value().rsplit("-", 1))
+        except ValueError:
+            return queryset
+        return queryset.filter(**{self.parameter_name + "__gte": low, self.parameter_name + "__lte": high})
+
+
+def dimension_filter(field, title):
+    return type("{}Filter".format(field.title().replace("_", "")), (DimensionRangeFilter,),
+                {"parameter_name": field, "title": title})
+
+
+def dimension_column(field, title):
+    def column(self, instance):
+        return getattr(instance, field, None)
+
+    column.short_description = title
+    column.admin_order_field = field
+    return column
+
+
 @admin.register(ReducerModel)
-class ReducerModelAdmin(VersionAdmin):
+class ReducerModelAdmin(LabelRelatedMixin, SearchIndexAdmin):
+    search_kind = "reducer"
+    autocomplete_fields = ['spool_model', 'line']
+    search_fields = ['description']
+    actions = catalog_export_actions("pk")
     inlines = [ReducerModelDimInline, ReducerModelImageInline]
     # fields = ['spool_d1']
-    readonly_fields = ("spool_url", "spool_d1", "spool_d2", "spool_h1", 'reducer_d3', 'reducer_d4', 'reducer_h2')
+    readonly_fields = ("spool_url", "spool_d1", "spool_d2", "spool_h1", 'reducer_d3', 'reducer_d4', 'reducer_h2',
+                       'fill_volume', 'capacity', 'spool_capacity')
     fieldsets = [
         ("SpoolModel", {'fields': [("spool_model", "spool_url")]}),
         ("Line", {"fields": ["line"]}),
         # ("Reducer Dimensions", {'fields': ['spool_d1', 'spool_d2', 'D3', 'D4', 'spool_h1', 'H2']}),
         ("Reducer Dimensions",
          {'fields': ['spool_d1', 'spool_d2', 'reducer_d3', 'reducer_d4', 'spool_h1', 'reducer_h2']}),
+        ("Line Capacity", {'fields': ['fill_volume', 'capacity', 'spool_capacity']}),
         # ('Relations', {'fields': ['relation_list']}),
     ]
 
-    list_display = ["spool_model", "line", 'spool_d1', 'spool_d2', 'reducer_d3', 'reducer_d4', 'spool_h1', 'reducer_h2']
+    list_display = ["spool_model", "line", 'spool_d1', 'spool_d2', 'reducer_d3', 'reducer_d4', 'spool_h1', 'reducer_h2',
+                    'fill_volume', 'capacity']
+    list_select_related = ["spool_model", "line"]
+    list_filter = [dimension_filter("spool_d1", "D1"), dimension_filter("spool_d2", "D2"),
+                   dimension_filter("spool_h1", "H1"), dimension_filter("reducer_d3", "D3"),
+                   dimension_filter("reducer_d4", "D4"), dimension_filter("reducer_h2", "H2")]
     ordering = ["spool_model", "line"]
 
+    # the actual dimensions are annotated in get_queryset(), joined through the actual_dimension pointers
+    DIMENSIONS = {
+        "spool_d1": "spool_model__actual_dimension__D1",
+        "spool_d2": "spool_model__actual_dimension__D2",
+        "spool_h1": "spool_model__actual_dimension__H1",
+        "reducer_d3": "actual_dimension__D3",
+        "reducer_d4": "actual_dimension__D4",
+        "reducer_h2": "actual_dimension__H2",
+        "reducer_shift": "actual_dimension__shift",
+    }
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(
+            **{name: F(path) for name, path in self.DIMENSIONS.items()})
+
     def spool_url(self, instance):
         return mark_safe('<a href="{url}">{name}</a>'.format(url=get_admin_url(instance.spool_model),
                                                              name=str(instance.spool_model)))
 
     spool_url.short_description = "URL"
 
-    def _get_spool_dim(self, instance):
-        return SpoolDimension.objects.filter(spool_model_id=instance.spool_model.pk, actual=True).first()
-
-    def _get_reducer_dim(self, instance):
-        return ReducerDimension.objects.filter(reducer_model_id=instance.pk, actual=True).first()
-
-    def spool_d1(self, instance):
-        spool_dim = self._get_spool_dim(instance)
-        return spool_dim.D1 if spool_dim else None
-
-    spool_d1.short_description = "D1"
+    spool_d1 = dimension_column("spool_d1", "D1")
+    spool_d2 = dimension_column("spool_d2", "D2")
+    spool_h1 = dimension_column("spool_h1", "H1")
+    reducer_d3 = dimension_column("reducer_d3", "D3")
+    reducer_d4 = dimension_column("reducer_d4", "D4")
+    reducer_h2 = dimension_column("reducer_h2", "H2")
 
-    def spool_d2(self, instance):
-        spool_dim = self._get_spool_dim(instance)
-        return spool_dim.D2 if spool_dim else None
-
-    spool_d2.short_description = "D2"
-
-    def spool_h1(self, instance):
-        spool_dim = self._get_spool_dim(instance)
-        return spool_dim.H1 if spool_dim else None
-
-    spool_h1.short_description = "H1"
+    @staticmethod
+    def _format_capacity(meters, line):
+        if meters is None or math.isnan(meters):
+            return None
+        return "{:.0f} m ({:.0f}%)".format(meters, 100.0 * line.length / meters) if meters else "0 m"
 
-    def reducer_d3(self, instance):
-        reducer_dim = self._get_reducer_dim(instance)
-        return reducer_dim.D3 if reducer_dim else None
+    def fill_volume(self, instance):
+        if None in (instance.spool_d1, instance.spool_h1, instance.reducer_d3, instance.reducer_h2):
+            return None
+        return "{:.1f} cm³".format(float(reducer_fill_volume(instance.spool_d1, instance.spool_h1, instance.reducer_d3,
+                                                            instance.reducer_h2, instance.reducer_shift)))
 
-    reducer_d3.short_description = "D3"
+    fill_volume.short_description = "Fill volume"
 
-    def reducer_d4(self, instance):
-        reducer_dim = self._get_reducer_dim(instance)
-        return reducer_dim.D4 if reducer_dim else None
+    def capacity(self, instance):
+        if None in (instance.spool_d1, instance.spool_h1, instance.reducer_d3, instance.reducer_h2):
+            return None
+        return self._format_capacity(float(reducer_capacity(instance.spool_d1, instance.spool_h1, instance.reducer_d3,
+                                                            instance.reducer_h2, instance.reducer_shift,
+                                                            instance.line.diameter)), instance.line)
 
-    reducer_d4.short_description = "D4"
+    capacity.short_description = "Capacity (line fill)"
 
-    def reducer_h2(self, instance):
-        reducer_dim = self._get_reducer_dim(instance)
-        return reducer_dim.H2 if reducer_dim else None
+    def spool_capacity(self, instance):
+        if None in (instance.spool_d1, instance.spool_d2, instance.spool_h1):
+            return None
+        return self._format_capacity(float(line_capacity(instance.spool_d1, instance.spool_d2, instance.spool_h1,
+                                                         instance.line.diameter)), instance.line)
 
-    reducer_h2.short_description = "H2"
+    spool_capacity.short_description = "Capacity without reducer"
 
 
 class MarkNewInstancesAsChangedModelForm(ModelForm):
@@ -312,9 +661,14 @@ class OrderGroupSentInline(admin.TabularInline):
 
 
 @admin.register(OrderGroup)
-class OrderGroupAdmin(VersionAdmin):
+class OrderGroupAdmin(QueuedVersionAdmin):
     # fields = ["name", "orders_list"]
-    readonly_fields = ['get_sum']
+    readonly_fields = ['get_sum', 'currency_totals']
+    list_display = ['name', 'created', 'get_sum']
+    search_fields = ['name']
+    actions = [order_update_action(name + "_orders", description.replace("Mark", "Mark orders"), _group_orders,
+                                   **fields) for name, description, fields in ORDER_ACTIONS] + \
+        [duplicate_groups] + order_export_actions("order__order_group")
     inlines = [OrderGroupNotSentInline, OrderGroupSentInline]
 
     # def orders_list(self, instance):
@@ -324,16 +678,22 @@ class OrderGroupAdmin(VersionAdmin):
     # orders_list.short_description = "Related Orders"
 
     def get_sum(self, instance):
-        orders = OrderBucket.objects.filter(order_group_id=instance.pk)
-        return format_html("{}", sum(map(lambda o: o.get_order_sum(), orders))) or mark_safe(
+        return format_html("{}", instance.total) or mark_safe(
             "<span class='errors'>No orders.</span>")
 
     get_sum.short_description = "Total"
+    get_sum.admin_order_field = "total"
 
+    def currency_totals(self, instance):
+        return format_currency_totals(group_currency_totals(instance.pk))
 
-class OrderInline(admin.TabularInline):
+    currency_totals.short_description = "Totals by currency"
+
+
+class OrderInline(LabelRelatedMixin, admin.TabularInline):
     extra = 0
     model = OrderItem
+    autocomplete_fields = ['reducer_model', 'price']
     # verbose_name = ''
     # verbose_name_plural = ''
     # max_num = 1
@@ -352,9 +712,16 @@ class OrderInline(admin.TabularInline):
 
 
 @admin.register(OrderBucket)
-class OrderAdmin(VersionAdmin):
-    readonly_fields = ['order_group_url']
+class OrderAdmin(QueuedVersionAdmin):
+    readonly_fields = ['order_group_url', 'total', 'currency_totals']
     inlines = [OrderInline]
+    list_display = ['name', 'order_group', 'total', 'payed', 'sent']
+    list_select_related = ['order_group']
+    autocomplete_fields = ['order_group']
+    list_filter = ['payed', 'sent']
+    action_form = MoveOrdersForm
+    actions = [order_update_action(name, description, **fields) for name, description, fields in ORDER_ACTIONS] + \
+        [move_to_group] + order_export_actions("order")
 
     # def orders_list(self, instance):
     #     return format_list(instance.get_orders())
@@ -372,3 +739,8 @@ class OrderAdmin(VersionAdmin):
             '<a href="{url}">{name}</a>'.format(url=get_admin_url(inst.order_group), name=str(inst.order_group)))
 
     order_group_url.short_description = "Order Group URL"
+
+    def currency_totals(self, instance):
+        return format_currency_totals(instance.get_currency_totals())
+
+    currency_totals.short_description = "Totals by currency"
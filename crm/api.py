@@ -0,0 +1,229 @@
+import hashlib
+import json
+from collections import defaultdict, namedtuple
+from datetime import datetime, timezone
+from typing import Iterable
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Count, Exists, F, OuterRef
+from django.http import Http404
+
+from crm.models import CatalogChange, Line, ReelManufacturer, ReelModel, SpoolModel, SpoolModelImage, ReducerModel, \
+    ReducerModelImage
+from crm.storage import image_storage
+
+# serialized response body, its strong ETag and Last-Modified
+Payload = namedtuple("Payload", ["body", "etag", "last_modified"])
+
+CACHE_PREFIX = "crm:api:"
+INDEX_KEY = "manufacturers"
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def _cache_key(key: str) -> str:
+    return CACHE_PREFIX + "payload:" + key
+
+
+def _touched_key(key: str) -> str:
+    return CACHE_PREFIX + "touched:" + key
+
+
+def manufacturer_key(manufacturer_id) -> str:
+    return "manufacturer:{}".format(manufacturer_id)
+
+
+def get_payload(key: str, build) -> Payload:
+    """Serialized `build()` result, cached until invalidate() is called for `key` or CRM_API_CACHE_TIMEOUT.
+
+    `build` returns the data and the newest `modified` timestamp in it. Last-Modified is the later
+    of that and the last invalidation, the dimensions and images have no timestamps of their own.
+    """
+    payload = cache.get(_cache_key(key))
+    if payload is None:
+        data, modified = build()
+        body = json.dumps(data, cls=DjangoJSONEncoder, separators=(",", ":")).encode()
+        touched = cache.get(_touched_key(key))
+        if modified is None and touched is None:
+            # nothing to date the data by, it counts as changed when it was first built
+            touched = datetime.now(timezone.utc)
+            cache.set(_touched_key(key), touched, None)
+        last_modified = max(modified or EPOCH, touched or EPOCH)
+        payload = Payload(body, hashlib.sha1(body).hexdigest(), last_modified)
+        cache.set(_cache_key(key), payload, settings.CRM_API_CACHE_TIMEOUT)
+    return payload
+
+
+def invalidate(keys: Iterable[str]):
+    keys = set(keys)
+    if not keys:
+        return
+    now = datetime.now(timezone.utc)
+    cache.delete_many([_cache_key(key) for key in keys])
+    cache.set_many({_touched_key(key): now for key in keys}, None)
+
+
+def invalidate_manufacturers(manufacturer_ids: Iterable[int], index: bool = False):
+    keys = [manufacturer_key(pk) for pk in set(manufacturer_ids) - {None}]
+    invalidate(keys + [INDEX_KEY] if index else keys)
+
+
+def build_index():
+    manufacturers = ReelManufacturer.objects.annotate(reel_models=Count('reelmodel')).values('id', 'name',
+                                                                                            'reel_models')
+    return list(manufacturers), None
+
+
+def _images(model, owner_field: str, filters: dict):
+    images = defaultdict(list)
+    for owner_id, name, width, height in model.objects.filter(**filters).exclude(image="").order_by('pk') \
+            .values_list(owner_field, 'image', 'img_width', 'img_height'):
+        images[owner_id].append({"url": image_storage.url(name), "width": width, "height": height})
+    return images
+
+
+def build_manufacturer(manufacturer_id: int):
+    """Manufacturer -> reel models -> spools -> reducers with the actual dimensions, 6 queries at any size."""
+    manufacturer = ReelManufacturer.objects.filter(pk=manufacturer_id).values('id', 'name').first()
+    if manufacturer is None:
+        raise Http404("No manufacturer {}".format(manufacturer_id))
+
+    reel_models = list(ReelModel.objects.filter(reel_manufacturer_id=manufacturer_id).values('id', 'name'))
+    spools = SpoolModel.objects.filter(reel_model__reel_manufacturer_id=manufacturer_id).values(
+        'id', 'reel_model_id', 'name', 'size', 'description', 'modified',
+        'actual_dimension__D1', 'actual_dimension__D2', 'actual_dimension__H1')
+    reducers = ReducerModel.objects.filter(spool_model__reel_model__reel_manufacturer_id=manufacturer_id).values(
+        'id', 'spool_model_id', 'line__length', 'line__diameter', 'description', 'modified',
+        'actual_dimension__D3', 'actual_dimension__D4', 'actual_dimension__H2', 'actual_dimension__shift')
+    spool_images = _images(SpoolModelImage, 'spool_model_id',
+                           {"spool_model__reel_model__reel_manufacturer_id": manufacturer_id})
+    reducer_images = _images(ReducerModelImage, 'reducer_model_id',
+                             {"reducer_model__spool_model__reel_model__reel_manufacturer_id": manufacturer_id})
+
+    modified = None
+    spool_reducers = defaultdict(list)
+    for r in reducers:
+        modified = max(modified or r['modified'], r['modified'])
+        spool_reducers[r['spool_model_id']].append({
+            "id": r['id'],
+            "line": {"length": r['line__length'], "diameter": r['line__diameter']},
+            "description": r['description'],
+            "modified": r['modified'],
+            "dimension": _dimension(r, 'D3', 'D4', 'H2', 'shift'),
+            "images": reducer_images.get(r['id'], []),
+        })
+    model_spools = defaultdict(list)
+    for s in spools:
+        modified = max(modified or s['modified'], s['modified'])
+        model_spools[s['reel_model_id']].append({
+            "id": s['id'],
+            "name": s['name'],
+            "size": s['size'],
+            "description": s['description'],
+            "modified": s['modified'],
+            "dimension": _dimension(s, 'D1', 'D2', 'H1'),
+            "images": spool_images.get(s['id'], []),
+            "reducers": spool_reducers.get(s['id'], []),
+        })
+    manufacturer["reel_models"] = [dict(reel_model, spools=model_spools.get(reel_model['id'], []))
+                                   for reel_model in reel_models]
+    return manufacturer, modified
+
+
+def _dimension(row: dict, *fields):
+    values = {field: row['actual_dimension__' + field] for field in fields}
+    return values if values[fields[0]] is not None else None
+
+
+DEFAULT_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 5000
+
+
+def _records(kind: str, ids) -> dict:
+    """Current state of the records of one kind by id, a record missing here was deleted."""
+    if kind == CatalogChange.Kind.MANUFACTURER:
+        rows = ReelManufacturer.objects.filter(pk__in=ids).values('id', 'name')
+    elif kind == CatalogChange.Kind.REEL_MODEL:
+        rows = ReelModel.objects.filter(pk__in=ids).values('id', 'name', manufacturer_id=F('reel_manufacturer_id'))
+    elif kind == CatalogChange.Kind.LINE:
+        rows = Line.objects.filter(pk__in=ids).values('id', 'name', 'length', 'diameter')
+    elif kind == CatalogChange.Kind.SPOOL:
+        images = _images(SpoolModelImage, 'spool_model_id', {"spool_model_id__in": ids})
+        rows = [dict(id=s['id'], reel_model_id=s['reel_model_id'], name=s['name'], size=s['size'],
+                     description=s['description'], modified=s['modified'],
+                     dimension=_dimension(s, 'D1', 'D2', 'H1'), images=images.get(s['id'], []))
+                for s in SpoolModel.objects.filter(pk__in=ids).order_by().values(
+                    'id', 'reel_model_id', 'name', 'size', 'description', 'modified',
+                    'actual_dimension__D1', 'actual_dimension__D2', 'actual_dimension__H1')]
+    else:
+        images = _images(ReducerModelImage, 'reducer_model_id', {"reducer_model_id__in": ids})
+        rows = [dict(id=r['id'], spool_model_id=r['spool_model_id'], line_id=r['line_id'],
+                     description=r['description'], modified=r['modified'],
+                     dimension=_dimension(r, 'D3', 'D4', 'H2', 'shift'), images=images.get(r['id'], []))
+                for r in ReducerModel.objects.filter(pk__in=ids).order_by().values(
+                    'id', 'spool_model_id', 'line_id', 'description', 'modified',
+                    'actual_dimension__D3', 'actual_dimension__D4', 'actual_dimension__H2',
+                    'actual_dimension__shift')]
+    return {row['id']: row for row in rows}
+
+
+def changes_page(cursor: int = 0, limit: int = DEFAULT_PAGE_SIZE) -> dict:
+    """Records changed after the `cursor` change, at most `limit` log entries per page.
+
+    The page is the keyset `id > cursor` of the change log, the returned cursor is the id of its last
+    entry. Entries of the same record are collapsed to its current state, or a tombstone when the
+    record doesn't exist anymore. A page costs one query per kind of record in it plus the images.
+
+    The ids are taken when a change is written, not when it commits. SQLite commits its single writer in id
+    order, but on PostgreSQL a transaction can commit a lower id after a client moved the cursor past a
+    higher one, that change would never be sent. The page ends before the entries younger than
+    CRM_CHANGES_SETTLE_SECONDS, which has to be longer than the catalog transactions.
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    entries = list(CatalogChange.objects.filter(pk__gt=cursor).order_by('pk')
+                   .values_list('pk', 'kind', 'object_id', 'created')[:limit + 1])
+    more = len(entries) > limit
+    entries = entries[:limit]
+    settled = CatalogChange.settled()
+    if settled is not None:
+        young = next((i for i, entry in enumerate(entries) if entry[3] > settled), None)
+        if young is not None:
+            # the rest is sent once it settled, the client polls again later
+            entries, more = entries[:young], False
+
+    latest = {}
+    for pk, kind, object_id, _ in entries:
+        latest.pop((kind, object_id), None)
+        latest[(kind, object_id)] = pk
+    by_kind = defaultdict(list)
+    for kind, object_id in latest:
+        by_kind[kind].append(object_id)
+    records = {kind: _records(kind, ids) for kind, ids in by_kind.items()}
+
+    changes = []
+    for kind, object_id in latest:
+        record = records[kind].get(object_id)
+        changes.append({"kind": kind, "id": object_id, "deleted": True} if record is None else
+                       {"kind": kind, "id": object_id, "deleted": False, "record": record})
+    return {"cursor": entries[-1][0] if entries else cursor, "more": more, "changes": changes}
+
+
+def compact_changes() -> int:
+    """Drops the log entries superseded by a later entry of the same record, the tombstones stay."""
+    newer = CatalogChange.objects.filter(kind=OuterRef('kind'), object_id=OuterRef('object_id'), pk__gt=OuterRef('pk'))
+    deleted, _ = CatalogChange.objects.filter(Exists(newer)).delete()
+    return deleted
+
+
+def seed_changes() -> int:
+    """Logs every existing record once, a client starting at cursor 0 gets the whole catalog."""
+    seeded = 0
+    for kind, model in ((CatalogChange.Kind.MANUFACTURER, ReelManufacturer), (CatalogChange.Kind.LINE, Line),
+                        (CatalogChange.Kind.REEL_MODEL, ReelModel), (CatalogChange.Kind.SPOOL, SpoolModel),
+                        (CatalogChange.Kind.REDUCER, ReducerModel)):
+        ids = list(model.objects.order_by('pk').values_list('pk', flat=True))
+        CatalogChange.objects.bulk_create((CatalogChange(kind=kind, object_id=pk) for pk in ids),
+                                          batch_size=DEFAULT_PAGE_SIZE)
+        seeded += len(ids)
+    return seeded
@@ -0,0 +1,169 @@
+import math
+
+import numpy as np
+from django.db.models import Q
+
+from crm.fit import RELOAD_CHANGES
+from crm.models import CatalogChange, Line, SpoolModel, ReducerModel
+from crm.snapshots import load_arrays, save_arrays, snapshot_path
+
+# share of the fill volume taken by line wound in a hexagonal pattern
+PACKING = math.pi / (2 * math.sqrt(3))
+
+
+def fill_volume(outer, core, width):
+    """Volume of the ring between the `core` and `outer` diameters over `width` in cm³, all dimensions in mm.
+
+    Works on scalars and NumPy arrays. Without a reducer the line fills spool D1 / D2 / H1. A reducer raises
+    the core to D3, is H2 wide and its `shift` keeps the line that far below the spool lip, so the ring is
+    D1 - 2 * shift / D3 / min(H1, H2).
+    """
+    return np.pi / 4 * np.clip(np.square(outer) - np.square(core), 0, None) * width / 1000
+
+
+def reducer_fill_volume(d1, h1, d3, h2, shift):
+    # D4 is the bore the reducer sits with on the spool core, inside D3: the line never reaches it and the
+    # capacity doesn't read it
+    return fill_volume(np.asarray(d1) - 2 * np.asarray(shift), d3, np.minimum(h1, h2))
+
+
+def volume_capacity(volume, line_diameter):
+    """Meters of line of `line_diameter` mm wound into `volume` cm³."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        meters = PACKING * np.asarray(volume) / (np.pi / 4 * np.square(line_diameter))
+    return np.where(np.asarray(line_diameter) > 0, meters, np.nan)
+
+
+def line_capacity(outer, core, width, line_diameter):
+    """Meters of line that fit on a spool, see fill_volume()."""
+    return volume_capacity(fill_volume(outer, core, width), line_diameter)
+
+
+def reducer_capacity(d1, h1, d3, h2, shift, line_diameter):
+    return volume_capacity(reducer_fill_volume(d1, h1, d3, h2, shift), line_diameter)
+
+
+class CapacityMatrix:
+    """Fill volume and line capacity of every spool and every reducer for every line.
+
+    `spool_volumes` are the fill volumes of the bare spools in cm³, `reducer_volumes` the ones of the spools
+    with the reducer installed. `spools` is a spool x line matrix of the capacity of the bare spools in meters,
+    `reducers` a reducer x line matrix of the spools with the reducer. The rows are sorted by pk.
+
+    The arrays are a snapshot of the change log cursor read by load(), refresh() reads the CatalogChange
+    entries after that cursor: the rows of the changed spools and reducers and of the reducers of the changed
+    spools are read and computed again, a changed line recomputes the columns from the stored volumes without
+    reading the dimensions. line_capacity keeps the snapshot in a file of the catalog cache directory.
+    The admin computes the capacity of the rows it shows from their annotated dimensions instead.
+    """
+
+    SNAPSHOT = "capacity-v1.npz"
+    SPOOL_FIELDS = ('pk', 'actual_dimension__D1', 'actual_dimension__D2', 'actual_dimension__H1')
+    REDUCER_FIELDS = ('pk', 'spool_model_id', 'spool_model__actual_dimension__D1',
+                      'spool_model__actual_dimension__H1', 'actual_dimension__D3', 'actual_dimension__H2',
+                      'actual_dimension__shift')
+    LINE_FIELDS = ('pk', 'diameter', 'length')
+    # the arrays of a snapshot file
+    _ARRAYS = ("line_rows", "spool_rows", "reducer_rows", "spool_volumes", "reducer_volumes", "spools", "reducers")
+
+    def __init__(self):
+        self._loaded = False
+        self.cursor = 0
+
+    def _set_lines(self, rows: np.ndarray):
+        self.line_rows = rows
+        self.line_ids = rows[:, 0].astype(np.int64)
+        self.line_diameters = rows[:, 1]
+        self.line_lengths = rows[:, 2]
+
+    def _load_lines(self):
+        self._set_lines(np.array(list(Line.objects.order_by('length', 'diameter').values_list(*self.LINE_FIELDS)),
+                                 dtype=np.float64).reshape(-1, len(self.LINE_FIELDS)))
+
+    @staticmethod
+    def _rows(qs, fields) -> np.ndarray:
+        # only models with actual dimensions, the pointers are the prefixes of the dimension fields
+        qs = qs.filter(**{field.rsplit('__', 1)[0] + '__isnull': False for field in fields if '__' in field})
+        return np.array(list(qs.order_by('pk').values_list(*fields)), dtype=np.float64).reshape(-1, len(fields))
+
+    @staticmethod
+    def _spool_volumes(rows: np.ndarray) -> np.ndarray:
+        return fill_volume(rows[:, 1], rows[:, 2], rows[:, 3])
+
+    @staticmethod
+    def _reducer_volumes(rows: np.ndarray) -> np.ndarray:
+        return reducer_fill_volume(rows[:, 2], rows[:, 3], rows[:, 4], rows[:, 5], rows[:, 6])
+
+    def _matrix(self, volumes: np.ndarray) -> np.ndarray:
+        # (rows, 1) against (1, lines) broadcasts to the whole matrix in one pass
+        return volume_capacity(volumes[:, np.newaxis], self.line_diameters[np.newaxis, :])
+
+    def load(self):
+        # the cursor is taken first, a change written during the read is read again by the next refresh()
+        self.cursor = CatalogChange.cursor()
+        self._load_lines()
+        self.spool_rows = self._rows(SpoolModel.objects.all(), self.SPOOL_FIELDS)
+        self.reducer_rows = self._rows(ReducerModel.objects.all(), self.REDUCER_FIELDS)
+        self.spool_volumes = self._spool_volumes(self.spool_rows)
+        self.reducer_volumes = self._reducer_volumes(self.reducer_rows)
+        self.spools = self._matrix(self.spool_volumes)
+        self.reducers = self._matrix(self.reducer_volumes)
+        self._loaded = True
+
+    def _replace(self, name: str, stale: np.ndarray, fresh: np.ndarray, volumes: np.ndarray):
+        """Replaces the `stale` rows of the `name` arrays by the `fresh` rows and their volumes."""
+        rows = np.concatenate([getattr(self, name + "_rows")[~stale], fresh])
+        order = np.argsort(rows[:, 0], kind="stable")
+        setattr(self, name + "_rows", rows[order])
+        setattr(self, name + "_volumes", np.concatenate([getattr(self, name + "_volumes")[~stale], volumes])[order])
+        setattr(self, name + "s", np.concatenate([getattr(self, name + "s")[~stale], self._matrix(volumes)])[order])
+
+    def refresh(self) -> int:
+        """Reads and computes the rows changed since the snapshot again, returns the number of rows read."""
+        if not self._loaded:
+            self.load()
+            return len(self.spool_rows) + len(self.reducer_rows)
+        changed, cursor = CatalogChange.changed_since(self.cursor)
+        spools, reducers = changed[CatalogChange.Kind.SPOOL], changed[CatalogChange.Kind.REDUCER]
+        if len(spools) + len(reducers) > RELOAD_CHANGES:
+            self.load()
+            return len(self.spool_rows) + len(self.reducer_rows)
+        self.cursor = cursor
+        if changed[CatalogChange.Kind.LINE]:
+            self._load_lines()
+            self.spools = self._matrix(self.spool_volumes)
+            self.reducers = self._matrix(self.reducer_volumes)
+        if not (spools or reducers):
+            return 0
+        # deleted records and the ones without actual dimensions anymore are dropped, the queries don't return them
+        fresh_spools = self._rows(SpoolModel.objects.filter(pk__in=spools), self.SPOOL_FIELDS)
+        self._replace("spool", np.isin(self.spool_rows[:, 0], list(spools)), fresh_spools,
+                      self._spool_volumes(fresh_spools))
+        fresh_reducers = self._rows(ReducerModel.objects.filter(Q(pk__in=reducers) | Q(spool_model_id__in=spools)),
+                                    self.REDUCER_FIELDS)
+        self._replace("reducer", np.isin(self.reducer_rows[:, 0], list(reducers)) |
+                      np.isin(self.reducer_rows[:, 1], list(spools)), fresh_reducers,
+                      self._reducer_volumes(fresh_reducers))
+        return len(fresh_spools) + len(fresh_reducers)
+
+    def save(self, path: str = None):
+        if not self._loaded:
+            self.load()
+        save_arrays(path or snapshot_path(self.SNAPSHOT), cursor=np.array([self.cursor]),
+                    **{name: getattr(self, name) for name in self._ARRAYS})
+
+    @classmethod
+    def open(cls, path: str = None) -> "CapacityMatrix":
+        """The matrix saved by save(), an empty one that loads on the first refresh() when there is none."""
+        matrix = cls()
+        arrays = load_arrays(path or snapshot_path(cls.SNAPSHOT))
+        if arrays is None or not set(cls._ARRAYS) <= set(arrays):
+            return matrix
+        # a snapshot ahead of the change log is one of a restored database or of a rolled back transaction
+        if int(arrays["cursor"][0]) <= CatalogChange.cursor():
+            matrix._set_lines(arrays["line_rows"])
+            for name in cls._ARRAYS[1:]:
+                setattr(matrix, name, arrays[name])
+            matrix.cursor = int(arrays["cursor"][0])
+            matrix._loaded = True
+        return matrix
@@ -0,0 +1,251 @@
+import hashlib
+import os
+import pickle
+import re
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from typing import Optional
+
+from django.conf import settings
+from django.db import connection
+
+from crm.models import Line, Price, ReelManufacturer, ReelModel, SpoolModel, ReducerModel
+
+# namedtuples have no __dict__, the whole tree is a few plain tuples per row
+ManufacturerNode = namedtuple("ManufacturerNode", ["id", "name", "reel_model_ids"])
+ReelModelNode = namedtuple("ReelModelNode", ["id", "manufacturer_id", "name", "spool_ids"])
+SpoolNode = namedtuple("SpoolNode", ["id", "reel_model_id", "name", "size", "display_name", "reducer_ids"])
+ReducerNode = namedtuple("ReducerNode", ["id", "spool_model_id", "line_id", "display_name"])
+LineNode = namedtuple("LineNode", ["id", "length", "diameter"])
+PriceNode = namedtuple("PriceNode", ["id", "currency", "price"])
+
+# bumped when the pickled layout changes, the snapshots of an older release are ignored
+SNAPSHOT_FORMAT = 2
+GENERATION_FILE = "generation"
+# seconds a process uses the generation it read last outside of a request, a request reads it once
+GENERATION_CHECK_SECONDS = 1.0
+_SNAPSHOT = re.compile(r"^catalog-v(\d+)-(\d+)\.pickle$")
+
+
+class Catalog:
+    """Manufacturer -> reel model -> spool -> reducer tree with the lines and prices, by id.
+
+    label() is the __str__ of a catalog row without the queries of its ForeignKey chain: the stored
+    display_name of the spools and reducers, computed from the tree for the others.
+    """
+
+    __slots__ = ("manufacturers", "reel_models", "spools", "reducers", "lines", "prices")
+
+    def __init__(self, manufacturers, reel_models, spools, reducers, lines, prices):
+        self.manufacturers = manufacturers
+        self.reel_models = reel_models
+        self.spools = spools
+        self.reducers = reducers
+        self.lines = lines
+        self.prices = prices
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    @classmethod
+    def load(cls) -> "Catalog":
+        """The whole tree in 6 queries."""
+        reducers, spool_reducers = {}, {}
+        for pk, spool_id, line_id, display_name in ReducerModel.objects.order_by('pk').values_list(
+                'pk', 'spool_model_id', 'line_id', 'display_name'):
+            reducers[pk] = ReducerNode(pk, spool_id, line_id, display_name)
+            spool_reducers.setdefault(spool_id, []).append(pk)
+        spools, model_spools = {}, {}
+        for pk, reel_model_id, name, size, display_name in SpoolModel.objects.order_by('pk').values_list(
+                'pk', 'reel_model_id', 'name', 'size', 'display_name'):
+            spools[pk] = SpoolNode(pk, reel_model_id, name, size, display_name, tuple(spool_reducers.get(pk, ())))
+            model_spools.setdefault(reel_model_id, []).append(pk)
+        reel_models, manufacturer_models = {}, {}
+        for pk, manufacturer_id, name in ReelModel.objects.order_by('pk').values_list(
+                'pk', 'reel_manufacturer_id', 'name'):
+            reel_models[pk] = ReelModelNode(pk, manufacturer_id, name, tuple(model_spools.get(pk, ())))
+            manufacturer_models.setdefault(manufacturer_id, []).append(pk)
+        manufacturers = {pk: ManufacturerNode(pk, name, tuple(manufacturer_models.get(pk, ())))
+                         for pk, name in ReelManufacturer.objects.order_by('pk').values_list('pk', 'name')}
+        lines = {pk: LineNode(pk, length, diameter)
+                 for pk, length, diameter in Line.objects.order_by('pk').values_list('pk', 'length', 'diameter')}
+        prices = {pk: PriceNode(pk, currency, price)
+                  for pk, currency, price in Price.objects.order_by('pk').values_list('pk', 'currency', 'price')}
+        return cls(manufacturers, reel_models, spools, reducers, lines, prices)
+
+    def manufacturer_label(self, pk) -> Optional[str]:
+        node = self.manufacturers.get(pk)
+        return None if node is None else node.name
+
+    def reel_model_label(self, pk) -> Optional[str]:
+        node = self.reel_models.get(pk)
+        manufacturer = None if node is None else self.manufacturer_label(node.manufacturer_id)
+        return None if manufacturer is None else "{} {}".format(manufacturer, node.name)
+
+    def spool_label(self, pk) -> Optional[str]:
+        node = self.spools.get(pk)
+        return None if node is None else node.display_name or None
+
+    def reducer_label(self, pk) -> Optional[str]:
+        node = self.reducers.get(pk)
+        return None if node is None else node.display_name or None
+
+    def line_label(self, pk) -> Optional[str]:
+        node = self.lines.get(pk)
+        return None if node is None else "{}-{}".format(str(node.diameter), str(node.length))
+
+    def price_label(self, pk) -> Optional[str]:
+        node = self.prices.get(pk)
+        return None if node is None else "{} {}".format(str(node.price), node.currency)
+
+    def label(self, instance) -> Optional[str]:
+        """Label of a catalog row, None for other models and the rows missing in the snapshot."""
+        label = _LABELS.get(type(instance))
+        return getattr(self, label)(instance.pk) if label else None
+
+
+_LABELS = {
+    ReelManufacturer: "manufacturer_label",
+    ReelModel: "reel_model_label",
+    SpoolModel: "spool_label",
+    ReducerModel: "reducer_label",
+    Line: "line_label",
+    Price: "price_label",
+}
+
+
+class CatalogCache:
+    """Read-through cache of the Catalog, shared by the worker processes of a database.
+
+    The generation is the modification time of a file in nanoseconds, invalidate() moves it forward. A process
+    reads it once per request (request_started calls expire()) and at most every GENERATION_CHECK_SECONDS
+    outside of requests. The first process that needs a generation builds it from the database and writes a
+    snapshot file, the others unpickle that file instead of running the queries. A catalog built inside a
+    transaction is used but not kept, the transaction may roll back after the generation it would be stored
+    under was bumped.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key = None
+        self._catalog = None
+        self._checked = None
+        self._checked_at = 0.0
+        self.hits = 0
+        self.loads = 0
+        self.misses = 0
+
+    @staticmethod
+    def _database() -> str:
+        # the server and database, a SQLite file by its inode: a restored or recreated file is another database
+        settings_dict = connection.settings_dict
+        identity = [connection.vendor, settings_dict['HOST'], settings_dict['PORT'], str(settings_dict['NAME'])]
+        if connection.vendor == "sqlite" and not connection.is_in_memory_db():
+            try:
+                stat = os.stat(settings_dict['NAME'])
+                identity += [os.path.abspath(settings_dict['NAME']), stat.st_dev, stat.st_ino]
+            except OSError:
+                pass
+        return hashlib.sha1(repr(identity).encode()).hexdigest()[:12]
+
+    @property
+    def directory(self) -> str:
+        # one cache per database, the test database never shares the snapshots of the real one
+        return os.path.join(settings.CRM_CATALOG_CACHE_DIR, self._database())
+
+    def generation(self, directory: str = None) -> int:
+        try:
+            return os.stat(os.path.join(directory or self.directory, GENERATION_FILE)).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+    def invalidate(self):
+        directory = self.directory
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, GENERATION_FILE)
+        with open(path, "a"):
+            pass
+        # past the generation this process read: two writes in one tick of the file system clock still differ.
+        # The bumps run after the commits, a bump lost to a concurrent one was read before the other was written,
+        # so its data is in every catalog built under the other one
+        generation = max(time.time_ns(), os.stat(path).st_mtime_ns + 1)
+        os.utime(path, ns=(generation, generation))
+        self.expire()
+
+    def expire(self, **kwargs):
+        """Reads the generation again on the next get()."""
+        self._checked = None
+
+    def _current(self) -> tuple:
+        now = time.monotonic()
+        if self._checked is None or now - self._checked_at > GENERATION_CHECK_SECONDS:
+            directory = self.directory
+            self._checked, self._checked_at = (directory, self.generation(directory)), now
+        return self._checked
+
+    def get(self, build: bool = True) -> Optional[Catalog]:
+        """The catalog of the current generation, None if it isn't cached yet and `build` is False."""
+        key = self._current()
+        with self._lock:
+            if self._key == key:
+                self.hits += 1
+                return self._catalog
+            catalog = self._read_snapshot(*key)
+            if catalog is not None:
+                self.loads += 1
+            elif not build:
+                return None
+            else:
+                self.misses += 1
+                catalog = Catalog.load()
+                if connection.in_atomic_block:
+                    return catalog
+                self._write_snapshot(*key, catalog)
+            self._key, self._catalog = key, catalog
+            return catalog
+
+    def label(self, instance) -> str:
+        """The cached label of a catalog row, its __str__ when the row isn't in the snapshot."""
+        # a tree built inside a transaction isn't kept, a few __str__ queries are cheaper than loading it
+        catalog = self.get(build=not connection.in_atomic_block)
+        label = None if catalog is None else catalog.label(instance)
+        return str(instance) if label is None else label
+
+    def stats(self) -> dict:
+        return {"pid": os.getpid(), "generation": self.generation(), "hits": self.hits, "loads": self.loads,
+                "misses": self.misses}
+
+    @staticmethod
+    def _snapshot_name(directory: str, generation: int) -> str:
+        return os.path.join(directory, "catalog-v{}-{}.pickle".format(SNAPSHOT_FORMAT, generation))
+
+    def _read_snapshot(self, directory: str, generation: int) -> Optional[Catalog]:
+        try:
+            with open(self._snapshot_name(directory, generation), 'rb') as fh:
+                return pickle.load(fh)
+        except (OSError, ValueError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def _write_snapshot(self, directory: str, generation: int, catalog: Catalog):
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, 'wb') as fh:
+            pickle.dump(catalog, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        # the rename is atomic, a reader opens either no file or a complete one
+        os.replace(tmp_name, self._snapshot_name(directory, generation))
+        for name in os.listdir(directory):
+            match = _SNAPSHOT.match(name)
+            if match and (int(match.group(1)) != SNAPSHOT_FORMAT or int(match.group(2)) < generation):
+                try:
+                    os.remove(os.path.join(directory, name))
+                except FileNotFoundError:
+                    pass
+
+
+catalog_cache = CatalogCache()
@@ -0,0 +1,27 @@
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+def sqlite_pragmas(pragmas=None):
+    pragmas = settings.CRM_SQLITE_PRAGMAS if pragmas is None else pragmas
+    return ["PRAGMA {} = {}".format(name, value) for name, value in pragmas.items()]
+
+
+@receiver(connection_created)
+def configure_connection(sender, connection, **kwargs):
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        for statement in sqlite_pragmas():
+            cursor.execute(statement)
+
+
+def update_statistics(connection):
+    """Refreshes the planner statistics after a bulk load.
+
+    Without them SQLite joins the admin changelists from the largest table and sorts the result, with them it
+    walks the name indexes of the manufacturers, reel models and spool models in order and stops at LIMIT.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("ANALYZE")
@@ -0,0 +1,166 @@
+import csv
+import tempfile
+from collections import defaultdict
+from itertools import islice
+from typing import Callable, Iterable, Iterator, List, Optional
+
+from django.http import FileResponse, StreamingHttpResponse
+
+from crm.importer.parser import NULL, RecordParser
+from crm.models import OrderItem, ReducerModel, ReducerDimension, SpoolDimension, SpoolModel
+
+# the columns import_models reads
+CATALOG_HEADER = ["model", "line", "d1", "d2", "h1", "d3", "d4", "h2", "description", "spool_description",
+                  "reducer_description", "spool_actual", "reducer_actual"]
+ORDER_HEADER = ["order_group", "order", "placed", "payed", "sent", "reducer", "line", "currency", "price", "amount",
+                "item_sum", "order_total"]
+BATCH_SIZE = 1000
+FORMATS = ("csv", "xlsx")
+CONTENT_TYPES = {
+    "csv": "text/csv",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+
+
+def _batches(iterable: Iterable, size: int):
+    it = iter(iterable)
+    batch = list(islice(it, size))
+    while batch:
+        yield batch
+        batch = list(islice(it, size))
+
+
+def _dims(dims: Iterable[tuple]) -> List[str]:
+    # "/" separated lists of every dimension component, repr() keeps the floats exact
+    columns = list(zip(*dims)) or [(), (), ()]
+    return ["/".join(repr(value) for value in column) for column in columns]
+
+
+def _text(value: Optional[str]) -> str:
+    return NULL if value is None else value
+
+
+def _actual(dims: List[tuple]) -> str:
+    """1-based position of the actual dimension, the dimensions are (actual, ...) tuples."""
+    return next((str(i) for i, (actual, *dim) in enumerate(dims, 1) if actual), "")
+
+
+def catalog_rows(reducers=None, batch_size: int = BATCH_SIZE,
+                 warn: Optional[Callable[[str], None]] = None) -> Iterator[list]:
+    """CSV rows of the reducers in the import_models layout, the header first.
+
+    Every reducer is one row per distinct description of its dimensions, with all its spool
+    dimensions; the reducers are read with a chunked iterator and the dimensions batch by batch,
+    so the memory use doesn't depend on the size of the catalog. The model descriptions and the
+    actual dimensions have their own columns, a NULL description is written as \\N. `warn` gets the
+    rows import_models would read back differently, the layout has no column for those values.
+    """
+    whole_catalog = reducers is None
+    reducers = ReducerModel.objects.all() if whole_catalog else reducers
+    rows = reducers.order_by('spool_model__reel_model__reel_manufacturer__name', 'spool_model__reel_model__name',
+                             'spool_model__name', 'line__length', 'line__diameter', 'pk').values_list(
+        'pk', 'spool_model_id', 'spool_model__reel_model__reel_manufacturer__name', 'spool_model__reel_model__name',
+        'spool_model__name', 'spool_model__size', 'spool_model__description', 'description', 'line__length',
+        'line__diameter')
+    yield CATALOG_HEADER
+    for batch in _batches(rows.iterator(chunk_size=batch_size), batch_size):
+        spool_dims = defaultdict(list)
+        for spool_id, *dim in SpoolDimension.objects.filter(spool_model_id__in={row[1] for row in batch}) \
+                .order_by('pk').values_list('spool_model_id', 'actual', 'D1', 'D2', 'H1'):
+            spool_dims[spool_id].append(tuple(dim))
+        reducer_dims = defaultdict(dict)
+        for reducer_id, description, *dim in ReducerDimension.objects.filter(
+                reducer_model_id__in=[row[0] for row in batch]).order_by('pk').values_list(
+                'reducer_model_id', 'description', 'actual', 'D3', 'D4', 'H2'):
+            reducer_dims[reducer_id].setdefault(description, []).append(tuple(dim))
+
+        for pk, spool_id, manufacturer, reel_model, spool, size, spool_description, reducer_description, length, \
+                diameter in batch:
+            model = "_".join([manufacturer, reel_model] + (spool or "").split())
+            if warn and (RecordParser.parse_model(model) != (manufacturer, reel_model) or
+                         RecordParser.parse_spool(model) != (spool or "", size)):
+                warn("{}: names or size are read back as {} {}".format(
+                    model, RecordParser.parse_model(model), RecordParser.parse_spool(model)))
+            line = "{!r}-{}".format(diameter, length)
+            dims = spool_dims[spool_id]
+            spool_columns = _dims(dim for actual, *dim in dims)
+            for description, reducer in (reducer_dims.get(pk) or {"": []}).items():
+                yield [model, line] + spool_columns + _dims(dim for actual, *dim in reducer) + [
+                    _text(description), _text(spool_description), _text(reducer_description), _actual(dims),
+                    _actual(reducer)]
+
+    if warn and whole_catalog:
+        # a row always has a line, import_models would add a 0-0 reducer to these
+        for spool in SpoolModel.objects.filter(reducermodel__isnull=True).select_related(
+                'reel_model__reel_manufacturer').iterator():
+            warn("{}: spool without reducers isn't exported".format(spool))
+
+
+def order_rows(items=None, batch_size: int = BATCH_SIZE) -> Iterator[list]:
+    """CSV rows of the order items with their sums and the cached order totals, the header first."""
+    items = OrderItem.objects.all() if items is None else items
+    rows = items.order_by('order__order_group__created', 'order__placed', 'order_id', 'pk').values_list(
+        'order__order_group__name', 'order__name', 'order__placed', 'order__payed', 'order__sent',
+        'reducer_model__spool_model__reel_model__reel_manufacturer__name',
+        'reducer_model__spool_model__reel_model__name',
+        'reducer_model__spool_model__name', 'reducer_model__line__diameter', 'reducer_model__line__length',
+        'price__currency', 'price__price', 'amount', 'order__total')
+    yield ORDER_HEADER
+    for (group, order, placed, payed, sent, manufacturer, reel_model, spool, diameter, length, currency, price,
+         amount, total) in rows.iterator(chunk_size=batch_size):
+        reducer = " ".join(filter(None, [manufacturer, reel_model, spool]))
+        yield [group, order, placed.isoformat(), payed, sent, reducer, "{}-{}".format(diameter, length), currency,
+               price, amount, price * amount, total]
+
+
+class Echo:
+    """File-like object csv.writer writes to, returns the line instead of storing it."""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows: Iterable[list]) -> Iterator[str]:
+    writer = csv.writer(Echo())
+    return (writer.writerow(row) for row in rows)
+
+
+def write_csv(rows: Iterable[list], fh) -> int:
+    count = -1
+    writer = csv.writer(fh)
+    for count, row in enumerate(rows):
+        writer.writerow(row)
+    return max(count, 0)
+
+
+def write_xlsx(rows: Iterable[list], fh, title: str = "export") -> int:
+    """Writes the rows with openpyxl's write-only workbook, which streams them to a temporary file."""
+    try:
+        from openpyxl import Workbook
+    except ImportError:
+        raise ImportError("XLSX export needs openpyxl: pip install openpyxl")
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(title)
+    count = -1
+    for count, row in enumerate(rows):
+        sheet.append(row)
+    workbook.save(fh)
+    return max(count, 0)
+
+
+def write_rows(rows: Iterable[list], fmt: str, fh, title: str = "export") -> int:
+    """Writes the rows to a text (CSV) or binary (XLSX) file, returns the count without the header."""
+    return write_csv(rows, fh) if fmt == "csv" else write_xlsx(rows, fh, title)
+
+
+def export_response(rows: Iterable[list], fmt: str, name: str):
+    """CSV is streamed to the client row by row, XLSX is a zip and is spooled to a temporary file first."""
+    filename = "{}.{}".format(name, fmt)
+    if fmt == "csv":
+        response = StreamingHttpResponse(csv_lines(rows), content_type=CONTENT_TYPES[fmt])
+        response['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
+        return response
+    fh = tempfile.TemporaryFile()
+    write_xlsx(rows, fh, name)
+    fh.seek(0)
+    return FileResponse(fh, as_attachment=True, filename=filename, content_type=CONTENT_TYPES[fmt])
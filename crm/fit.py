@@ -0,0 +1,140 @@
+from collections import namedtuple
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+from django.db.models import Q
+
+from crm.models import CatalogChange, ReducerModel
+from crm.snapshots import load_arrays, save_arrays, snapshot_path
+
+Fit = namedtuple("Fit", [
+    "reducer_id",  # ReducerModel.pk
+    "distance",  # euclidean distance of the spool dimensions
+    "spool",  # (D1, D2, H1)
+    "reducer",  # (D3, D4, H2)
+    "line",  # (Line.length, Line.diameter)
+])
+
+_FIELDS = ('pk', 'spool_model_id', 'line__diameter', 'line__length',
+           'spool_model__actual_dimension__D1', 'spool_model__actual_dimension__D2',
+           'spool_model__actual_dimension__H1',
+           'actual_dimension__D3', 'actual_dimension__D4', 'actual_dimension__H2', 'line_id')
+# more changed records than this are read with the query of the whole index instead of id lists
+RELOAD_CHANGES = 500
+
+
+class FitIndex:
+    """Actual spool and reducer geometry of every ReducerModel in NumPy arrays.
+
+    Rows are sorted by spool D1, so the candidates within a D1 tolerance are one searchsorted() slice,
+    the rest of the comparison is vectorized over that slice.
+
+    The arrays are a snapshot of the change log cursor read by load(). refresh() reads the CatalogChange
+    entries after that cursor and re-reads only the rows of the changed reducers and of the reducers of the
+    changed spools and lines, a search refreshes first. find_reducer keeps the snapshot in a file of the
+    catalog cache directory, a run reads the file and the rows changed since the last run.
+    """
+
+    SNAPSHOT = "fit-index-v1.npz"
+
+    def __init__(self):
+        self._loaded = False
+        self.cursor = 0
+        self._set_rows(np.empty((0, len(_FIELDS))))
+
+    def _set_rows(self, rows: np.ndarray):
+        rows = rows[np.argsort(rows[:, 4], kind="stable")]
+        self.rows = rows
+        self.ids = rows[:, 0].astype(np.int64)
+        self.spool_ids = rows[:, 1].astype(np.int64)
+        self.lines = rows[:, 2:4]  # diameter, length
+        self.spools = rows[:, 4:7]  # D1, D2, H1
+        self.reducers = rows[:, 7:10]  # D3, D4, H2
+        self.line_ids = rows[:, 10].astype(np.int64)
+
+    @staticmethod
+    def _read(qs) -> np.ndarray:
+        qs = qs.filter(spool_model__actual_dimension__isnull=False, actual_dimension__isnull=False)
+        return np.array(list(qs.order_by().values_list(*_FIELDS)), dtype=np.float64).reshape(-1, len(_FIELDS))
+
+    def load(self):
+        # the cursor is taken first, a change written during the read is read again by the next refresh()
+        self.cursor = CatalogChange.cursor()
+        self._set_rows(self._read(ReducerModel.objects.all()))
+        self._loaded = True
+
+    def refresh(self) -> int:
+        """Re-reads the rows changed since the snapshot, returns the number of rows read."""
+        if not self._loaded:
+            self.load()
+            return len(self.ids)
+        changed, cursor = CatalogChange.changed_since(self.cursor)
+        reducers, spools, lines = (changed[kind] for kind in (
+            CatalogChange.Kind.REDUCER, CatalogChange.Kind.SPOOL, CatalogChange.Kind.LINE))
+        if len(reducers) + len(spools) + len(lines) > RELOAD_CHANGES:
+            self.load()
+            return len(self.ids)
+        self.cursor = cursor
+        if not (reducers or spools or lines):
+            return 0
+        # deleted records and the ones without actual dimensions anymore are dropped, the query doesn't return them
+        stale = np.isin(self.ids, list(reducers)) | np.isin(self.spool_ids, list(spools)) | \
+            np.isin(self.line_ids, list(lines))
+        fresh = self._read(ReducerModel.objects.filter(
+            Q(pk__in=reducers) | Q(spool_model_id__in=spools) | Q(line_id__in=lines)))
+        self._set_rows(np.concatenate([self.rows[~stale], fresh]))
+        return len(fresh)
+
+    def save(self, path: str = None):
+        if not self._loaded:
+            self.load()
+        save_arrays(path or snapshot_path(self.SNAPSHOT), rows=self.rows, cursor=np.array([self.cursor]))
+
+    @classmethod
+    def open(cls, path: str = None) -> "FitIndex":
+        """The index saved by save(), an empty one that loads on the first search when there is none."""
+        index = cls()
+        arrays = load_arrays(path or snapshot_path(cls.SNAPSHOT))
+        if arrays is None or arrays["rows"].ndim != 2 or arrays["rows"].shape[1] != len(_FIELDS):
+            return index
+        # a snapshot ahead of the change log is one of a restored database or of a rolled back transaction
+        if int(arrays["cursor"][0]) <= CatalogChange.cursor():
+            index._set_rows(arrays["rows"])
+            index.cursor = int(arrays["cursor"][0])
+            index._loaded = True
+        return index
+
+    def search(self, spool: Tuple[float, float, float], line: Tuple[int, float] = None,
+               tolerance: float = 1.0, limit: int = 1) -> List[Fit]:
+        return self.search_many([spool], [line], tolerance, limit)[0]
+
+    def search_many(self, spools: Iterable[Tuple[float, float, float]], lines: Iterable[Optional[Tuple[int, float]]],
+                    tolerance: float = 1.0, limit: int = 1) -> List[List[Fit]]:
+        """Best fitting reducers for every spool (D1, D2, H1) and optional line (length, diameter).
+
+        A reducer fits when all spool dimensions differ by at most `tolerance` and the line matches,
+        the fits are ordered by the euclidean distance of the spool dimensions.
+        """
+        self.refresh()
+        spools = np.asarray(list(spools), dtype=np.float64).reshape(-1, 3)
+        lines = list(lines)
+        starts = np.searchsorted(self.spools[:, 0], spools[:, 0] - tolerance, side="left")
+        ends = np.searchsorted(self.spools[:, 0], spools[:, 0] + tolerance, side="right")
+
+        results = []
+        for spool, line, start, end in zip(spools, lines, starts, ends):
+            diff = np.abs(self.spools[start:end] - spool)
+            mask = (diff <= tolerance).all(axis=1)
+            if line:
+                length, diameter = line
+                mask &= np.isclose(self.lines[start:end, 0], diameter)
+                if length:
+                    mask &= self.lines[start:end, 1] == length
+            candidates = np.flatnonzero(mask)
+            distances = np.sqrt((diff[candidates] ** 2).sum(axis=1))
+            best = np.argsort(distances, kind="stable")[:limit]
+            results.append([Fit(int(self.ids[i]), float(distance), tuple(self.spools[i].tolist()),
+                                tuple(self.reducers[i].tolist()), (int(self.lines[i, 1]), float(self.lines[i, 0])))
+                            for i, distance in zip(candidates[best] + start, distances[best])])
+        return results
+
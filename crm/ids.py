@@ -0,0 +1,65 @@
+import hashlib
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timezone
+
+from django.conf import settings
+
+NODE_LENGTH = 8
+
+
+class NameGenerator:
+    """Unique readable names: "<prefix>-<UTC second>Z-<node>-<sequence>".
+
+    The node tags the process, the sequence counts the names the process made in that second,
+    so the names of different workers never collide and the names of a worker always increase,
+    with no query to find a free one. The clock going back doesn't reuse a second: the generator
+    stays on the last second it used until the clock catches up. The second is in UTC, a local time
+    repeats an hour when daylight saving time ends.
+    """
+
+    def __init__(self, node: str = None):
+        self._lock = threading.Lock()
+        self._fixed_node = node
+        self._node = None
+        self._pid = None
+        self._second = 0
+        self._sequence = 0
+
+    @property
+    def node(self) -> str:
+        if self._pid != os.getpid():
+            # a forked worker inherits the parent's state, it needs a node and sequence of its own
+            self._pid = os.getpid()
+            self._second, self._sequence = 0, 0
+            self._node = self._fixed_node or self._configured_node() or self._random_node()
+        return self._node
+
+    @classmethod
+    def _configured_node(cls) -> str:
+        # the workers of a host share its settings, containers of one image share the settings and often the pid
+        # as well: a random tag per process tells them apart
+        node = getattr(settings, "CRM_NODE_ID", "")
+        return "{}.{}".format(node, cls._random_node()) if node else ""
+
+    @staticmethod
+    def _random_node() -> str:
+        seed = "{}:{}:{}".format(socket.gethostname(), os.getpid(), os.urandom(8).hex()).encode()
+        return hashlib.sha1(seed).hexdigest()[:NODE_LENGTH]
+
+    def next(self, prefix: str) -> str:
+        with self._lock:
+            node = self.node
+            second = max(int(time.time()), self._second)
+            if second == self._second:
+                self._sequence += 1
+            else:
+                self._second, self._sequence = second, 0
+            return "{}-{}-{}-{:04d}".format(
+                prefix, datetime.fromtimestamp(second, timezone.utc).strftime("%Y-%m-%d_%H:%M:%SZ"), node,
+                self._sequence)
+
+
+names = NameGenerator()
@@ -0,0 +1,5 @@
+from crm.importer.parser import CsvSource, ImportRecord, ImportRecordError, ParsedChunk, RecordParser, parse_chunks, \
+    parse_jobs, read_records
+from crm.importer.writer import BulkImporter, ImportStats, QueryCounter, chunks
+from crm.importer.diff import CatalogDiff
+from crm.importer.fingerprint import FingerprintFilter
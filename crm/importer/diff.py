@@ -0,0 +1,103 @@
+from collections import defaultdict
+from typing import Dict, Iterable, List, Set
+
+from crm.importer.parser import ImportRecord
+from crm.importer.writer import chunks
+from crm.models import Line, ReelManufacturer, ReelModel, SpoolModel, SpoolDimension, ReducerModel, ReducerDimension
+
+# natural key fields of every catalog level, in the order they appear in the key tuples
+KEY_FIELDS = {
+    "line": ("length", "diameter"),
+    "reel_manufacturer": ("manufacturer",),
+    "reel_model": ("manufacturer", "reel_model"),
+    "spool_model": ("manufacturer", "reel_model", "spool"),
+    "spool_dimension": ("manufacturer", "reel_model", "spool", "D1", "D2", "H1"),
+    "reducer_model": ("manufacturer", "reel_model", "spool", "length", "diameter"),
+    "reducer_dimension": ("manufacturer", "reel_model", "spool", "length", "diameter", "D3", "D4", "H2",
+                          "description"),
+}
+
+_SPOOL = ("reel_model__reel_manufacturer__name", "reel_model__name", "name")
+_REDUCER_SPOOL = tuple("spool_model__" + field for field in _SPOOL)
+
+
+class CatalogDiff:
+    """Compares ImportRecords with the catalog by natural keys.
+
+    Both sides are turned into sets of key tuples, the slice of the catalog that belongs to the
+    manufacturers of the file is loaded with one query per level.
+    """
+
+    def __init__(self, batch_size: int = 500):
+        self.batch_size = batch_size
+        self.incoming = {level: set() for level in KEY_FIELDS}
+
+    def add(self, records: Iterable[ImportRecord]):
+        for r in records:
+            spool = (r.manufacturer, r.reel_model, r.spool)
+            reducer = spool + r.line
+            self.incoming["line"].add(r.line)
+            self.incoming["reel_manufacturer"].add((r.manufacturer,))
+            self.incoming["reel_model"].add((r.manufacturer, r.reel_model))
+            self.incoming["spool_model"].add(spool)
+            self.incoming["spool_dimension"].update(spool + dim for dim in r.spool_dims)
+            self.incoming["reducer_model"].add(reducer)
+            self.incoming["reducer_dimension"].update(reducer + dim + (r.description,) for dim in r.reducer_dims)
+
+    def load_existing(self) -> Dict[str, Set[tuple]]:
+        manufacturers = [key[0] for key in self.incoming["reel_manufacturer"]]
+        lines = {key[0] for key in self.incoming["line"]}
+        existing = {level: set() for level in KEY_FIELDS}
+        existing["line"].update(Line.objects.filter(length__in=lines).values_list("length", "diameter"))
+        for names in chunks(manufacturers, self.batch_size):
+            existing["reel_manufacturer"].update(
+                ReelManufacturer.objects.filter(name__in=names).values_list("name"))
+            existing["reel_model"].update(
+                ReelModel.objects.filter(reel_manufacturer__name__in=names)
+                .values_list("reel_manufacturer__name", "name"))
+            existing["spool_model"].update(
+                SpoolModel.objects.filter(reel_model__reel_manufacturer__name__in=names).values_list(*_SPOOL))
+            existing["spool_dimension"].update(
+                SpoolDimension.objects.filter(spool_model__reel_model__reel_manufacturer__name__in=names)
+                .values_list(*("spool_model__" + field for field in _SPOOL), "D1", "D2", "H1"))
+            existing["reducer_model"].update(
+                ReducerModel.objects.filter(spool_model__reel_model__reel_manufacturer__name__in=names)
+                .values_list(*_REDUCER_SPOOL, "line__length", "line__diameter"))
+            existing["reducer_dimension"].update(
+                ReducerDimension.objects.filter(
+                    reducer_model__spool_model__reel_model__reel_manufacturer__name__in=names)
+                .values_list(*("reducer_model__" + field for field in _REDUCER_SPOOL),
+                             "reducer_model__line__length", "reducer_model__line__diameter",
+                             "D3", "D4", "H2", "description"))
+        return existing
+
+    def report(self) -> dict:
+        existing = self.load_existing()
+        new = {level: self.incoming[level] - existing[level] for level in KEY_FIELDS}
+
+        # reducer dimensions whose geometry exists already, but only with another description
+        existing_geometry = defaultdict(list)
+        for key in existing["reducer_dimension"]:
+            existing_geometry[key[:-1]].append(key[-1])
+        changed = []
+        for key in sorted(new["reducer_dimension"], key=_sort_key):
+            if key[:-1] in existing_geometry:
+                changed.append(dict(_as_dict("reducer_dimension", key),
+                                    existing_descriptions=sorted(existing_geometry[key[:-1]], key=str)))
+        new["reducer_dimension"] -= {key for key in new["reducer_dimension"] if key[:-1] in existing_geometry}
+
+        return {
+            "summary": dict({level: len(keys) for level, keys in new.items()},
+                            description_changed=len(changed)),
+            "new": {level: [_as_dict(level, key) for key in sorted(keys, key=_sort_key)]
+                    for level, keys in new.items()},
+            "description_changed": changed,
+        }
+
+
+def _sort_key(key) -> List[str]:
+    return [str(value) for value in key] if isinstance(key, tuple) else [str(key)]
+
+
+def _as_dict(level: str, key: tuple) -> dict:
+    return dict(zip(KEY_FIELDS[level], key))
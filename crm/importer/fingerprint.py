@@ -0,0 +1,71 @@
+import hashlib
+from collections import Counter
+from typing import Callable, Dict, Iterable, List
+
+from crm.importer.parser import ImportRecord
+from crm.importer.writer import ImportStats, chunks
+from crm.models import ImportFingerprint
+
+
+def _sha1(value) -> str:
+    return hashlib.sha1(repr(value).encode("utf-8")).hexdigest()
+
+
+class FingerprintFilter:
+    """Drops the records of a source that are unchanged since its previous import.
+
+    Rows are identified by their model/line and the number of times that pair occurred before in the
+    file, the digest covers the whole normalized record, so the fill-forward values are part of it.
+    A chunked import stores `occurrences` with its checkpoint, a resumed run continues the counts.
+    """
+
+    def __init__(self, source: str, stats: ImportStats, batch_size: int = 500, occurrences: Dict[str, int] = None):
+        self.source = source
+        self.stats = stats
+        self.batch_size = batch_size
+        self.previous = {row_key: (pk, digest) for pk, row_key, digest in
+                         ImportFingerprint.objects.filter(source=source).values_list('pk', 'row_key', 'digest')}
+        self.occurrences = Counter(occurrences or {})
+        self.seen = set()
+        self.pending = {}
+
+    def filter(self, records: Iterable[ImportRecord],
+               exists: Callable[[ImportRecord], bool] = lambda record: True) -> List[ImportRecord]:
+        """The records to write: the new and changed ones, and the unchanged ones whose catalog rows don't
+        `exist` any more, deleted since the previous import."""
+        changed = []
+        for record in records:
+            natural_key = (record.manufacturer, record.reel_model, record.spool, record.line)
+            occurrence_key = _sha1(natural_key)
+            self.occurrences[occurrence_key] += 1
+            row_key = _sha1((natural_key, self.occurrences[occurrence_key]))
+            digest = _sha1(tuple(record))
+            self.seen.add(row_key)
+
+            pk, previous_digest = self.previous.get(row_key, (None, None))
+            if digest == previous_digest and exists(record):
+                self.stats.skipped += 1
+                continue
+            self.stats.fingerprints["changed" if pk else "inserted"] += 1
+            self.pending[row_key] = digest
+            changed.append(record)
+        return changed
+
+    def save(self):
+        """Stores the digests of the rows passed by filter(), call it in the transaction that wrote them."""
+        new = [ImportFingerprint(source=self.source, row_key=row_key, digest=digest)
+               for row_key, digest in self.pending.items() if row_key not in self.previous]
+        ImportFingerprint.objects.bulk_create(new, batch_size=self.batch_size)
+        changed = [ImportFingerprint(pk=self.previous[row_key][0], digest=digest)
+                   for row_key, digest in self.pending.items() if row_key in self.previous]
+        ImportFingerprint.objects.bulk_update(changed, ['digest'], batch_size=self.batch_size)
+        for row_key, digest in self.pending.items():
+            self.previous[row_key] = (self.previous.get(row_key, (None, None))[0], digest)
+        self.pending = {}
+
+    def finish(self):
+        """Forgets the rows that disappeared from the source, the catalog rows they created are kept."""
+        deleted = [pk for row_key, (pk, digest) in self.previous.items() if row_key not in self.seen and pk]
+        for pks in chunks(deleted, self.batch_size):
+            ImportFingerprint.objects.filter(pk__in=pks).delete()
+        self.stats.fingerprints["deleted"] += len(deleted)
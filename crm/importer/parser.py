@@ -0,0 +1,279 @@
+import csv
+import re
+from collections import namedtuple
+from itertools import islice
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+ImportRecord = namedtuple("ImportRecord", [
+    "manufacturer",  # ReelManufacturer.name
+    "reel_model",  # ReelModel.name
+    "spool",  # SpoolModel.name
+    "size",  # SpoolModel.size
+    "line",  # (Line.length, Line.diameter)
+    "spool_dims",  # ((D1, D2, H1), ...)
+    "reducer_dims",  # ((D3, D4, H2), ...)
+    "description",  # ReducerDimension.description
+    "spool_description",  # SpoolModel.description, set when the spool is created
+    "reducer_description",  # ReducerModel.description, set when the reducer is created
+    "spool_actual",  # index of the actual dimension in spool_dims or None
+    "reducer_actual",  # index of the actual dimension in reducer_dims or None
+], defaults=(None, None, None, None))
+
+# a cell holding NULL is read as None, an empty cell as ""
+NULL = "\\N"
+
+
+ParsedChunk = namedtuple("ParsedChunk", [
+    "records",  # [ImportRecord, ...]
+    "offset",  # CsvSource.offset behind the last row of the chunk
+    "state",  # CsvSource.state behind the last row of the chunk
+    "row",  # CsvSource.row of the last row of the chunk
+])
+
+
+class ImportRecordError(ValueError):
+    pass
+
+
+class RecordParser:
+    """Turns raw CSV rows into ImportRecord tuples.
+
+    Keeps the fill-forward state of a single file: the last seen model/line and the last
+    complete dimension triple used to fill the gaps of "/" separated dimension lists.
+    """
+
+    def __init__(self, state: dict = None):
+        self.current_model = None
+        self.current_line = None
+        self.last_dim = [None, None, None]
+        if state:
+            self.state = state
+
+    @property
+    def state(self) -> dict:
+        return {"model": self.current_model, "line": self.current_line, "dim": list(self.last_dim)}
+
+    @state.setter
+    def state(self, state: dict):
+        self.current_model = state.get("model")
+        self.current_line = state.get("line")
+        self.last_dim = list(state.get("dim") or [None, None, None])
+
+    def parse(self, record: Dict[str, str]) -> Optional[ImportRecord]:
+        if self.record_empty(record):
+            return None
+        self.fill_forward(record)
+        return self.normalize(record)
+
+    @staticmethod
+    def record_empty(record: dict):
+        return not list(filter(None, record.values()))
+
+    def fill_forward(self, record: Dict[str, str]):
+        if not record.get('line') and not record.get("model"):
+            record['line'] = self.current_line
+        else:
+            self.current_line = record.get("line")
+
+        if not record.get('model'):
+            record['model'] = self.current_model
+        else:
+            self.current_model = record['model']
+
+    def normalize(self, record: Dict[str, str]) -> ImportRecord:
+        manufacturer, reel_model = self.parse_model(record.get("model"))
+        spool, size = self.parse_spool(record.get("model"))
+        spool_dims = self.parse_dims(record.get("d1"), record.get("d2"), record.get("h1"))
+        reducer_dims = self.parse_dims(record.get("d3"), record.get("d4"), record.get("h2"))
+        return ImportRecord(
+            manufacturer=manufacturer,
+            reel_model=reel_model,
+            spool=spool,
+            size=size,
+            line=self.parse_line(record.get("line")),
+            spool_dims=spool_dims,
+            reducer_dims=reducer_dims,
+            description=self.parse_null(record.get("description")),
+            spool_description=self.parse_null(record.get("spool_description")),
+            reducer_description=self.parse_null(record.get("reducer_description")),
+            spool_actual=self.parse_index(record.get("spool_actual"), spool_dims),
+            reducer_actual=self.parse_index(record.get("reducer_actual"), reducer_dims))
+
+    @staticmethod
+    def parse_model(model: str) -> Tuple[str, str]:
+        model_list = (model or "").strip().split("_")
+        if len(model_list) < 2:
+            raise ImportRecordError("Can't parse manufacturer and reel model from {!r}".format(model))
+        manufacturer, model = model_list[0:2]
+        return str(manufacturer).strip().capitalize(), str(model).strip().capitalize()
+
+    @staticmethod
+    def parse_spool(model: str) -> Tuple[str, Optional[int]]:
+        spool_name = " ".join(model.strip().split("_")[2:])
+        size = re.search(r"([\d]{4,})", spool_name)
+        if size:
+            size = int(size.group(1))
+        return spool_name.strip().capitalize(), size
+
+    @staticmethod
+    def parse_null(value: Optional[str]) -> Optional[str]:
+        return None if value == NULL else value
+
+    @staticmethod
+    def parse_index(value: Optional[str], dims: tuple) -> Optional[int]:
+        """The 1-based position of the actual dimension in the "/" separated list, as a 0-based index."""
+        if not value or not value.strip():
+            return None
+        index = int(value) - 1
+        if not 0 <= index < len(dims):
+            raise ValueError("No dimension {} of {}".format(value, len(dims)))
+        return index
+
+    @staticmethod
+    def parse_line(line: str = "") -> Tuple[int, float]:
+        if not line:
+            line = "0-0"
+        line_list = line.strip().split('-')
+        if len(line_list) < 2:
+            line_list.append("0")
+        diameter, length = line_list
+        if "," in length or "." in length:
+            length, diameter = diameter, length
+        return int(length), float(diameter.replace(",", "."))
+
+    def parse_dims(self, d1: str, d2: str, h: str) -> Tuple[Tuple[float, float, float], ...]:
+        return tuple((valid_float(d1), valid_float(d2), valid_float(h)) for d1, d2, h in self.unpack_dim(d1, d2, h))
+
+    def unpack_dim(self, d1: str, d2: str, h: str):
+        cur_d1, cur_d2, cur_h = self.last_dim
+        for dim in zip_lists(d1.split("/"), d2.split("/"), h.split("/")):
+            if not next(filter(None, dim), None):
+                continue
+            d1, d2, h = dim
+            if not d1:
+                if cur_d1:
+                    d1 = cur_d1
+                else:
+                    continue
+
+            if not d2:
+                if cur_d2:
+                    d2 = cur_d2
+                else:
+                    continue
+
+            if not h:
+                if cur_h:
+                    h = cur_h
+                else:
+                    continue
+            yield d1, d2, h
+            self.last_dim = [d1, d2, h]
+
+
+def zip_lists(*args):
+    max_len = len(max(*args, key=len))
+    eq_it = map(lambda v: v + [v[-1]] * (max_len - len(v)), args)
+    return zip(*eq_it)
+
+
+def valid_float(value: Union[str, float]) -> float:
+    if isinstance(value, float):
+        return value
+    return float(value.strip().replace(",", ".").replace(" ", ''))
+
+
+class _OffsetLines:
+    """Line iterator over a binary file that knows the byte offset of the next unread line."""
+
+    def __init__(self, fh, encoding: str):
+        self.fh = fh
+        self.encoding = encoding
+        self.offset = fh.tell()
+
+    def seek(self, offset: int):
+        self.fh.seek(offset)
+        self.offset = offset
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        line = self.fh.readline()
+        if not line:
+            raise StopIteration
+        self.offset += len(line)
+        return line.decode(self.encoding)
+
+
+class CsvSource:
+    """Streams ImportRecords from a CSV file.
+
+    After every yielded record `offset` points right behind its row and `state` holds the parser
+    fill-forward state, so a later CsvSource(file_path, offset, state, row) continues exactly there.
+    """
+
+    def __init__(self, file_path: str, offset: int = 0, state: dict = None, row: int = 0, encoding: str = "utf-8-sig"):
+        self.file_path = file_path
+        self.offset = offset
+        self.row = row
+        self.parser = RecordParser(state)
+        self.encoding = encoding
+
+    @property
+    def state(self) -> dict:
+        return self.parser.state
+
+    def __iter__(self) -> Iterator[ImportRecord]:
+        with open(self.file_path, "rb") as fh:
+            lines = _OffsetLines(fh, self.encoding)
+            reader = csv.DictReader(lines)
+            # the header is always read from the beginning of the file
+            if reader.fieldnames and self.offset:
+                lines.seek(self.offset)
+            for record in reader:
+                self.row += 1
+                try:
+                    import_record = self.parser.parse(record)
+                except ValueError as e:
+                    raise ImportRecordError("{}: row {}: {}".format(self.file_path, self.row, e)) from e
+                self.offset = lines.offset
+                if import_record:
+                    yield import_record
+
+
+def read_records(file_path: str) -> Iterator[ImportRecord]:
+    return iter(CsvSource(file_path))
+
+
+def parse_chunks(file_path: str, offset: int = 0, state: dict = None, row: int = 0,
+                 chunk_size: int = None) -> Iterator[ParsedChunk]:
+    source = CsvSource(file_path, offset, state, row)
+    records = iter(source)
+    chunk = list(islice(records, chunk_size))
+    while chunk:
+        yield ParsedChunk(chunk, source.offset, source.state, source.row)
+        chunk = list(islice(records, chunk_size))
+
+
+def parse_jobs(jobs: List[tuple], queues: list, next_job):
+    """Parse process entry point: parses the next unclaimed job into its queue until no job is left.
+
+    A job holds the parse_chunks arguments, its chunks are put into the queue of the same index one by one
+    and None follows the last one. A parse error is put instead and ends the process. The jobs are claimed
+    in order from the shared `next_job` counter, so the job a reader waits for is always being parsed.
+    """
+    while True:
+        with next_job.get_lock():
+            index = next_job.value
+            next_job.value += 1
+        if index >= len(jobs):
+            return
+        try:
+            for chunk in parse_chunks(*jobs[index]):
+                # blocks while the queue is full, the parsed chunks of a file stay bounded
+                queues[index].put(chunk)
+        except Exception as e:
+            queues[index].put(e)
+            return
+        queues[index].put(None)
@@ -0,0 +1,246 @@
+import time
+from collections import Counter
+from itertools import islice
+from typing import Dict, Iterable, List, Set
+
+from django.db import connection
+from django.db.models import OuterRef, Subquery
+
+from crm.importer.parser import ImportRecord
+from crm.models import CatalogChange, Line, ReelManufacturer, ReelModel, SpoolModel, SpoolDimension, ReducerModel, ReducerDimension
+from crm.signals import catalog_bulk_changed
+
+DEFAULT_BATCH_SIZE = 500
+
+
+def chunks(iterable: Iterable, size: int):
+    it = iter(iterable)
+    chunk = list(islice(it, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(it, size))
+
+
+class QueryCounter:
+    """Counts the queries executed on a connection, works with DEBUG=False."""
+
+    def __init__(self, conn=connection):
+        self.connection = conn
+        self.count = 0
+        self._wrapper = None
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        self._wrapper = self.connection.execute_wrapper(self)
+        self._wrapper.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._wrapper.__exit__(exc_type, exc_val, exc_tb)
+
+
+class ImportStats:
+    def __init__(self):
+        self.rows = 0
+        self.skipped = 0
+        self.created = Counter()
+        self.fingerprints = Counter()
+        self.queries = 0
+        self.started = time.monotonic()
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    @property
+    def rows_per_sec(self):
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+    def summary(self):
+        created = ", ".join("{}={}".format(name, count) for name, count in sorted(self.created.items())) or "nothing"
+        summary = "Imported {} rows in {:.2f}s ({:.0f} rows/sec), {} queries; created: {}".format(
+            self.rows, self.elapsed, self.rows_per_sec, self.queries, created)
+        if self.skipped or self.fingerprints:
+            total = self.rows + self.skipped
+            summary += "\nSkipped {} of {} rows as unchanged ({:.0f}%); inserted={}, changed={}, deleted={}".format(
+                self.skipped, total, 100.0 * self.skipped / total if total else 0.0,
+                self.fingerprints["inserted"], self.fingerprints["changed"], self.fingerprints["deleted"])
+        return summary
+
+    def failure(self, rolled_back: bool):
+        if rolled_back:
+            return "Import failed after {:.2f}s, {} queries; rolled back, nothing was imported".format(
+                self.elapsed, self.queries)
+        return "Import failed after {} rows in {:.2f}s, {} queries; the rows before the error stay imported".format(
+            self.rows, self.elapsed, self.queries)
+
+
+class BulkImporter:
+    """Writes ImportRecords with batched bulk inserts.
+
+    The natural keys of the catalog (line_const, reel_model_const, spool_model_const, reducer_model_const
+    and the dimension values) are preloaded into in-memory maps once, so resolving a record costs no queries.
+    Records are written level by level: every level is one bulk insert of the missing keys followed by
+    one query that reads back the primary keys of the new rows.
+    """
+
+    def __init__(self, stats: ImportStats = None, batch_size: int = DEFAULT_BATCH_SIZE):
+        self.stats = stats or ImportStats()
+        self.batch_size = batch_size
+        self._loaded = False
+
+    def load(self):
+        self.lines = {(length, diameter): pk for pk, length, diameter in
+                      Line.objects.values_list('pk', 'length', 'diameter')}
+        self.manufacturers = {name: pk for pk, name in ReelManufacturer.objects.values_list('pk', 'name')}
+        self.reel_models = {(manufacturer, name): pk for pk, manufacturer, name in
+                            ReelModel.objects.values_list('pk', 'reel_manufacturer_id', 'name')}
+        self.spools = {(reel_model, name): pk for pk, reel_model, name in
+                       SpoolModel.objects.values_list('pk', 'reel_model_id', 'name')}
+        self.reducers = {(spool, line): pk for pk, spool, line in
+                         ReducerModel.objects.values_list('pk', 'spool_model_id', 'line_id')}
+        self.spool_dims = set(SpoolDimension.objects.values_list('spool_model_id', 'D1', 'D2', 'H1'))
+        self.reducer_dims = set(ReducerDimension.objects.values_list('reducer_model_id', 'D3', 'D4', 'H2',
+                                                                     'description'))
+        self.spool_actual = {spool: tuple(dim) for spool, *dim in SpoolDimension.objects.filter(
+            actual=True).values_list('spool_model_id', 'D1', 'D2', 'H1')}
+        self.reducer_actual = {reducer: tuple(dim) for reducer, *dim in ReducerDimension.objects.filter(
+            actual=True).values_list('reducer_model_id', 'D3', 'D4', 'H2', 'description')}
+        self._loaded = True
+
+    def exists(self, record: ImportRecord) -> bool:
+        """Whether the reducer of the record and its spool and reducer dimensions are in the catalog."""
+        if not self._loaded:
+            self.load()
+        reel_model = self.reel_models.get((self.manufacturers.get(record.manufacturer), record.reel_model))
+        spool = self.spools.get((reel_model, record.spool))
+        reducer = self.reducers.get((spool, self.lines.get(record.line)))
+        return reducer is not None and \
+            all((spool,) + dim in self.spool_dims for dim in record.spool_dims) and \
+            all((reducer,) + dim + (record.description,) in self.reducer_dims for dim in record.reducer_dims)
+
+    def write(self, records: Iterable[ImportRecord]):
+        if not self._loaded:
+            self.load()
+        records = list(records)
+        created_lines = self.stats.created['line']
+
+        changes = {kind: set() for kind in CatalogChange.Kind}
+        changes[CatalogChange.Kind.LINE] = self._insert(Line, self.lines, {
+            r.line: Line(length=r.line[0], diameter=r.line[1])
+            for r in records if r.line not in self.lines
+        }, ('length', 'diameter'), 'length')
+
+        changes[CatalogChange.Kind.MANUFACTURER] = self._insert(ReelManufacturer, self.manufacturers, {
+            r.manufacturer: ReelManufacturer(name=r.manufacturer)
+            for r in records if r.manufacturer not in self.manufacturers
+        }, ('name',), 'name')
+
+        reel_model_keys = [(self.manufacturers[r.manufacturer], r.reel_model) for r in records]
+        changes[CatalogChange.Kind.REEL_MODEL] = self._insert(ReelModel, self.reel_models, {
+            key: ReelModel(reel_manufacturer_id=key[0], name=key[1])
+            for key in reel_model_keys if key not in self.reel_models
+        }, ('reel_manufacturer_id', 'name'), 'reel_manufacturer_id')
+
+        spool_keys = [(self.reel_models[key], r.spool) for key, r in zip(reel_model_keys, records)]
+        # bulk_create sends no pre_save, the display names are set from the record names; the first row of
+        # a spool creates it, like get_or_create() does
+        spools = {}
+        for key, r in zip(spool_keys, records):
+            if key not in self.spools and key not in spools:
+                spools[key] = SpoolModel(
+                    reel_model_id=key[0], name=key[1], size=r.size, description=r.spool_description,
+                    display_name=SpoolModel.format_name(r.manufacturer, r.reel_model, r.spool))
+        changes[CatalogChange.Kind.SPOOL] = self._insert(SpoolModel, self.spools, spools, ('reel_model_id', 'name'),
+                                                         'reel_model_id')
+
+        spool_ids = [self.spools[key] for key in spool_keys]
+        changes[CatalogChange.Kind.SPOOL] |= self._insert_dims(SpoolDimension, self.spool_dims, [
+            (spool_id,) + dim for spool_id, r in zip(spool_ids, records) for dim in r.spool_dims
+        ], ('spool_model_id', 'D1', 'D2', 'H1'))
+
+        changes[CatalogChange.Kind.SPOOL] |= self._set_actual(SpoolDimension, self.spool_actual, {
+            spool_id: r.spool_dims[r.spool_actual]
+            for spool_id, r in zip(spool_ids, records) if r.spool_actual is not None
+        }, ('D1', 'D2', 'H1'))
+
+        reducer_keys = [(spool_id, self.lines[r.line]) for spool_id, r in zip(spool_ids, records)]
+        reducers = {}
+        for key, r in zip(reducer_keys, records):
+            if key not in self.reducers and key not in reducers:
+                reducers[key] = ReducerModel(
+                    spool_model_id=key[0], line_id=key[1], description=r.reducer_description,
+                    display_name=ReducerModel.format_name(SpoolModel.format_name(r.manufacturer, r.reel_model, r.spool),
+                                                          Line.format_name(*r.line)))
+        changes[CatalogChange.Kind.REDUCER] = self._insert(ReducerModel, self.reducers, reducers,
+                                                           ('spool_model_id', 'line_id'), 'spool_model_id')
+
+        changes[CatalogChange.Kind.REDUCER] |= self._insert_dims(ReducerDimension, self.reducer_dims, [
+            (self.reducers[key],) + dim + (r.description,)
+            for key, r in zip(reducer_keys, records) for dim in r.reducer_dims
+        ], ('reducer_model_id', 'D3', 'D4', 'H2', 'description'))
+        changes[CatalogChange.Kind.REDUCER] |= self._set_actual(ReducerDimension, self.reducer_actual, {
+            self.reducers[key]: r.reducer_dims[r.reducer_actual] + (r.description,)
+            for key, r in zip(reducer_keys, records) if r.reducer_actual is not None
+        }, ('D3', 'D4', 'H2', 'description'))
+
+        # bulk_create sends no post_save, the delta sync log is written here
+        for kind, ids in changes.items():
+            CatalogChange.record(kind, ids)
+
+        self.stats.rows += len(records)
+        if any(changes.values()):
+            # the API payloads and the search index are refreshed here as well
+            catalog_bulk_changed.send(sender=type(self),
+                                      manufacturer_ids={self.manufacturers[r.manufacturer] for r in records},
+                                      spool_ids=set(spool_ids), lines=self.stats.created['line'] > created_lines)
+
+    def _insert(self, model, index: Dict, pending: Dict, key_fields: tuple, filter_field: str) -> Set[int]:
+        """Inserts the `pending` objects and adds their primary keys to `index`, returns those keys."""
+        if not pending:
+            return set()
+        model.objects.bulk_create(pending.values(), batch_size=self.batch_size)
+        self.stats.created[model._meta.model_name] += len(pending)
+
+        # SQLite doesn't return the primary keys of bulk inserted rows, read them back by the parent key
+        filter_values = {getattr(obj, filter_field) for obj in pending.values()}
+        for values in chunks(filter_values, self.batch_size):
+            for pk, *key in model.objects.filter(**{filter_field + "__in": values}).values_list('pk', *key_fields):
+                key = tuple(key) if len(key) > 1 else key[0]
+                if key in pending:
+                    index[key] = pk
+        return {index[key] for key in pending}
+
+    def _insert_dims(self, model, index: set, keys: List[tuple], key_fields: tuple) -> Set[int]:
+        """Inserts the missing dimension `keys`, returns the ids of their owners."""
+        pending = [key for key in dict.fromkeys(keys) if key not in index]
+        if not pending:
+            return set()
+        model.objects.bulk_create((model(**dict(zip(key_fields, key))) for key in pending),
+                                  batch_size=self.batch_size)
+        index.update(pending)
+        self.stats.created[model._meta.model_name] += len(pending)
+        return {key[0] for key in pending}
+
+    def _set_actual(self, model, index: Dict[int, tuple], actual: Dict[int, tuple], key_fields: tuple) -> Set[int]:
+        """Marks the `actual` dimensions of their owners, like ActualDimensionMixin.save() does, returns the ids of
+        the owners whose actual dimension changed."""
+        pending = {owner: dim for owner, dim in actual.items() if index.get(owner) != dim}
+        if not pending:
+            return set()
+        owner_field = model._meta.get_field(model.owner_field)
+        for owners in chunks(list(pending), self.batch_size):
+            model.objects.filter(**{owner_field.name + "__in": owners, "actual": True}).update(actual=False)
+            pks = {}
+            for pk, owner, *dim in model.objects.filter(**{owner_field.name + "__in": owners}).order_by(
+                    'pk').values_list('pk', owner_field.attname, *key_fields):
+                if tuple(dim) == pending[owner]:
+                    pks.setdefault(owner, pk)
+            model.objects.filter(pk__in=pks.values()).update(actual=True)
+            owner_field.related_model.objects.filter(pk__in=owners).update(actual_dimension=Subquery(
+                model.objects.filter(**{owner_field.name: OuterRef('pk'), "actual": True}).values('pk')[:1]))
+        index.update(pending)
+        return set(pending)
@@ -0,0 +1,103 @@
+import statistics
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.db import OperationalError, connection, connections, transaction
+
+from crm.models import OrderBucket, OrderGroup, OrderItem, Price, ReducerModel
+
+# SQLite defaults, what every connection ran with before CRM_SQLITE_PRAGMAS
+ROLLBACK_JOURNAL_PRAGMAS = {"journal_mode": "DELETE", "synchronous": "FULL", "busy_timeout": 5000}
+
+
+class Command(BaseCommand):
+    help = "Measures the write throughput of concurrent order entry on the configured database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8, help="Threads entering orders, each on own connection")
+        parser.add_argument('--orders', type=int, default=50, help="Orders entered by every worker")
+        parser.add_argument('--items', type=int, default=3, help="Items of every order")
+        parser.add_argument('--sqlite-profile', choices=['tuned', 'rollback'], default='tuned',
+                            help="SQLite only: CRM_SQLITE_PRAGMAS or the rollback journal defaults for comparison")
+        parser.add_argument('--keep', action='store_true', help="Keep the benchmark orders and their price")
+
+    def handle(self, *args, **options):
+        reducer_ids = list(ReducerModel.objects.values_list('pk', flat=True)[:100])
+        if not reducer_ids:
+            raise CommandError("The benchmark needs reducer models, import a catalog first")
+        # the workers enter the orders on their own connections, the rows they reference are committed first and
+        # deleted afterwards instead of rolled back
+        price, price_created = Price.objects.get_or_create(currency=Price.Currency.UAH, price=100)
+        group = OrderGroup.objects.create(name="benchmark-{}".format(uuid.uuid4().hex[:12]))
+        pragmas = settings.CRM_SQLITE_PRAGMAS
+        try:
+            self._run(group, price, reducer_ids, options)
+        finally:
+            if connection.vendor == "sqlite" and settings.CRM_SQLITE_PRAGMAS is not pragmas:
+                settings.CRM_SQLITE_PRAGMAS = pragmas
+                connections.close_all()
+                with connection.cursor() as cursor:
+                    cursor.execute("PRAGMA journal_mode = {}".format(pragmas.get("journal_mode", "DELETE")))
+            if not options['keep']:
+                group.delete()
+                # an order entered meanwhile may use the price, deleting it would delete the items
+                if price_created and not OrderItem.objects.filter(price=price).exists():
+                    price.delete()
+
+    def _run(self, group, price, reducer_ids, options):
+        profile = connection.vendor
+        if profile == "sqlite":
+            profile = "sqlite/{}".format(options['sqlite_profile'])
+            if options['sqlite_profile'] == 'rollback':
+                settings.CRM_SQLITE_PRAGMAS = ROLLBACK_JOURNAL_PRAGMAS
+                with connection.cursor() as cursor:
+                    # the journal mode is stored in the database file, the others apply per connection
+                    cursor.execute("PRAGMA journal_mode = DELETE")
+            connections.close_all()
+
+        latencies, errors = [], []
+        started = time.monotonic()
+        workers = [threading.Thread(target=self._enter_orders,
+                                    args=(worker, group.pk, reducer_ids, price.pk, options, latencies, errors))
+                   for worker in range(options['workers'])]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.monotonic() - started
+
+        orders = len(latencies)
+        self.stdout.write("{}: {} orders ({} items) in {:.2f}s, {:.1f} orders/s, latency p50 {:.1f}ms "
+                          "p95 {:.1f}ms, {} failed".format(
+                              profile, orders, orders * options['items'], elapsed, orders / elapsed if elapsed else 0,
+                              _percentile(latencies, 50), _percentile(latencies, 95), len(errors)))
+        for error in sorted(set(errors)):
+            self.stderr.write("{}x {}".format(errors.count(error), error))
+
+    @staticmethod
+    def _enter_orders(worker, group_id, reducer_ids, price_id, options, latencies, errors):
+        try:
+            for i in range(options['orders']):
+                started = time.monotonic()
+                try:
+                    with transaction.atomic():
+                        order = OrderBucket.objects.create(order_group_id=group_id,
+                                                           name="benchmark-{}-{}-{}".format(group_id, worker, i))
+                        for n in range(options['items']):
+                            OrderItem.objects.create(order=order, price_id=price_id, amount=1 + n,
+                                                     reducer_model_id=reducer_ids[(i + n) % len(reducer_ids)])
+                except OperationalError as e:
+                    errors.append(str(e))
+                    continue
+                latencies.append((time.monotonic() - started) * 1000)
+        finally:
+            connection.close()
+
+
+def _percentile(values, percent):
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100)[percent - 1]
@@ -0,0 +1,51 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.apps import apps
+from django.core.management import BaseCommand
+
+from crm.models import SpoolModelImage, ReducerModelImage
+from crm.thumbnails import content_hash, make_thumbnails
+
+
+def _build(job):
+    model, name, digest, force = job
+    try:
+        return make_thumbnails(name, digest, apps.get_model(model)._meta.get_field("image").storage, force=force), None
+    except (OSError, ValueError) as e:
+        return 0, "{}: {}".format(name, e)
+
+
+class Command(BaseCommand):
+    help = "Backfills image hashes and renders the missing JPEG/WebP thumbnails of the spool/reducer images"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help="Processes rendering the thumbnails, 1 renders in this process")
+        parser.add_argument('--force', action='store_true', help="Render the thumbnails that exist already again")
+
+    def handle(self, *args, **options):
+        jobs = []
+        for model in (SpoolModelImage, ReducerModelImage):
+            for image in model.objects.exclude(image="").exclude(image__isnull=True):
+                if not image.image_hash:
+                    image.image_hash = content_hash(image.image)
+                    model.objects.filter(pk=image.pk).update(image_hash=image.image_hash)
+                jobs.append((model._meta.label, image.image.name, image.image_hash, options['force']))
+
+        workers = max(options['workers'], 1)
+        if workers == 1 or len(jobs) < 2:
+            rendered = self._collect(map(_build, jobs))
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=django.setup) as executor:
+                rendered = self._collect(executor.map(_build, jobs, chunksize=16))
+        self.stdout.write("Rendered {} thumbnails for {} images".format(rendered, len(jobs)))
+
+    def _collect(self, results) -> int:
+        rendered = 0
+        for count, error in results:
+            rendered += count
+            if error:
+                self.stderr.write(error)
+        return rendered
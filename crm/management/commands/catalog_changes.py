@@ -0,0 +1,45 @@
+import json
+
+from django.core.management import BaseCommand
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+
+from crm.api import DEFAULT_PAGE_SIZE, changes_page, compact_changes, seed_changes
+
+
+class Command(BaseCommand):
+    help = "Writes the catalog changes after a delta sync cursor as JSON lines, one page per line"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cursor', type=int, default=0, help="Cursor returned by the previous sync")
+        parser.add_argument('--limit', type=int, default=DEFAULT_PAGE_SIZE, help="Log entries per page")
+        parser.add_argument('--output', help="File to write the pages to instead of stdout")
+        parser.add_argument('--seed', action='store_true',
+                            help="Log every existing record first, for catalogs created before the change log")
+        parser.add_argument('--compact', action='store_true',
+                            help="Drop the log entries superseded by later ones, writes no pages")
+
+    def handle(self, *args, **options):
+        if options['seed']:
+            with transaction.atomic():
+                self.stderr.write("Logged {} records".format(seed_changes()))
+        if options['compact']:
+            with transaction.atomic():
+                self.stderr.write("Dropped {} superseded entries".format(compact_changes()))
+            return
+
+        out = open(options['output'], 'w') if options['output'] else self.stdout
+        cursor, changes = options['cursor'], 0
+        try:
+            while True:
+                page = changes_page(cursor, options['limit'])
+                if page['changes']:
+                    out.write(json.dumps(page, cls=DjangoJSONEncoder) + "\n")
+                changes += len(page['changes'])
+                cursor = page['cursor']
+                if not page['more']:
+                    break
+        finally:
+            if options['output']:
+                out.close()
+        self.stderr.write("{} changes, next cursor {}".format(changes, cursor))
@@ -0,0 +1,82 @@
+import os
+
+from django.core.management import BaseCommand
+
+from crm.models import SpoolModelImage, ReducerModelImage
+from crm.storage import image_storage, prunable, unreferenced
+from crm.thumbnails import THUMBNAIL_FORMATS, content_hash, thumbnail_name
+
+
+class Command(BaseCommand):
+    help = "Moves the spool/reducer images into the content addressed storage, identical files are stored once"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Only report what would be moved and deleted")
+        parser.add_argument('--prune', action='store_true',
+                            help="Delete the blobs (and their thumbnails) that no image row references")
+        parser.add_argument('--grace', type=int, default=3600,
+                            help="--prune keeps the blobs saved in the last N seconds, their rows may not be "
+                                 "committed yet (default: %(default)s)")
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        prefix = image_storage.prefix + "/"
+        moved = missing = freed = 0
+        blobs = set()
+        old_names = {}
+
+        for model in (SpoolModelImage, ReducerModelImage):
+            for pk, name, digest in model.objects.exclude(image="").exclude(image__isnull=True) \
+                    .exclude(image__startswith=prefix).values_list('pk', 'image', 'image_hash').iterator():
+                if not image_storage.exists(name):
+                    missing += 1
+                    self.stderr.write("{} {}: {} is missing".format(model.__name__, pk, name))
+                    continue
+                size = image_storage.size(name)
+                if dry_run:
+                    moved += 1
+                    freed += size
+                    continue
+                with image_storage.open(name, 'rb') as fh:
+                    blob = image_storage.blob_name(content_hash(fh), os.path.splitext(name)[1])
+                    if image_storage.exists(blob):
+                        freed += size
+                    else:
+                        image_storage.save(name, fh)
+                model.objects.filter(pk=pk).update(image=blob, image_hash=image_storage.digest(blob))
+                moved += 1
+                blobs.add(blob)
+                old_names[name] = digest
+
+        # the old files go only after every row points to its blob, a row may share the file with another one
+        for name in sorted(unreferenced(old_names)):
+            self._delete(name, old_names[name])
+
+        pruned = 0
+        if options['prune']:
+            pruned = self._prune(dry_run, options['grace'])
+
+        self.stdout.write("{} {} images into {} blobs ({} missing), {:.1f} MiB {}; {} unreferenced blobs {}".format(
+            "Would move" if dry_run else "Moved", moved, len(blobs), missing, freed / 2 ** 20,
+            "at most to free" if dry_run else "freed by deduplication", pruned,
+            "to delete" if dry_run else "deleted"))
+
+    def _prune(self, dry_run: bool, grace: int) -> int:
+        names = set()
+        if not image_storage.exists(image_storage.prefix):
+            return 0
+        for directory in image_storage.listdir(image_storage.prefix)[0]:
+            path = os.path.join(image_storage.prefix, directory)
+            names.update(os.path.join(path, name) for name in image_storage.listdir(path)[1])
+        orphans = prunable(names, grace)
+        if not dry_run:
+            for name in orphans:
+                self._delete(name, image_storage.digest(name))
+        return len(orphans)
+
+    @staticmethod
+    def _delete(name: str, digest: str):
+        thumbnails = [thumbnail_name(name, digest, ext) for ext in THUMBNAIL_FORMATS] if digest else []
+        for path in [name] + thumbnails:
+            if image_storage.exists(path):
+                image_storage.delete(path)
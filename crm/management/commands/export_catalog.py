@@ -0,0 +1,31 @@
+from django.core.management import BaseCommand, CommandError
+
+from crm.export import BATCH_SIZE, FORMATS, catalog_rows, write_rows
+
+
+class Command(BaseCommand):
+    help = "Exports the catalog in the CSV layout import_models reads, or the same rows as XLSX"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=FORMATS, default='csv')
+        parser.add_argument('--output', '-o', type=str, default=None, help="File to write, CSV goes to stdout without")
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help="Reducers read per query")
+
+    def handle(self, *args, **options):
+        rows = catalog_rows(batch_size=options['batch_size'], warn=self.stderr.write)
+        count = export(rows, options, "catalog", self.stdout)
+        if options['output']:
+            self.stdout.write("Exported {} rows to {}".format(count, options['output']))
+
+
+def export(rows, options, title: str, stdout) -> int:
+    if options['output'] is None and options['format'] != 'csv':
+        raise CommandError("{} export needs --output".format(options['format'].upper()))
+    try:
+        if options['output'] is None:
+            return write_rows(rows, options['format'], stdout, title)
+        with open(options['output'], 'w' if options['format'] == 'csv' else 'wb',
+                  **({"newline": "", "encoding": "utf-8"} if options['format'] == 'csv' else {})) as fh:
+            return write_rows(rows, options['format'], fh, title)
+    except ImportError as e:
+        raise CommandError(e)
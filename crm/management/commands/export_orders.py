@@ -0,0 +1,18 @@
+from django.core.management import BaseCommand
+
+from crm.export import BATCH_SIZE, FORMATS, order_rows
+from crm.management.commands.export_catalog import export
+
+
+class Command(BaseCommand):
+    help = "Exports the order items with their sums and the order totals as CSV or XLSX"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=FORMATS, default='csv')
+        parser.add_argument('--output', '-o', type=str, default=None, help="File to write, CSV goes to stdout without")
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help="Order items read per query")
+
+    def handle(self, *args, **options):
+        count = export(order_rows(batch_size=options['batch_size']), options, "orders", self.stdout)
+        if options['output']:
+            self.stdout.write("Exported {} rows to {}".format(count, options['output']))
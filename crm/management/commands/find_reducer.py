@@ -0,0 +1,58 @@
+import csv
+import time
+
+from django.core.management import BaseCommand, CommandError
+
+from crm.fit import FitIndex
+from crm.importer.parser import RecordParser, valid_float
+from crm.models import ReducerModel
+
+
+class Command(BaseCommand):
+    help = "Finds the reducers that fit spool dimensions D1/D2/H1 and a line, for one spool or a CSV of spools"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--d1', type=float)
+        parser.add_argument('--d2', type=float)
+        parser.add_argument('--h1', type=float)
+        parser.add_argument('--line', type=str, default=None, help='line as in import_models, e.g. 0.3-150')
+        parser.add_argument('--csv', type=str, default=None,
+                            help='CSV with d1, d2, h1 and optional line columns, writes the best fits as CSV')
+        parser.add_argument('--tolerance', type=float, default=1.0,
+                            help='max difference of every spool dimension in mm (default: %(default)s)')
+        parser.add_argument('--limit', type=int, default=1, help='fits per spool (default: %(default)s)')
+
+    def handle(self, *args, **options):
+        if options["csv"]:
+            with open(options["csv"]) as csvfile:
+                queries = list(csv.DictReader(csvfile))
+        elif None not in (options["d1"], options["d2"], options["h1"]):
+            queries = [{"d1": options["d1"], "d2": options["d2"], "h1": options["h1"], "line": options["line"]}]
+        else:
+            raise CommandError("Pass --d1, --d2 and --h1 or --csv")
+
+        try:
+            spools = [(valid_float(q["d1"]), valid_float(q["d2"]), valid_float(q["h1"])) for q in queries]
+            lines = [RecordParser.parse_line(q["line"]) if q.get("line") else None for q in queries]
+        except (KeyError, ValueError) as e:
+            raise CommandError("Bad spool dimensions: {}".format(e))
+
+        fit_index = FitIndex.open()
+        refreshed = fit_index.refresh()
+        started = time.monotonic()
+        results = fit_index.search_many(spools, lines, options["tolerance"], options["limit"])
+        elapsed = time.monotonic() - started
+
+        names = {r.pk: str(r) for r in ReducerModel.objects.select_related(
+            'spool_model__reel_model__reel_manufacturer', 'line').filter(
+            pk__in={fit.reducer_id for fits in results for fit in fits})}
+        writer = csv.writer(self.stdout)
+        writer.writerow(["d1", "d2", "h1", "line", "reducer_id", "reducer", "distance", "D3", "D4", "H2"])
+        for query, fits in zip(queries, results):
+            row = [query["d1"], query["d2"], query["h1"], query.get("line") or ""]
+            for fit in fits or [None]:
+                writer.writerow(row + ([fit.reducer_id, names[fit.reducer_id], round(fit.distance, 3)] +
+                                       list(fit.reducer) if fit else [""] * 6))
+        fit_index.save()
+        self.stderr.write("{} spools searched in {:.1f} ms, {} index rows read".format(len(queries), elapsed * 1000,
+                                                                                   refreshed))
@@ -0,0 +1,45 @@
+import logging
+import time
+
+from django.core.management import BaseCommand
+from django.db import close_old_connections
+
+from crm.revisions import flush_queue, revision_queue
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Writes the admin revisions queued in settings.CRM_REVISION_QUEUE_DIR to the reversion tables"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=None, help="Write at most this many revisions")
+        parser.add_argument('--interval', type=float, default=0,
+                            help="Keep running and look for new revisions every INTERVAL seconds")
+        parser.add_argument('--retry-failed', action='store_true',
+                            help="Put the revisions that failed before back into the queue first")
+
+    def handle(self, *args, **options):
+        if not revision_queue.enabled:
+            self.stderr.write("CRM_REVISION_QUEUE_DIR isn't set, the revisions are written in the request")
+            return
+        if options['retry_failed']:
+            for name in revision_queue.failed():
+                revision_queue.retry(name)
+        while True:
+            try:
+                written, failed = flush_queue(limit=options['limit'])
+            except Exception:
+                if not options['interval']:
+                    raise
+                # a worker outlives a broken connection or an unreadable queue directory, the next pass retries
+                logger.exception("Flushing the revision queue failed")
+                close_old_connections()
+                written, failed = 0, []
+            for name in failed:
+                self.stderr.write("{}: can't be written, renamed to {}.failed".format(name, name))
+            if written or failed or not options['interval']:
+                self.stdout.write("Wrote {} revisions".format(written))
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
@@ -1,11 +1,23 @@
-import csv
-import re
-from typing import Dict, List, Union
-from collections import OrderedDict
+import hashlib
+import json
+import multiprocessing
+import os
+import queue
+from contextlib import nullcontext
+from typing import Iterator, List, Tuple
 
-from django.core.management import BaseCommand
+from django.core.management import BaseCommand, CommandError
+from django.db import connection, transaction
 
-from crm.models import Line, ReelManufacturer, ReelModel, SpoolModel, SpoolDimension, ReducerModel, ReducerDimension
+from crm.db import update_statistics
+from crm.importer import BulkImporter, CatalogDiff, FingerprintFilter, ImportRecord, ImportRecordError, ImportStats, ParsedChunk, QueryCounter, \
+    parse_chunks, parse_jobs, read_records
+from crm.importer.writer import DEFAULT_BATCH_SIZE
+from crm.models import Line, ReelManufacturer, ReelModel, SpoolModel, SpoolDimension, ReducerModel, ReducerDimension, \
+    ImportCheckpoint
+
+# parsed chunks a --workers process keeps in the queue of a file before it waits for the writer
+QUEUED_CHUNKS = 2
 
 
 class Command(BaseCommand):
@@ -13,49 +25,244 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         # Positional arguments
-        # parser.add_argument(self.ARG_NAME, nargs='+', type=str)
-        parser.add_argument(self.ARG_NAME, type=str)
+        parser.add_argument(self.ARG_NAME, nargs='+', type=str,
+                            help='CSV files or directories with CSV files, imported in the given order')
 
         # Named (optional) arguments
-        # parser.add_argument(
-        #     '--delete',
-        #     action='store_true',
-        #     help='Delete poll instead of closing it',
-        # )
+        parser.add_argument(
+            '--bulk',
+            action='store_true',
+            help='Resolve the catalog keys in memory and write new rows with bulk inserts in one transaction',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=DEFAULT_BATCH_SIZE,
+            help='Rows per bulk insert (default: %(default)s)',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=None,
+            help='Stream the file with bulk inserts, commit and checkpoint every N rows. '
+                 'A rerun resumes from the last checkpoint',
+        )
+        parser.add_argument(
+            '--restart',
+            action='store_true',
+            help='Drop the checkpoint of a previous --chunk-size run and import from the beginning',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Parse the files in a pool of N processes, a single writer merges them in file order. '
+                 'Implies --bulk',
+        )
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            help='Skip the rows whose content hash is unchanged since the previous import of the same file. '
+                 'Implies --bulk',
+        )
+        parser.add_argument(
+            '--dry-run', '--diff',
+            action='store_true',
+            dest='dry_run',
+            help="Don't write anything, print a JSON report of the rows the import would add or change",
+        )
+        parser.add_argument(
+            '--report',
+            type=str,
+            default=None,
+            help='Write the --dry-run report to this file instead of stdout',
+        )
 
     def handle(self, *args, **options):
-        file_path = options.get(self.ARG_NAME)
-
-        if file_path:
-            with open(file_path) as csvfile:
-                reader = csv.DictReader(csvfile)
-
-                current_model = None
-                current_line = None
-                for record in reader:
-                    if self._record_empty(record):
-                        continue
-
-                    if not record.get('line') and not record.get("model"):
-                        record['line'] = current_line
-                    else:
-                        current_line = record.get("line")
-
-                    if not record.get('model'):
-                        record['model'] = current_model
-                    else:
-                        current_model = record['model']
-
-                    self._handle_record(record)
-
-    def _record_empty(self, record: dict):
-        return not list(filter(None, record.values()))
-
-    def _handle_record(self, record: OrderedDict):
-        line = record.get("line")
-        line_obj = self._get_line(line)
-
-        model_obj = self._get_model(record.get("model"))
+        file_paths = self._collect_files(options.get(self.ARG_NAME))
+
+        if options["dry_run"]:
+            return self._diff(file_paths, options)
+
+        self.stats = ImportStats()
+        bulk = options["chunk_size"] or options["bulk"] or options["incremental"] or options["workers"] > 1
+        queries = QueryCounter()
+        try:
+            with queries:
+                if bulk:
+                    self._import_bulk(file_paths, options)
+                else:
+                    for file_path in file_paths:
+                        for record in read_records(file_path):
+                            self._handle_record(record)
+                            self.stats.rows += 1
+            update_statistics(connection)
+        except BaseException as e:
+            self.stats.queries = queries.count
+            # a bulk import without --chunk-size is one transaction, the others commit as they go
+            self.stderr.write(self.stats.failure(rolled_back=bulk and not options["chunk_size"]))
+            if isinstance(e, ImportRecordError):
+                raise CommandError(e)
+            raise
+        self.stats.queries = queries.count
+        self.stdout.write(self.stats.summary())
+
+    def _collect_files(self, paths: List[str]) -> List[str]:
+        file_paths = []
+        for path in paths:
+            if os.path.isdir(path):
+                file_paths.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                         if name.lower().endswith(".csv")))
+            elif os.path.isfile(path):
+                file_paths.append(path)
+            else:
+                raise CommandError("No such file or directory: {}".format(path))
+        return file_paths
+
+    def _diff(self, file_paths: List[str], options: dict):
+        diff = CatalogDiff(options["batch_size"])
+        try:
+            for parsed_chunks in self._parse([(file_path, 0, None, 0, options["batch_size"]) for file_path in file_paths],
+                                             options["workers"]):
+                for chunk in parsed_chunks:
+                    diff.add(chunk.records)
+        except ImportRecordError as e:
+            raise CommandError(e)
+        report = json.dumps(diff.report(), indent=2, ensure_ascii=False)
+        if options["report"]:
+            with open(options["report"], "w") as fh:
+                fh.write(report)
+        else:
+            self.stdout.write(report)
+
+    def _import_bulk(self, file_paths: List[str], options: dict):
+        chunk_size = options["chunk_size"]
+        checkpoints = [self._get_checkpoint(file_path, options["restart"]) if chunk_size else None
+                       for file_path in file_paths]
+        # without --chunk-size the files are parsed in chunks of a batch as well, but written in one transaction
+        parse_size = chunk_size or options["batch_size"]
+        jobs = [(file_path, checkpoint.offset, checkpoint.state, checkpoint.rows, parse_size) if checkpoint else
+                (file_path, 0, None, 0, parse_size)
+                for file_path, checkpoint in zip(file_paths, checkpoints)]
+
+        importer = BulkImporter(self.stats, options["batch_size"])
+        # without --chunk-size everything goes into one transaction, otherwise every chunk commits separately
+        with nullcontext() if chunk_size else transaction.atomic():
+            for job, checkpoint, parsed_chunks in zip(jobs, checkpoints, self._parse(jobs, options["workers"])):
+                fingerprints = FingerprintFilter(os.path.abspath(job[0]), self.stats, options["batch_size"],
+                                                 checkpoint.occurrences if checkpoint else None) \
+                    if options["incremental"] else None
+                prefix = self._prefix_hash(job[0], job[1]) if checkpoint else None
+                for chunk in parsed_chunks:
+                    with transaction.atomic():
+                        importer.write(fingerprints.filter(chunk.records, importer.exists) if fingerprints else
+                                       chunk.records)
+                        if fingerprints:
+                            fingerprints.save()
+                        if checkpoint:
+                            self._update_prefix_hash(prefix, job[0], checkpoint.offset, chunk.offset)
+                            checkpoint.offset, checkpoint.state, checkpoint.rows = chunk.offset, chunk.state, chunk.row
+                            checkpoint.size, checkpoint.mtime = self._file_version(job[0])
+                            checkpoint.prefix_hash = prefix.hexdigest()
+                            if fingerprints:
+                                checkpoint.occurrences = fingerprints.occurrences
+                            checkpoint.save()
+                with transaction.atomic():
+                    # a resumed run hasn't seen the rows before the checkpoint, so it can't tell which disappeared
+                    if fingerprints and not job[1]:
+                        fingerprints.finish()
+                    if checkpoint and checkpoint.pk:
+                        checkpoint.delete()
+
+    def _parse(self, jobs: List[Tuple], workers: int) -> Iterator[Iterator[ParsedChunk]]:
+        """The chunks of every job, in job order.
+
+        The fill-forward state of a file runs through all its chunks, so a file is parsed by one process.
+        With several workers every file streams its chunks through a queue of QUEUED_CHUNKS, the chunks
+        in flight are at most workers * (QUEUED_CHUNKS + 1) however large the files are.
+        """
+        if workers <= 1 or len(jobs) <= 1:
+            for job in jobs:
+                yield parse_chunks(*job)
+            return
+        context = multiprocessing.get_context()
+        queues = [context.Queue(QUEUED_CHUNKS) for _ in jobs]
+        next_job = context.Value('i', 0)
+        processes = [context.Process(target=parse_jobs, args=(jobs, queues, next_job), daemon=True)
+                     for _ in range(min(workers, len(jobs)))]
+        for process in processes:
+            process.start()
+        try:
+            for chunk_queue in queues:
+                yield self._queued_chunks(chunk_queue, processes)
+        finally:
+            for process in processes:
+                process.terminate()
+                process.join()
+
+    @staticmethod
+    def _queued_chunks(chunk_queue, processes) -> Iterator[ParsedChunk]:
+        while True:
+            try:
+                chunk = chunk_queue.get(timeout=1)
+            except queue.Empty:
+                # the processes put everything they parsed before they exit
+                if not any(process.is_alive() for process in processes) and chunk_queue.empty():
+                    raise CommandError("The parse processes exited before the import finished")
+                continue
+            if chunk is None:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    def _get_checkpoint(self, file_path: str, restart: bool) -> ImportCheckpoint:
+        source = os.path.abspath(file_path)
+        if restart:
+            ImportCheckpoint.objects.filter(source=source).delete()
+        checkpoint = ImportCheckpoint.objects.filter(source=source).first() or ImportCheckpoint(source=source)
+        if checkpoint.offset and not self._checkpoint_matches(checkpoint):
+            self.stdout.write("{} changed since the checkpoint, importing it from the beginning".format(source))
+            checkpoint.delete()
+            checkpoint = ImportCheckpoint(source=source)
+        if checkpoint.offset:
+            self.stdout.write("Resuming {} after row {}".format(source, checkpoint.rows))
+        return checkpoint
+
+    @staticmethod
+    def _file_version(file_path: str) -> Tuple[int, float]:
+        stat = os.stat(file_path)
+        return stat.st_size, stat.st_mtime
+
+    def _checkpoint_matches(self, checkpoint: ImportCheckpoint) -> bool:
+        """An unchanged file, or a file with rows appended behind the checkpoint, can be resumed."""
+        size, mtime = self._file_version(checkpoint.source)
+        if size < checkpoint.offset or not checkpoint.prefix_hash:
+            return False
+        if (size, mtime) == (checkpoint.size, checkpoint.mtime):
+            return True
+        return self._prefix_hash(checkpoint.source, checkpoint.offset).hexdigest() == checkpoint.prefix_hash
+
+    def _prefix_hash(self, file_path: str, offset: int):
+        prefix = hashlib.sha1()
+        self._update_prefix_hash(prefix, file_path, 0, offset)
+        return prefix
+
+    @staticmethod
+    def _update_prefix_hash(prefix, file_path: str, start: int, end: int):
+        with open(file_path, "rb") as fh:
+            fh.seek(start)
+            while start < end:
+                block = fh.read(min(end - start, 1 << 20))
+                if not block:
+                    break
+                prefix.update(block)
+                start += len(block)
+
+    def _handle_record(self, record: ImportRecord):
+        line_obj = self._get_line(record)
+
+        model_obj = self._get_model(record)
 
         assert model_obj
 
@@ -65,109 +272,74 @@ class Command(BaseCommand):
 
         self._create_spool_dim(spool_obj, record)
 
-        reducer_obj = self._get_reducer_model(spool_obj, line_obj)
+        reducer_obj = self._get_reducer_model(spool_obj, line_obj, record)
 
         assert reducer_obj
 
         self._create_reducer_dim(reducer_obj, record)
 
-    def _create_reducer_dim(self, reducer_model: ReducerModel, record: Dict[str, str]):
-        for d3, d4, h2 in self._unpack_dim(record.get("d3"), record.get("d4"), record.get("h2")):
-            dim_obj, created = ReducerDimension.objects.get_or_create(
+    def _get_or_create(self, model, **kwargs):
+        obj, created = model.objects.get_or_create(**kwargs)
+        self.stats.created[model._meta.model_name] += created
+        return obj
+
+    @staticmethod
+    def _set_actual(dim):
+        # ActualDimensionMixin.save() unmarks the other dimensions of the owner
+        if not dim.actual:
+            dim.actual = True
+            dim.save()
+
+    def _create_reducer_dim(self, reducer_model: ReducerModel, record: ImportRecord):
+        for i, (d3, d4, h2) in enumerate(record.reducer_dims):
+            dim = self._get_or_create(
+                ReducerDimension,
                 reducer_model=reducer_model,
-                D3=self._valid_float(d3),
-                D4=self._valid_float(d4),
-                H2=self._valid_float(h2),
-                description=record.get("description"))
-
-    def _get_reducer_model(self, spool_model: SpoolModel, line: Line):
-        reducer_obj, created = ReducerModel.objects.get_or_create(
+                D3=d3,
+                D4=d4,
+                H2=h2,
+                description=record.description)
+            if i == record.reducer_actual:
+                self._set_actual(dim)
+
+    def _get_reducer_model(self, spool_model: SpoolModel, line: Line, record: ImportRecord):
+        return self._get_or_create(
+            ReducerModel,
             spool_model=spool_model,
-            line=line)
-        return reducer_obj
-
-    def _create_spool_dim(self, spool_model: SpoolModel, record: Dict[str, str]):
+            line=line,
+            defaults={"description": record.reducer_description})
 
-        for d1, d2, h1 in self._unpack_dim(record.get("d1"), record.get("d2"), record.get("h1")):
-            dim_obj, created = SpoolDimension.objects.get_or_create(
+    def _create_spool_dim(self, spool_model: SpoolModel, record: ImportRecord):
+        for i, (d1, d2, h1) in enumerate(record.spool_dims):
+            dim = self._get_or_create(
+                SpoolDimension,
                 spool_model=spool_model,
-                D1=self._valid_float(d1),
-                D2=self._valid_float(d2),
-                H1=self._valid_float(h1))
-
-    def _unpack_dim(self, d1, d2, h, last_val: list = [None, None, None]):
-        cur_d1, cur_d2, cur_h = last_val
-        for dim in self._zip_lists(d1.split("/"), d2.split("/"), h.split("/")):
-            if not next(filter(None, dim), None):
-                continue
-            d1, d2, h = dim
-            if not d1:
-                if cur_d1:
-                    d1 = cur_d1
-                else:
-                    continue
-
-            if not d2:
-                if cur_d2:
-                    d2 = cur_d2
-                else:
-                    continue
-
-            if not h:
-                if cur_h:
-                    h = cur_h
-                else:
-                    continue
-            yield d1, d2, h
-            last_val[0] = d1
-            last_val[1] = d2
-            last_val[2] = h
-
-    def _zip_lists(self, *args):
-        max_len = len(max(*args, key=len))
-        eq_it = map(lambda v: v + [v[-1]] * (max_len - len(v)), args)
-        return zip(*eq_it)
-
-    def _valid_float(self, value: Union[str, float]) -> float:
-        if isinstance(value, float):
-            return value
-        return float(value.strip().replace(",", ".").replace(" ", ''))
-
-    def _get_spool(self, model_obj: ReelModel, record: dict):
-        spool_name = " ".join(record.get("model").strip().split("_")[2:])
-        size = re.search(r"([\d]{4,})", spool_name)
-        if size:
-            size = size.group(1)
-
-        spool_obj, created = SpoolModel.objects.get_or_create(
-            name=spool_name.strip().capitalize(),
+                D1=d1,
+                D2=d2,
+                H1=h1)
+            if i == record.spool_actual:
+                self._set_actual(dim)
+
+    def _get_spool(self, model_obj: ReelModel, record: ImportRecord):
+        return self._get_or_create(
+            SpoolModel,
+            name=record.spool,
             reel_model=model_obj,
-            size=size)
-        return spool_obj
-
-    def _get_model(self, model: str):
-        model_list = model.strip().split("_")
-        if len(model_list) < 2:
-            return
-        manufacturer, model = model_list[0:2]
-        man_obj, created = ReelManufacturer.objects.get_or_create(
-            name=str(manufacturer).strip().capitalize())
-        model_obj, created = ReelModel.objects.get_or_create(
-            name=str(model).strip().capitalize(),
+            size=record.size,
+            defaults={"description": record.spool_description})
+
+    def _get_model(self, record: ImportRecord):
+        man_obj = self._get_or_create(
+            ReelManufacturer,
+            name=record.manufacturer)
+        return self._get_or_create(
+            ReelModel,
+            name=record.reel_model,
             reel_manufacturer=man_obj)
-        return model_obj
-
-    def _get_line(self, line: str = "") -> Line:
-        # diameter, length = line.strip().split('-')
-        if not line:
-            line = "0-0"
-        line_list = line.strip().split('-')
-        if len(line_list) < 2:
-            line_list.append("0")
-        diameter, length = line_list
-        if "," in length or "." in length:
-            length, diameter = diameter, length
-        p, created = Line.objects.get_or_create(
-            length=int(length),
-            diameter=float(diameter.replace(",", ".")))
-        return p
+
+    def _get_line(self, record: ImportRecord) -> Line:
+        length, diameter = record.line
+        return self._get_or_create(
+            Line,
+            length=length,
+            diameter=diameter)
@@ -0,0 +1,48 @@
+import csv
+import math
+
+from django.core.management import BaseCommand
+
+from crm.capacity import CapacityMatrix
+from crm.importer.parser import RecordParser
+from crm.models import SpoolModel, ReducerModel
+
+
+class Command(BaseCommand):
+    help = ("Writes the fill volume in cm³ and the line capacity in meters of every spool (or reducer) for every line "
+            "as CSV")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reducers', action='store_true',
+                            help='rows are the reducers installed on their spools instead of the bare spools')
+        parser.add_argument('--line', type=str, action='append', default=[],
+                            help='only this line, as in import_models, e.g. 0.3-150. Can be repeated')
+
+    def handle(self, *args, **options):
+        capacity_matrix = CapacityMatrix.open()
+        capacity_matrix.refresh()
+        capacity_matrix.save()
+        columns = list(range(len(capacity_matrix.line_ids)))
+        if options["line"]:
+            wanted = {RecordParser.parse_line(line) for line in options["line"]}
+            columns = [i for i in columns
+                       if (int(capacity_matrix.line_lengths[i]), capacity_matrix.line_diameters[i]) in wanted]
+
+        if options["reducers"]:
+            model, rows, volumes, matrix = (ReducerModel, capacity_matrix.reducer_rows, capacity_matrix.reducer_volumes,
+                                            capacity_matrix.reducers)
+            related = ('spool_model__reel_model__reel_manufacturer', 'line')
+        else:
+            model, rows, volumes, matrix = (SpoolModel, capacity_matrix.spool_rows, capacity_matrix.spool_volumes,
+                                            capacity_matrix.spools)
+            related = ('reel_model__reel_manufacturer',)
+        names = {obj.pk: str(obj) for obj in model.objects.select_related(*related)}
+
+        writer = csv.writer(self.stdout)
+        writer.writerow(["id", "name", "volume_cm3"] + ["{:g}-{:g}".format(capacity_matrix.line_diameters[i],
+                                                                           capacity_matrix.line_lengths[i])
+                                                        for i in columns])
+        for row, volume, capacities in zip(rows, volumes, matrix):
+            pk = int(row[0])
+            writer.writerow([pk, names.get(pk, ""), round(float(volume), 1)] +
+                            ["" if math.isnan(capacities[i]) else round(capacities[i]) for i in columns])
@@ -0,0 +1,45 @@
+import reversion
+from django.core.management import BaseCommand, CommandError
+
+from crm.revisions import BATCH_SIZE, compact_versions, delete_in_batches, empty_revisions, prunable_copies, \
+    prunable_versions, registered_model
+
+
+class Command(BaseCommand):
+    help = "Deletes or compacts the old versions of the models registered with reversion, in short transactions"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', action='append', default=[],
+                            help="app_label.Model to prune, every registered model when not given; repeatable")
+        parser.add_argument('--days', type=int, default=90, help="Keep the versions of the last DAYS days")
+        parser.add_argument('--keep', type=int, default=1,
+                            help="Keep the KEEP latest versions of every object, however old they are")
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help="Rows deleted per transaction")
+        parser.add_argument('--pause', type=float, default=0.05, help="Seconds to wait between the transactions")
+        parser.add_argument('--compact', action='store_true',
+                            help="First replace the old versions equal to the previous version of their object "
+                                 "with copies of it")
+        parser.add_argument('--dry-run', action='store_true', help="Only count what would be deleted")
+
+    def handle(self, *args, **options):
+        try:
+            models = [registered_model(label) for label in options['model']] or reversion.get_registered_models()
+        except LookupError as e:
+            raise CommandError(e)
+        batch_size, pause = options['batch_size'], options['pause']
+        done = "would be deleted" if options['dry_run'] else "deleted"
+        for model in models:
+            if options['compact'] and not options['dry_run']:
+                count = compact_versions(model, options['days'], batch_size, pause)
+                self.stdout.write("{}: {} versions compacted".format(model._meta.label, count))
+            # the copies go first, the versions they copy can't be deleted before
+            copies = prunable_copies(model, options['days'], options['keep'])
+            count = copies.count() if options['dry_run'] else delete_in_batches(copies, batch_size, pause)
+            self.stdout.write("{}: {} copies {}".format(model._meta.label, count, done))
+            versions = prunable_versions(model, options['days'], options['keep'])
+            count = versions.count() if options['dry_run'] else delete_in_batches(versions, batch_size, pause)
+            self.stdout.write("{}: {} versions {}".format(model._meta.label, count, done))
+        # the revisions left without versions, the versions of the other models keep theirs
+        revisions = empty_revisions(options['days'])
+        count = revisions.count() if options['dry_run'] else delete_in_batches(revisions, batch_size, pause)
+        self.stdout.write("{} empty revisions {}".format(count, done))
@@ -0,0 +1,14 @@
+import time
+
+from django.core.management import BaseCommand
+
+from crm.search import search_index
+
+
+class Command(BaseCommand):
+    help = "Recreates the catalog full-text search index from the spool and reducer models"
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        count = search_index.rebuild()
+        self.stdout.write("Indexed {} documents in {:.2f}s".format(count, time.monotonic() - started))
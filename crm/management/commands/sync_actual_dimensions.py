@@ -0,0 +1,21 @@
+from django.core.management import BaseCommand
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
+
+from crm.models import ReelManufacturer, SpoolModel, SpoolDimension, ReducerModel, ReducerDimension
+from crm.signals import catalog_bulk_changed
+
+
+class Command(BaseCommand):
+    help = "Points SpoolModel/ReducerModel.actual_dimension to the dimension marked as actual"
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            spools = SpoolModel.objects.update(actual_dimension=Subquery(
+                SpoolDimension.objects.filter(spool_model=OuterRef('pk'), actual=True).values('pk')[:1]))
+            reducers = ReducerModel.objects.update(actual_dimension=Subquery(
+                ReducerDimension.objects.filter(reducer_model=OuterRef('pk'), actual=True).values('pk')[:1]))
+        catalog_bulk_changed.send(sender=type(self),
+                                  manufacturer_ids=ReelManufacturer.objects.values_list('pk', flat=True),
+                                  spool_ids=SpoolModel.objects.values_list('pk', flat=True))
+        self.stdout.write("Updated {} spool models and {} reducer models".format(spools, reducers))
@@ -0,0 +1,13 @@
+from django.core.management import BaseCommand
+from django.db import transaction
+
+from crm.names import update_display_names
+
+
+class Command(BaseCommand):
+    help = "Recalculates the cached display names of the spool models, reducer models and order items"
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            updated = update_display_names()
+        self.stdout.write("Updated {} display names".format(updated))
@@ -0,0 +1,13 @@
+from django.core.management import BaseCommand
+from django.db import transaction
+
+from crm.totals import update_bucket_totals
+
+
+class Command(BaseCommand):
+    help = "Recalculates the cached OrderBucket and OrderGroup totals"
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            update_bucket_totals()
+        self.stdout.write("Totals updated")
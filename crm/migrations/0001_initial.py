@@ -0,0 +1,355 @@
+# Generated by Django 3.1.14 on 2026-10-17 09:03
+
+import crm.models
+import crm.storage
+import crm.thumbnails
+import datetime
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('reversion', '0002_add_index_on_version_for_content_type_and_db'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('manufacturer', 'Manufacturer'), ('reel_model', 'Reel Model'), ('spool', 'Spool'), ('reducer', 'Reducer'), ('line', 'Line')], max_length=20)),
+                ('object_id', models.IntegerField()),
+                ('deleted', models.BooleanField(default=False)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ExchangeRate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('currency', models.CharField(choices=[('UAH', 'Uah'), ('USD', 'Usd'), ('ERU', 'Eur')], max_length=3)),
+                ('date', models.DateField(default=datetime.date.today)),
+                ('rate', models.FloatField(help_text='units of the reporting currency for one unit of the currency')),
+            ],
+            options={
+                'ordering': ['currency', '-date'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ImportCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(help_text='absolute path of the imported file', max_length=500, unique=True)),
+                ('offset', models.BigIntegerField(default=0, help_text='byte offset behind the last committed row')),
+                ('rows', models.IntegerField(default=0, help_text='CSV rows committed so far')),
+                ('state', models.JSONField(default=dict, help_text='fill-forward model/line/dimension state')),
+                ('size', models.BigIntegerField(default=0, help_text='file size when the checkpoint was written')),
+                ('mtime', models.FloatField(default=0, help_text='file modification time when the checkpoint was written')),
+                ('prefix_hash', models.CharField(blank=True, default='', help_text='sha1 of the file bytes before `offset`', max_length=40)),
+                ('occurrences', models.JSONField(default=dict, help_text='--incremental: rows per model/line before `offset`')),
+                ('modified', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ImportFingerprint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(help_text='absolute path of the imported file', max_length=500)),
+                ('row_key', models.CharField(help_text='hash of the model/line of the row and its occurrence', max_length=40)),
+                ('digest', models.CharField(help_text='hash of the normalized row', max_length=40)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Line',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(blank=True, max_length=200, null=True)),
+                ('length', models.IntegerField(help_text='line length in Meters')),
+                ('diameter', models.FloatField(help_text='line diameter in Millimeters')),
+            ],
+            options={
+                'ordering': ['length', 'diameter'],
+            },
+        ),
+        migrations.CreateModel(
+            name='OrderBucket',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(default=crm.models.order_name, max_length=200, unique=True)),
+                ('payed', models.BooleanField(default=False)),
+                ('sent', models.BooleanField(default=False)),
+                ('description', models.TextField(blank=True, null=True)),
+                ('created', models.DateTimeField(auto_now=True)),
+                ('placed', models.DateField(default=datetime.date.today, help_text='the items are converted at the exchange rates of this day')),
+                ('total', models.IntegerField(default=0, editable=False, help_text='cached sum of the order items')),
+            ],
+            options={
+                'ordering': ['created', 'name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='OrderGroup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(default=crm.models.group_name, max_length=200, unique=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('description', models.TextField(blank=True, null=True)),
+                ('payed_sum', models.IntegerField(default=0)),
+                ('total', models.IntegerField(default=0, editable=False, help_text='cached sum of the group orders')),
+            ],
+            options={
+                'ordering': ['created', 'name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='OrderItem',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.IntegerField(default=2)),
+                ('printed', models.BooleanField(default=False)),
+                ('description', models.TextField(blank=True, null=True)),
+                ('display_name', models.CharField(blank=True, default='', editable=False, help_text='cached reducer, amount and price', max_length=1000)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Price',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('currency', models.CharField(choices=[('UAH', 'Uah'), ('USD', 'Usd'), ('ERU', 'Eur')], default='UAH', max_length=3)),
+                ('price', models.IntegerField(default=100)),
+            ],
+            options={
+                'ordering': ['currency', 'price'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ReducerDimension',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('actual', models.BooleanField(default=False)),
+                ('D3', models.FloatField(default=1.0, help_text='Spool D3')),
+                ('D4', models.FloatField(default=1.0, help_text='Spool D4')),
+                ('H2', models.FloatField(default=1.0, help_text='Spool H2')),
+                ('shift', models.FloatField(default=0, help_text='Shift')),
+                ('description', models.CharField(blank=True, default='', max_length=200, null=True)),
+            ],
+            bases=(crm.models.ActualDimensionMixin, models.Model),
+        ),
+        migrations.CreateModel(
+            name='ReducerModel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('description', models.TextField(blank=True, null=True)),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('display_name', models.CharField(blank=True, db_index=True, default='', editable=False, help_text='cached spool and line name', max_length=1000)),
+                ('actual_dimension', models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='crm.reducerdimension')),
+                ('line', models.ForeignKey(default=1, on_delete=django.db.models.deletion.CASCADE, to='crm.line')),
+            ],
+            options={
+                'ordering': ['spool_model', 'modified'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ReelManufacturer',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200, unique=True)),
+            ],
+            options={
+                'ordering': ['name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ReelModel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200)),
+                ('reel_manufacturer', models.ForeignKey(default=1, on_delete=django.db.models.deletion.CASCADE, to='crm.reelmanufacturer')),
+            ],
+            options={
+                'ordering': ['reel_manufacturer', 'name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='SpoolDimension',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('actual', models.BooleanField(default=False)),
+                ('D1', models.FloatField(default=1.0, help_text='Spool D1')),
+                ('D2', models.FloatField(default=1.0, help_text='Spool D2')),
+                ('H1', models.FloatField(default=1.0, help_text='Spool H1')),
+                ('description', models.CharField(blank=True, default='', max_length=200, null=True)),
+            ],
+            bases=(crm.models.ActualDimensionMixin, models.Model),
+        ),
+        migrations.CreateModel(
+            name='SpoolModel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(blank=True, default='', max_length=200, null=True)),
+                ('size', models.IntegerField(blank=True, default=None, null=True)),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('description', models.TextField(blank=True, null=True)),
+                ('display_name', models.CharField(blank=True, db_index=True, default='', editable=False, help_text='cached manufacturer, reel model and spool name', max_length=1000)),
+                ('actual_dimension', models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='crm.spooldimension')),
+                ('reel_model', models.ForeignKey(default=1, on_delete=django.db.models.deletion.CASCADE, to='crm.reelmodel')),
+            ],
+            options={
+                'ordering': ['reel_model', 'name', 'modified'],
+            },
+        ),
+        migrations.CreateModel(
+            name='CompactRevision',
+            fields=[
+            ],
+            options={
+                'proxy': True,
+                'indexes': [],
+                'constraints': [],
+            },
+            bases=('reversion.revision',),
+        ),
+        migrations.CreateModel(
+            name='VersionCopy',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('revision', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='copies', to='reversion.revision')),
+                ('version', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='copies', to='reversion.version')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SpoolModelImage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('img_height', models.PositiveIntegerField(default=100)),
+                ('img_width', models.PositiveIntegerField(default=100)),
+                ('image', models.ImageField(blank=True, height_field='img_height', null=True, storage=crm.storage.ContentAddressedStorage(), upload_to='spool_images', width_field='img_width')),
+                ('image_hash', models.CharField(blank=True, default='', editable=False, help_text='sha256 of the image, names its thumbnails', max_length=64)),
+                ('spool_model', models.ForeignKey(default=1, on_delete=django.db.models.deletion.CASCADE, to='crm.spoolmodel')),
+            ],
+            bases=(crm.thumbnails.ThumbnailMixin, models.Model),
+        ),
+        migrations.AddField(
+            model_name='spooldimension',
+            name='spool_model',
+            field=models.ForeignKey(default=1, on_delete=django.db.models.deletion.CASCADE, to='crm.spoolmodel'),
+        ),
+        migrations.CreateModel(
+            name='ReducerModelImage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('img_height', models.PositiveIntegerField(default=100)),
+                ('img_width', models.PositiveIntegerField(default=100)),
+                ('image', models.ImageField(blank=True, height_field='img_height', null=True, storage=crm.storage.ContentAddressedStorage(), upload_to='reducer_images', width_field='img_width')),
+                ('image_hash', models.CharField(blank=True, default='', editable=False, help_text='sha256 of the image, names its thumbnails', max_length=64)),
+                ('reducer_model', models.ForeignKey(default=1, on_delete=django.db.models.deletion.CASCADE, to='crm.reducermodel')),
+            ],
+            bases=(crm.thumbnails.ThumbnailMixin, models.Model),
+        ),
+        migrations.AddField(
+            model_name='reducermodel',
+            name='spool_model',
+            field=models.ForeignKey(default=1, on_delete=django.db.models.deletion.CASCADE, to='crm.spoolmodel'),
+        ),
+        migrations.AddField(
+            model_name='reducerdimension',
+            name='reducer_model',
+            field=models.ForeignKey(default=1, on_delete=django.db.models.deletion.CASCADE, to='crm.reducermodel'),
+        ),
+        migrations.AddConstraint(
+            model_name='price',
+            constraint=models.UniqueConstraint(fields=('currency', 'price'), name='price_const'),
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='order',
+            field=models.ForeignKey(default=1, on_delete=django.db.models.deletion.CASCADE, to='crm.orderbucket'),
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='price',
+            field=models.ForeignKey(default=1, on_delete=django.db.models.deletion.CASCADE, to='crm.price'),
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='reducer_model',
+            field=models.ForeignKey(default=1, on_delete=django.db.models.deletion.CASCADE, to='crm.reducermodel'),
+        ),
+        migrations.AddIndex(
+            model_name='ordergroup',
+            index=models.Index(fields=['created', 'name'], name='order_group_order_idx'),
+        ),
+        migrations.AddField(
+            model_name='orderbucket',
+            name='order_group',
+            field=models.ForeignKey(default=1, on_delete=django.db.models.deletion.CASCADE, to='crm.ordergroup'),
+        ),
+        migrations.AddConstraint(
+            model_name='line',
+            constraint=models.UniqueConstraint(fields=('length', 'diameter'), name='line_const'),
+        ),
+        migrations.AddConstraint(
+            model_name='importfingerprint',
+            constraint=models.UniqueConstraint(fields=('source', 'row_key'), name='import_fingerprint_const'),
+        ),
+        migrations.AddIndex(
+            model_name='exchangerate',
+            index=models.Index(fields=['currency', '-date'], name='exchange_rate_order_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='exchangerate',
+            constraint=models.UniqueConstraint(fields=('currency', 'date'), name='exchange_rate_const'),
+        ),
+        migrations.AddIndex(
+            model_name='catalogchange',
+            index=models.Index(fields=['kind', 'object_id'], name='catalog_change_object_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='versioncopy',
+            constraint=models.UniqueConstraint(fields=('revision', 'version'), name='version_copy_const'),
+        ),
+        migrations.AddIndex(
+            model_name='spoolmodel',
+            index=models.Index(fields=['reel_model', 'name', 'modified', '-id'], name='spool_model_order_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='spoolmodel',
+            constraint=models.UniqueConstraint(fields=('reel_model', 'name'), name='spool_model_const'),
+        ),
+        migrations.AddConstraint(
+            model_name='spooldimension',
+            constraint=models.UniqueConstraint(condition=models.Q(actual=True), fields=('spool_model',), name='spool_dimension_actual_const'),
+        ),
+        migrations.AddConstraint(
+            model_name='reelmodel',
+            constraint=models.UniqueConstraint(fields=('reel_manufacturer', 'name'), name='reel_model_const'),
+        ),
+        migrations.AddIndex(
+            model_name='reducermodel',
+            index=models.Index(fields=['spool_model', 'modified'], name='reducer_model_order_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='reducermodel',
+            constraint=models.UniqueConstraint(fields=('spool_model', 'line'), name='reducer_model_const'),
+        ),
+        migrations.AddConstraint(
+            model_name='reducerdimension',
+            constraint=models.UniqueConstraint(condition=models.Q(actual=True), fields=('reducer_model',), name='reducer_dimension_actual_const'),
+        ),
+        migrations.AddIndex(
+            model_name='orderbucket',
+            index=models.Index(fields=['created', 'name'], name='order_bucket_order_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='orderbucket',
+            index=models.Index(condition=models.Q(sent=False), fields=['order_group', 'created', 'name'], name='order_bucket_not_sent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='orderbucket',
+            index=models.Index(condition=models.Q(sent=True), fields=['order_group', 'created', 'name'], name='order_bucket_sent_idx'),
+        ),
+    ]
@@ -1,7 +1,23 @@
-from datetime import datetime
+from collections import defaultdict
+from datetime import date, datetime, timedelta, timezone
+from itertools import chain, groupby
+from typing import Dict, List, Set, Tuple
 
-from django.core.files.storage import default_storage
-from django.db import models
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+from django.db.models import Case, ExpressionWrapper, F, OuterRef, Subquery, Sum, Value, When
+from django.db.models.deletion import Collector
+from django.db.models.functions import Coalesce
+from reversion.models import Revision, Version, _safe_revert
+from reversion.revisions import _follow_relations_recursive
+
+from crm.ids import names
+from crm.storage import image_storage
+from crm.thumbnails import ThumbnailMixin
+
+# the cached __str__ of the spools, reducers and order items, the parts are up to 200 characters each
+DISPLAY_NAME_LENGTH = 1000
 
 
 class Line(models.Model):
@@ -15,8 +31,12 @@ class Line(models.Model):
     length = models.IntegerField(help_text="line length in Meters")
     diameter = models.FloatField(help_text="line diameter in Millimeters")
 
+    @staticmethod
+    def format_name(length: int, diameter: float) -> str:
+        return "{}-{}".format(str(diameter), str(length))
+
     def __str__(self):
-        return "{}-{}".format(str(self.diameter), str(self.length))
+        return self.format_name(self.length, self.diameter)
 
 
 class ReelManufacturer(models.Model):
@@ -49,18 +69,67 @@ class SpoolModel(models.Model):
         constraints = [
             models.UniqueConstraint(fields=['reel_model', 'name'], name='spool_model_const')
         ]
+        indexes = [
+            # the admin changelist appends -pk, the name is nullable so the ordering isn't total without it
+            models.Index(fields=['reel_model', 'name', 'modified', '-id'], name='spool_model_order_idx'),
+        ]
 
     reel_model = models.ForeignKey(ReelModel, on_delete=models.CASCADE, default=1)
     name = models.CharField(max_length=200, null=True, blank=True, unique=False, default="")
     size = models.IntegerField(default=None, null=True, blank=True)
     modified = models.DateTimeField(auto_now=True)
     description = models.TextField(null=True, blank=True)
+    actual_dimension = models.ForeignKey('SpoolDimension', on_delete=models.SET_NULL, null=True, blank=True,
+                                         editable=False, related_name='+')
+    display_name = models.CharField(max_length=DISPLAY_NAME_LENGTH, blank=True, default="", editable=False,
+                                    db_index=True, help_text="cached manufacturer, reel model and spool name")
+
+    @staticmethod
+    def format_name(manufacturer: str, reel_model: str, name: str) -> str:
+        return "{} {} {}".format(manufacturer, reel_model, name or "")
 
     def __str__(self):
-        return "{} {}".format(self.reel_model, self.name or "")
+        return self.display_name or "{} {}".format(self.reel_model, self.name or "")
+
 
+class ActualDimensionMixin:
+    """Keeps one actual dimension per owner and the owner's `actual_dimension` pointer in sync."""
+
+    # name of the ForeignKey to the model that points to its actual dimension
+    owner_field = None
+
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        owner_field = type(self)._meta.get_field(self.owner_field)
+        owner_model, owner_id = owner_field.related_model, getattr(self, owner_field.attname)
+        with transaction.atomic(using=using):
+            # lock the owner row, concurrent switches of its actual dimension wait for each other
+            list(owner_model.objects.select_for_update().filter(pk=owner_id).order_by().values_list('pk'))
+            if self.actual:
+                # select all other active items
+                qs = type(self).objects.filter(**{owner_field.attname: owner_id, "actual": True})
+                # except self (if self already exists)
+                if self.pk:
+                    qs = qs.exclude(pk=self.pk)
+                # and deactive them
+                qs.update(actual=False)
+            super().save(force_insert, force_update, using, update_fields)
+            # a dimension moved to another owner or not actual anymore mustn't stay referenced
+            stale = owner_model.objects.filter(actual_dimension=self)
+            if self.actual:
+                stale = stale.exclude(pk=owner_id)
+                owner_model.objects.filter(pk=owner_id).update(actual_dimension=self)
+            stale.update(actual_dimension=None)
+
+
+class SpoolDimension(ActualDimensionMixin, models.Model):
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['spool_model'], condition=models.Q(actual=True),
+                                    name='spool_dimension_actual_const')
+        ]
+
+    owner_field = 'spool_model'
 
-class SpoolDimension(models.Model):
     actual = models.BooleanField(default=False)
     spool_model = models.ForeignKey(SpoolModel, on_delete=models.CASCADE, default=1)
     D1 = models.FloatField(default=1.0, help_text="Spool D1", null=False)
@@ -68,24 +137,15 @@ class SpoolDimension(models.Model):
     H1 = models.FloatField(default=1.0, help_text="Spool H1", null=False)
     description = models.CharField(max_length=200, null=True, blank=True, unique=False, default="")
 
-    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
-        if self.actual:
-            # select all other active items
-            qs = type(self).objects.filter(spool_model=self.spool_model, actual=True)
-            # except self (if self already exists)
-            if self.pk:
-                qs = qs.exclude(pk=self.pk)
-            # and deactive them
-            qs.update(actual=False)
-        super().save(force_insert, force_update, using, update_fields)
-
-
-class SpoolModelImage(models.Model):
+
+class SpoolModelImage(ThumbnailMixin, models.Model):
     spool_model = models.ForeignKey(SpoolModel, on_delete=models.CASCADE, default=1)
     img_height = models.PositiveIntegerField(default=100)
     img_width = models.PositiveIntegerField(default=100)
-    image = models.ImageField(storage=default_storage, upload_to="spool_images", null=True, blank=True,
+    image = models.ImageField(storage=image_storage, upload_to="spool_images", null=True, blank=True,
                               height_field='img_height', width_field='img_width')
+    image_hash = models.CharField(max_length=64, blank=True, default="", editable=False,
+                                  help_text="sha256 of the image, names its thumbnails")
 
     def __str__(self):
         return ""
@@ -96,18 +156,37 @@ class ReducerModel(models.Model):
     line = models.ForeignKey(Line, default=1, on_delete=models.CASCADE, null=False)
     description = models.TextField(null=True, blank=True)
     modified = models.DateTimeField(auto_now=True)
+    actual_dimension = models.ForeignKey('ReducerDimension', on_delete=models.SET_NULL, null=True, blank=True,
+                                         editable=False, related_name='+')
+    display_name = models.CharField(max_length=DISPLAY_NAME_LENGTH, blank=True, default="", editable=False,
+                                    db_index=True, help_text="cached spool and line name")
 
     class Meta:
         ordering = ['spool_model', 'modified']
         constraints = [
             models.UniqueConstraint(fields=['spool_model', 'line'], name='reducer_model_const')
         ]
+        indexes = [
+            models.Index(fields=['spool_model', 'modified'], name='reducer_model_order_idx'),
+        ]
+
+    @staticmethod
+    def format_name(spool: str, line: str) -> str:
+        return "{} {}".format(spool, line)
 
     def __str__(self):
-        return "{} {}".format(self.spool_model, self.line)
+        return self.display_name or "{} {}".format(self.spool_model, self.line)
+
+
+class ReducerDimension(ActualDimensionMixin, models.Model):
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['reducer_model'], condition=models.Q(actual=True),
+                                    name='reducer_dimension_actual_const')
+        ]
 
+    owner_field = 'reducer_model'
 
-class ReducerDimension(models.Model):
     actual = models.BooleanField(default=False)
     reducer_model = models.ForeignKey(ReducerModel, on_delete=models.CASCADE, default=1)
     D3 = models.FloatField(default=1.0, help_text="Spool D3", null=False)
@@ -116,24 +195,15 @@ class ReducerDimension(models.Model):
     shift = models.FloatField(default=0, help_text="Shift")
     description = models.CharField(max_length=200, null=True, blank=True, unique=False, default="")
 
-    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
-        if self.actual:
-            # select all other active items
-            qs = type(self).objects.filter(reducer_model=self.reducer_model, actual=True)
-            # except self (if self already exists)
-            if self.pk:
-                qs = qs.exclude(pk=self.pk)
-            # and deactive them
-            qs.update(actual=False)
-        super().save(force_insert, force_update, using, update_fields)
-
-
-class ReducerModelImage(models.Model):
+
+class ReducerModelImage(ThumbnailMixin, models.Model):
     reducer_model = models.ForeignKey(ReducerModel, on_delete=models.CASCADE, default=1)
     img_height = models.PositiveIntegerField(default=100)
     img_width = models.PositiveIntegerField(default=100)
-    image = models.ImageField(storage=default_storage, upload_to="reducer_images", null=True, blank=True,
+    image = models.ImageField(storage=image_storage, upload_to="reducer_images", null=True, blank=True,
                               height_field='img_height', width_field='img_width')
+    image_hash = models.CharField(max_length=64, blank=True, default="", editable=False,
+                                  help_text="sha256 of the image, names its thumbnails")
 
     def __str__(self):
         return ""
@@ -154,22 +224,94 @@ class Price(models.Model):
     currency = models.CharField(max_length=3, default=Currency.UAH, choices=Currency.choices)
     price = models.IntegerField(default=100)
 
+    @staticmethod
+    def format_name(price: int, currency: str) -> str:
+        return "{} {}".format(str(price), currency)
+
     def __str__(self):
-        return "{} {}".format(str(self.price), self.currency)
+        return self.format_name(self.price, self.currency)
+
+    def clean(self):
+        if self.pk and OrderItem.objects.filter(price=self).exists():
+            ExchangeRate.require_rates(self.currency)
+
+
+class ExchangeRate(models.Model):
+    """Rate of a currency to settings.CRM_REPORTING_CURRENCY, effective from `date` until the next rate."""
+
+    class Meta:
+        ordering = ['currency', '-date']
+        constraints = [
+            models.UniqueConstraint(fields=['currency', 'date'], name='exchange_rate_const')
+        ]
+        indexes = [
+            models.Index(fields=['currency', '-date'], name='exchange_rate_order_idx'),
+        ]
+
+    currency = models.CharField(max_length=3, choices=Price.Currency.choices)
+    date = models.DateField(default=date.today)
+    rate = models.FloatField(help_text="units of the reporting currency for one unit of the currency")
+
+    def __str__(self):
+        return "{} {} = {} {}".format(self.date, self.currency, self.rate, settings.CRM_REPORTING_CURRENCY)
+
+    @classmethod
+    def rate_at(cls, currency: str, when: str):
+        """Expression of the rate of the `currency` field effective at the `when` field of the outer query.
+
+        A date before the first rate of the currency gets that first rate, the expression is NULL only for a
+        currency without rates, which require_rates() keeps out of the orders.
+        """
+        return Case(
+            When(**{currency: settings.CRM_REPORTING_CURRENCY}, then=Value(1.0)),
+            default=Coalesce(
+                Subquery(cls.objects.filter(currency=OuterRef(currency), date__lte=OuterRef(when))
+                         .order_by('-date').values('rate')[:1]),
+                Subquery(cls.objects.filter(currency=OuterRef(currency)).order_by('date').values('rate')[:1])),
+            output_field=models.FloatField())
+
+    @classmethod
+    def require_rates(cls, currency: str, exclude_pk=None):
+        """Raises ValidationError for a currency the order totals can't be converted from."""
+        if currency == settings.CRM_REPORTING_CURRENCY or \
+                cls.objects.filter(currency=currency).exclude(pk=exclude_pk).exists():
+            return
+        raise ValidationError("No exchange rate of {} to {}, add one before ordering in {}".format(
+            currency, settings.CRM_REPORTING_CURRENCY, currency))
+
+    @classmethod
+    def required(cls, rates) -> List[str]:
+        """The currencies of order items that would be left without rates if `rates` were deleted."""
+        pks = [rate.pk for rate in rates]
+        return sorted(currency for currency in {rate.currency for rate in rates}
+                      if currency != settings.CRM_REPORTING_CURRENCY
+                      and not cls.objects.filter(currency=currency).exclude(pk__in=pks).exists()
+                      and OrderItem.objects.filter(price__currency=currency).exists())
+
+    def clean(self):
+        # moving the last rate of a currency to another one
+        if self.pk:
+            old = ExchangeRate.objects.filter(pk=self.pk).first()
+            if old and old.currency != self.currency and ExchangeRate.required([old]):
+                raise ValidationError("The orders in {} need an exchange rate".format(old.currency))
 
 
 def group_name():
-    return "OrderGroup-{}".format(datetime.now().strftime("%Y-%m-%d_%H:%M:%S"))
+    return names.next("OrderGroup")
 
 
 class OrderGroup(models.Model):
     class Meta:
         ordering = ['created', 'name']
+        indexes = [
+            models.Index(fields=['created', 'name'], name='order_group_order_idx'),
+        ]
 
     name = models.CharField(max_length=200, null=False, unique=True, default=group_name)
     created = models.DateTimeField(auto_now_add=True)
     description = models.TextField(null=True, blank=True)
     payed_sum = models.IntegerField(default=0)
+    total = models.IntegerField(default=0, editable=False, help_text="cached sum of the group orders")
 
     # def get_orders(self):
     #     return Order.objects.filter(order_group_id=self.name) or []
@@ -182,12 +324,21 @@ class OrderGroup(models.Model):
 
 
 def order_name():
-    return "Order-{}".format(datetime.now().strftime("%Y-%m-%d_%H:%M:%S"))
+    return names.next("Order")
 
 
 class OrderBucket(models.Model):
     class Meta:
         ordering = ['created', 'name']
+        indexes = [
+            models.Index(fields=['created', 'name'], name='order_bucket_order_idx'),
+            # the sent/not sent inlines of an order group, SQLite filters booleans as "NOT sent"/"sent",
+            # which can't seek a (order_group, sent) index, partial indexes match those terms
+            models.Index(fields=['order_group', 'created', 'name'], condition=models.Q(sent=False),
+                         name='order_bucket_not_sent_idx'),
+            models.Index(fields=['order_group', 'created', 'name'], condition=models.Q(sent=True),
+                         name='order_bucket_sent_idx'),
+        ]
 
     name = models.CharField(max_length=200, null=False, unique=True, default=order_name)
     order_group = models.ForeignKey(OrderGroup, on_delete=models.CASCADE, default=1)
@@ -195,6 +346,8 @@ class OrderBucket(models.Model):
     sent = models.BooleanField(default=False)
     description = models.TextField(null=True, blank=True)
     created = models.DateTimeField(auto_now=True, editable=False)
+    placed = models.DateField(default=date.today, help_text="the items are converted at the exchange rates of this day")
+    total = models.IntegerField(default=0, editable=False, help_text="cached sum of the order items")
 
     def __str__(self):
         return self.name
@@ -203,7 +356,10 @@ class OrderBucket(models.Model):
         return OrderItem.objects.filter(order_id=self.pk)
 
     def get_order_sum(self):
-        return sum([item.get_item_sum() for item in self.get_order_items()])
+        return round(self.get_order_items().aggregate(total=Coalesce(Sum(OrderItem.converted_sum()), 0.0))["total"])
+
+    def get_currency_totals(self):
+        return OrderItem.currency_totals(self.get_order_items())
 
 
 class OrderItem(models.Model):
@@ -213,9 +369,194 @@ class OrderItem(models.Model):
     amount = models.IntegerField(default=2)
     printed = models.BooleanField(default=False)
     description = models.TextField(null=True, blank=True, )
+    display_name = models.CharField(max_length=DISPLAY_NAME_LENGTH, blank=True, default="", editable=False,
+                                    help_text="cached reducer, amount and price")
+
+    ITEM_SUM = F('price__price') * F('amount')
+
+    @classmethod
+    def converted_sum(cls):
+        """Expression of the item sum in the reporting currency, at the rate of the day the order was placed."""
+        return ExpressionWrapper(cls.ITEM_SUM * ExchangeRate.rate_at('price__currency', 'order__placed'),
+                                 output_field=models.FloatField())
+
+    @classmethod
+    def currency_totals(cls, items):
+        """Per currency subtotals of the items and their sums in the reporting currency, one grouped query.
+
+        `converted` is None for a currency without exchange rates.
+        """
+        return list(items.order_by('price__currency').values('price__currency').annotate(
+            total=Sum(cls.ITEM_SUM), converted=Sum(cls.converted_sum())))
+
+    @staticmethod
+    def format_name(reducer: str, amount: int, price: str) -> str:
+        return "{} - {}x{}".format(reducer, amount, price)
 
     def __str__(self):
-        return "{} - {}x{}".format(self.reducer_model, self.amount, self.price)
+        return self.display_name or "{} - {}x{}".format(self.reducer_model, self.amount, self.price)
 
     def get_item_sum(self):
         return self.price.price * self.amount
+
+    def clean(self):
+        if self.price_id:
+            ExchangeRate.require_rates(self.price.currency)
+
+
+class ImportCheckpoint(models.Model):
+    """Position of an interrupted chunked import_models run, committed together with each chunk."""
+
+    source = models.CharField(max_length=500, unique=True, help_text="absolute path of the imported file")
+    offset = models.BigIntegerField(default=0, help_text="byte offset behind the last committed row")
+    rows = models.IntegerField(default=0, help_text="CSV rows committed so far")
+    state = models.JSONField(default=dict, help_text="fill-forward model/line/dimension state")
+    size = models.BigIntegerField(default=0, help_text="file size when the checkpoint was written")
+    mtime = models.FloatField(default=0, help_text="file modification time when the checkpoint was written")
+    prefix_hash = models.CharField(max_length=40, blank=True, default="",
+                                   help_text="sha1 of the file bytes before `offset`")
+    occurrences = models.JSONField(default=dict, help_text="--incremental: rows per model/line before `offset`")
+    modified = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return "{} @ {}".format(self.source, self.offset)
+
+
+class ImportFingerprint(models.Model):
+    """Content hash of a normalized import_models row, lets later imports of the same file skip it."""
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['source', 'row_key'], name='import_fingerprint_const')
+        ]
+
+    source = models.CharField(max_length=500, help_text="absolute path of the imported file")
+    row_key = models.CharField(max_length=40, help_text="hash of the model/line of the row and its occurrence")
+    digest = models.CharField(max_length=40, help_text="hash of the normalized row")
+
+    def __str__(self):
+        return "{} {}".format(self.source, self.row_key)
+
+
+class CatalogChange(models.Model):
+    """Append-only log of catalog changes, its ids are the keyset cursors of the delta sync.
+
+    Dimension and image changes are logged as changes of their spool/reducer, the records the
+    clients sync. A deleted record leaves a tombstone entry.
+    """
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['kind', 'object_id'], name='catalog_change_object_idx'),
+        ]
+
+    class Kind(models.TextChoices):
+        MANUFACTURER = "manufacturer"
+        REEL_MODEL = "reel_model"
+        SPOOL = "spool"
+        REDUCER = "reducer"
+        LINE = "line"
+
+    kind = models.CharField(max_length=20, choices=Kind.choices)
+    object_id = models.IntegerField()
+    deleted = models.BooleanField(default=False)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return "{} {} {}".format(self.kind, self.object_id, "deleted" if self.deleted else "changed")
+
+    @classmethod
+    def record(cls, kind, ids, deleted=False):
+        cls.objects.bulk_create([cls(kind=kind, object_id=pk, deleted=deleted) for pk in sorted(set(ids))])
+
+    @staticmethod
+    def settled():
+        """Entries created before this time are committed, None when every entry is (see crm.api.changes_page)."""
+        if not settings.CRM_CHANGES_SETTLE_SECONDS:
+            return None
+        return datetime.now(timezone.utc) - timedelta(seconds=settings.CRM_CHANGES_SETTLE_SECONDS)
+
+    @classmethod
+    def _settled_entries(cls, cursor: int):
+        entries = cls.objects.filter(pk__gt=cursor).order_by('pk')
+        settled = cls.settled()
+        if settled is not None:
+            young = entries.filter(created__gt=settled).values_list('pk', flat=True).first()
+            if young is not None:
+                entries = entries.filter(pk__lt=young)
+        return entries
+
+    @classmethod
+    def cursor(cls) -> int:
+        """Id of the last settled entry, the changes after it are read again by changed_since()."""
+        return cls._settled_entries(0).order_by('-pk').values_list('pk', flat=True).first() or 0
+
+    @classmethod
+    def changed_since(cls, cursor: int) -> Tuple[Dict[str, Set[int]], int]:
+        """Ids of the records changed after the `cursor` entry by kind, and the cursor of the last settled entry."""
+        changed = defaultdict(set)
+        for pk, kind, object_id in cls._settled_entries(cursor).values_list('pk', 'kind', 'object_id').iterator():
+            changed[kind].add(object_id)
+            cursor = pk
+        return changed, cursor
+
+
+class VersionCopy(models.Model):
+    """An object of a revision stored as the earlier version with the same data, instead of a new version.
+
+    The revisions of the orders serialize every inline row the saved objects follow, most of them unchanged.
+    The revisions written from the queue store those as copies, prune_revisions --compact turns the old
+    versions equal to the previous version of their object into copies.
+    """
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['revision', 'version'], name='version_copy_const')
+        ]
+
+    revision = models.ForeignKey(Revision, on_delete=models.CASCADE, related_name='copies')
+    # prune_revisions doesn't delete the versions that have copies
+    version = models.ForeignKey(Version, on_delete=models.PROTECT, related_name='copies')
+
+    def __str__(self):
+        return "{} #{}".format(self.version, self.revision_id)
+
+    def resolve(self) -> Version:
+        """The version as the revision would hold it, unsaved."""
+        version = self.version
+        return Version(revision=self.revision, object_id=version.object_id, content_type_id=version.content_type_id,
+                       db=version.db, format=version.format, serialized_data=version.serialized_data,
+                       object_repr=version.object_repr)
+
+
+class CompactRevision(Revision):
+    """A revision together with its copies."""
+
+    class Meta:
+        proxy = True
+
+    def versions(self) -> List[Version]:
+        return list(self.version_set.all()) + [copy.resolve() for copy in self.copies.select_related('version')]
+
+    def revert(self, delete=False):
+        # Revision.revert() over the versions and the copies
+        versions_by_db = defaultdict(list)
+        for version in self.versions():
+            versions_by_db[version.db].append(version)
+        for version_db, versions in versions_by_db.items():
+            with transaction.atomic(using=version_db):
+                if delete:
+                    old_revision = set()
+                    for version in versions:
+                        model = version._model
+                        try:
+                            old_revision.add(model._default_manager.using(version.db).get(pk=version.object_id))
+                        except model.DoesNotExist:
+                            pass
+                    current_revision = chain.from_iterable(_follow_relations_recursive(obj) for obj in old_revision)
+                    collector = Collector(using=version_db)
+                    new_objs = [item for item in current_revision if item not in old_revision]
+                    for model, group in groupby(new_objs, type):
+                        collector.collect(list(group))
+                    collector.delete()
+                _safe_revert(versions)
@@ -0,0 +1,77 @@
+from typing import Iterable, List, Optional
+
+from crm.models import Line, OrderItem, Price, ReelModel, ReducerModel, SpoolModel
+
+# display names are the cached __str__ of the spools, reducers and order items; a rename of a parent
+# is written down the tree, only the rows whose name changed are updated and cascaded further
+BATCH_SIZE = 500
+
+
+def spool_name(reel_model_id: int, name: str) -> str:
+    manufacturer, reel_model = ReelModel.objects.filter(pk=reel_model_id).values_list(
+        'reel_manufacturer__name', 'name').get()
+    return SpoolModel.format_name(manufacturer, reel_model, name)
+
+
+def reducer_name(spool_model_id: int, line_id: int) -> str:
+    spool = SpoolModel.objects.filter(pk=spool_model_id).values_list('display_name', flat=True).get()
+    length, diameter = Line.objects.filter(pk=line_id).values_list('length', 'diameter').get()
+    return ReducerModel.format_name(spool, Line.format_name(length, diameter))
+
+
+def item_name(reducer_model_id: int, amount: int, price_id: int) -> str:
+    reducer = ReducerModel.objects.filter(pk=reducer_model_id).values_list('display_name', flat=True).get()
+    price, currency = Price.objects.filter(pk=price_id).values_list('price', 'currency').get()
+    return OrderItem.format_name(reducer, amount, Price.format_name(price, currency))
+
+
+def _write(model, rows: Iterable[tuple]) -> List[int]:
+    """Stores the (pk, stored name, current name) rows whose name differs, returns their keys."""
+    changed = [model(pk=pk, display_name=name) for pk, stored, name in rows if stored != name]
+    model.objects.bulk_update(changed, ['display_name'], batch_size=BATCH_SIZE)
+    return [obj.pk for obj in changed]
+
+
+def update_spool_names(spools=None) -> int:
+    spools = SpoolModel.objects.all() if spools is None else spools
+    changed = _write(SpoolModel, [
+        (pk, stored, SpoolModel.format_name(manufacturer, reel_model, name))
+        for pk, stored, manufacturer, reel_model, name in spools.order_by().values_list(
+            'pk', 'display_name', 'reel_model__reel_manufacturer__name', 'reel_model__name', 'name')])
+    if not changed:
+        return 0
+    return len(changed) + update_reducer_names(ReducerModel.objects.filter(spool_model_id__in=changed))
+
+
+def update_reducer_names(reducers=None) -> int:
+    reducers = ReducerModel.objects.all() if reducers is None else reducers
+    changed = _write(ReducerModel, [
+        (pk, stored, ReducerModel.format_name(spool, Line.format_name(length, diameter)))
+        for pk, stored, spool, length, diameter in reducers.order_by().values_list(
+            'pk', 'display_name', 'spool_model__display_name', 'line__length', 'line__diameter')])
+    if not changed:
+        return 0
+    return len(changed) + update_item_names(OrderItem.objects.filter(reducer_model_id__in=changed))
+
+
+def update_item_names(items=None) -> int:
+    items = OrderItem.objects.all() if items is None else items
+    return len(_write(OrderItem, [
+        (pk, stored, OrderItem.format_name(reducer, amount, Price.format_name(price, currency)))
+        for pk, stored, reducer, amount, price, currency in items.order_by().values_list(
+            'pk', 'display_name', 'reducer_model__display_name', 'amount', 'price__price', 'price__currency')]))
+
+
+def update_display_names(spool_ids: Optional[Iterable[int]] = None) -> int:
+    """Recomputes the names of the spools (every spool without `spool_ids`) and everything below them,
+    returns the count of updated rows.
+    """
+    spools = SpoolModel.objects.all() if spool_ids is None else SpoolModel.objects.filter(pk__in=spool_ids)
+    # the reducers and items of an unchanged spool may be stale as well, they are checked after the cascade
+    updated = update_spool_names(spools)
+    reducers = ReducerModel.objects.all() if spool_ids is None else ReducerModel.objects.filter(
+        spool_model_id__in=spool_ids)
+    updated += update_reducer_names(reducers)
+    items = OrderItem.objects.all() if spool_ids is None else OrderItem.objects.filter(
+        reducer_model__spool_model_id__in=spool_ids)
+    return updated + update_item_names(items)
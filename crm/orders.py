@@ -0,0 +1,116 @@
+from typing import Iterable, List, Optional
+
+import reversion
+from django.db import transaction
+from django.utils import timezone
+from reversion.models import Revision, Version
+
+from crm.models import OrderBucket, OrderGroup, OrderItem, order_name
+from crm.revisions import new_version
+from crm.totals import update_bucket_totals, update_group_totals
+
+BATCH_SIZE = 500
+
+
+def save_revision(objects: Iterable, user=None, comment: str = "") -> Optional[Revision]:
+    """One revision with a version of every object, the versions are written with bulk inserts.
+
+    reversion.add_to_revision() saves the versions one by one and follows the registered relations of
+    every object, for an action over hundreds of orders that is a few queries per order.
+    """
+    objects = [obj for obj in objects if reversion.is_registered(type(obj))]
+    if not objects:
+        return None
+    revision = Revision.objects.create(date_created=timezone.now(), user=user, comment=comment)
+    versions = [new_version(obj) for obj in objects]
+    for version in versions:
+        version.revision = revision
+    Version.objects.bulk_create(versions, batch_size=BATCH_SIZE)
+    return revision
+
+
+def update_orders(buckets, user=None, comment: str = "", **fields) -> int:
+    """Sets the `fields` (payed/sent) of the buckets with one UPDATE, records one revision."""
+    with transaction.atomic():
+        pks = list(buckets.order_by().values_list('pk', flat=True))
+        updated = OrderBucket.objects.filter(pk__in=pks).update(**fields)
+        save_revision(OrderBucket.objects.filter(pk__in=pks), user, comment)
+    return updated
+
+
+def update_items(items, user=None, comment: str = "", **fields) -> int:
+    """Sets the `fields` (printed) of the items with one UPDATE, records one revision of the items and orders."""
+    with transaction.atomic():
+        pks = list(items.order_by().values_list('pk', flat=True))
+        updated = OrderItem.objects.filter(pk__in=pks).update(**fields)
+        save_revision(list(OrderBucket.objects.filter(orderitem__pk__in=pks).distinct()) +
+                      list(OrderItem.objects.filter(pk__in=pks)), user, comment)
+    return updated
+
+
+def move_orders(buckets, group: OrderGroup, user=None, comment: str = "") -> int:
+    """Moves the buckets to `group`, the cached totals of the groups they leave and of `group` are updated."""
+    with transaction.atomic():
+        pks = list(buckets.order_by().values_list('pk', flat=True))
+        moved = OrderBucket.objects.filter(pk__in=pks)
+        group_ids = set(moved.values_list('order_group_id', flat=True)) | {group.pk}
+        updated = moved.update(order_group=group)
+        update_group_totals(group_ids)
+        save_revision(list(OrderBucket.objects.filter(pk__in=pks)) +
+                      list(OrderGroup.objects.filter(pk__in=group_ids)), user, comment)
+    return updated
+
+
+def _copy_name(model, name: str, suffix: str) -> str:
+    # the name is cut so that the suffix fits into the field
+    return name[:model._meta.get_field('name').max_length - len(suffix)] + suffix
+
+
+def _free_suffix(group: OrderGroup, bucket_names: List[str]) -> str:
+    # names are unique, the copies get the first " copy N" suffix free for the group and every order
+    n = 1
+    while True:
+        suffix = " copy" if n == 1 else " copy {}".format(n)
+        if not OrderGroup.objects.filter(name=_copy_name(OrderGroup, group.name, suffix)).exists() and \
+                not OrderBucket.objects.filter(name__in=[_copy_name(OrderBucket, name, suffix)
+                                                         for name in bucket_names]).exists():
+            return suffix
+        n += 1
+
+
+def duplicate_group(group: OrderGroup, user=None) -> OrderGroup:
+    """Copies the group with its orders and their items, not payed and not sent.
+
+    The copies keep the `placed` day of their orders, so their totals are converted at the same exchange rates
+    as the originals. The group, the orders and the items are bulk inserted, SQLite returns no primary keys
+    from a bulk insert so the new rows are looked up by their unique names.
+    """
+    with transaction.atomic():
+        buckets = list(OrderBucket.objects.filter(order_group=group).order_by('pk'))
+        suffix = _free_suffix(group, [bucket.name for bucket in buckets])
+        names = {}
+        for bucket in buckets:
+            name = _copy_name(OrderBucket, bucket.name, suffix)
+            # long names that differ only in the part cut off get a generated name
+            names[bucket.pk] = order_name() if name in names.values() else name
+        # bulk inserts all the way, a save() would also add the copy to the revision of the admin view
+        group_name = _copy_name(OrderGroup, group.name, suffix)
+        OrderGroup.objects.bulk_create([OrderGroup(name=group_name, description=group.description)])
+        copy = OrderGroup.objects.get(name=group_name)
+        OrderBucket.objects.bulk_create([
+            OrderBucket(name=names[bucket.pk], order_group=copy, description=bucket.description,
+                        placed=bucket.placed)
+            for bucket in buckets
+        ], batch_size=BATCH_SIZE)
+        copies = dict(OrderBucket.objects.filter(order_group=copy).values_list('name', 'pk'))
+        new_ids = {bucket.pk: copies[names[bucket.pk]] for bucket in buckets}
+        OrderItem.objects.bulk_create([
+            OrderItem(order_id=new_ids[item.order_id], reducer_model_id=item.reducer_model_id, price_id=item.price_id,
+                      amount=item.amount, description=item.description, display_name=item.display_name)
+            for item in OrderItem.objects.filter(order__order_group=group).order_by('pk')
+        ], batch_size=BATCH_SIZE)
+        update_bucket_totals(new_ids.values())
+        copy.refresh_from_db()
+        save_revision([copy] + list(OrderBucket.objects.filter(order_group=copy)), user,
+                      "Copied from {}".format(group.name))
+    return copy
@@ -0,0 +1,380 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import timedelta
+from itertools import chain
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core import serializers
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import DatabaseError, models, router, transaction
+from django.db.models import Count, Exists, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.encoding import force_str
+from reversion.models import Revision, Version
+from reversion.revisions import _get_options, is_registered
+
+from crm.models import VersionCopy
+
+BATCH_SIZE = 500
+FAILED_SUFFIX = ".failed"
+_local = threading.local()
+logger = logging.getLogger(__name__)
+
+
+def _chunks(items: list, size: int = BATCH_SIZE) -> Iterator[list]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def new_version(obj) -> Version:
+    """Unsaved version of a registered object, with the serialization options it was registered with."""
+    options = _get_options(type(obj))
+    return Version(object_id=force_str(obj.pk), content_type=ContentType.objects.get_for_model(obj),
+                   db=obj._state.db or router.db_for_write(type(obj)), format=options.format,
+                   serialized_data=serializers.serialize(options.format, (obj,), fields=options.fields,
+                                                         use_natural_foreign_keys=options.use_natural_foreign_keys),
+                   object_repr=force_str(obj))
+
+
+class RevisionQueue:
+    """Local queue of the revisions to write, one JSON file per revision, read in the order they were queued.
+
+    A file is complete once it has a .json name: it is written to a temporary name, synced and renamed.
+    """
+
+    def __init__(self, directory: str = None):
+        self._directory = directory
+
+    @property
+    def directory(self) -> str:
+        return self._directory or settings.CRM_REVISION_QUEUE_DIR
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory)
+
+    def put(self, entry: dict) -> str:
+        directory = self.directory
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(entry, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        name = "{:020d}-{}.json".format(time.time_ns(), uuid.uuid4().hex[:8])
+        os.replace(tmp_name, os.path.join(directory, name))
+        return name
+
+    def pending(self) -> List[str]:
+        try:
+            return sorted(name for name in os.listdir(self.directory) if name.endswith(".json"))
+        except FileNotFoundError:
+            return []
+
+    def read(self, name: str) -> dict:
+        with open(os.path.join(self.directory, name)) as fh:
+            return json.load(fh)
+
+    def remove(self, name: str):
+        os.remove(os.path.join(self.directory, name))
+
+    def set_aside(self, name: str):
+        os.replace(os.path.join(self.directory, name), os.path.join(self.directory, name + FAILED_SUFFIX))
+
+    def failed(self) -> List[str]:
+        try:
+            return sorted(name for name in os.listdir(self.directory) if name.endswith(FAILED_SUFFIX))
+        except FileNotFoundError:
+            return []
+
+    def retry(self, name: str):
+        """Puts a set aside file back, in its original place in the queue."""
+        os.replace(os.path.join(self.directory, name), os.path.join(self.directory, name[:-len(FAILED_SUFFIX)]))
+
+    def __len__(self):
+        return len(self.pending())
+
+
+revision_queue = RevisionQueue()
+
+
+def is_capturing() -> bool:
+    return getattr(_local, "frame", None) is not None
+
+
+def capture(obj):
+    _local.frame["objects"][(obj._meta.label_lower, force_str(obj.pk))] = obj
+
+
+def set_comment(comment: str):
+    _local.frame["comment"] = comment
+
+
+@contextmanager
+def deferred_revision(user=None, queue: RevisionQueue = None):
+    """Collects the registered objects saved in the block, the revision is queued when the transaction commits.
+
+    The objects they follow (the inline rows) are serialized too, like reversion does, but an object whose data
+    equals its latest version is queued as the pk of that version and written as a copy of it, a VersionCopy.
+    A later version of the row, written by an order action before the queue is flushed, doesn't change this
+    revision.
+    """
+    if is_capturing():
+        yield
+        return
+    queue = queue or revision_queue
+    _local.frame = {"user": getattr(user, "pk", None), "comment": "", "objects": {}}
+    try:
+        with transaction.atomic():
+            yield
+            entry = _entry(_local.frame)
+            if entry is not None:
+                transaction.on_commit(lambda: queue.put(entry))
+    finally:
+        _local.frame = None
+
+
+def _followed(obj) -> Iterator[Tuple[str, List[str]]]:
+    # reversion.revisions._follow_relations() without loading the related rows
+    for name in dict.fromkeys(_get_options(type(obj)).follow):
+        try:
+            related = getattr(obj, name)
+        except ObjectDoesNotExist:
+            continue
+        if isinstance(related, models.Model):
+            yield related._meta.label_lower, [force_str(related.pk)]
+        elif isinstance(related, (models.Manager, models.QuerySet)):
+            yield related.model._meta.label_lower, [force_str(pk) for pk in related.values_list('pk', flat=True)]
+
+
+def _version_data(label: str, version: Version) -> dict:
+    return {"model": label, "object_id": version.object_id, "format": version.format,
+            "serialized_data": version.serialized_data, "object_repr": version.object_repr}
+
+
+def _latest_versions(model, pks: List[str]) -> Dict[str, Tuple[int, str]]:
+    """pk and serialized data of the latest version of every object that has one."""
+    content_type = ContentType.objects.get_for_model(model)
+    latest = {}
+    for batch in _chunks(pks):
+        latest_pks = Version.objects.filter(content_type=content_type, object_id__in=batch).order_by() \
+            .values('object_id').annotate(latest=Max('pk')).values_list('latest', flat=True)
+        latest.update((object_id, (pk, data)) for pk, object_id, data in Version.objects.filter(
+            pk__in=list(latest_pks)).values_list('pk', 'object_id', 'serialized_data'))
+    return latest
+
+
+def _entry(frame: dict) -> Optional[dict]:
+    objects = frame["objects"]
+    if not objects:
+        return None
+    saved, follow = {}, {}
+    for (label, pk), obj in objects.items():
+        saved.setdefault(label, []).append(obj)
+        for followed_label, pks in _followed(obj):
+            follow.setdefault(followed_label, set()).update(pk for pk in pks if (followed_label, pk) not in objects)
+    versions, copies = [], {}
+    for label in dict.fromkeys(chain(saved, follow)):
+        model = apps.get_model(label)
+        pks = sorted(follow.get(label, ()))
+        latest = _latest_versions(model, sorted(chain(pks, (force_str(obj.pk) for obj in saved.get(label, ())))))
+        for obj in chain(saved.get(label, ()), chain.from_iterable(model._base_manager.filter(pk__in=batch)
+                                                                   for batch in _chunks(pks))):
+            version = new_version(obj)
+            pk, data = latest.get(version.object_id, (None, None))
+            if data == version.serialized_data:
+                copies.setdefault(label, {})[version.object_id] = pk
+            else:
+                versions.append(_version_data(label, version))
+    return {"date_created": timezone.now().isoformat(), "user": frame["user"], "comment": frame["comment"],
+            "versions": versions, "copies": copies}
+
+
+def _copies(model, copies: Dict[str, int]) -> Tuple[Dict[str, int], List[Version]]:
+    """The copied versions that still exist, by object, and the current state of the objects of the others."""
+    found = {}
+    for batch in _chunks(list(copies.values())):
+        found.update(Version.objects.filter(pk__in=batch).values_list('object_id', 'pk'))
+    # a version pruned since the request is replaced with the current state of its object
+    missing = [object_id for object_id in copies if object_id not in found]
+    versions = []
+    for batch in _chunks(missing):
+        versions.extend(map(new_version, model._base_manager.filter(pk__in=batch)))
+    return found, versions
+
+
+def _existing(model, object_ids: List[str]) -> set:
+    pks = set()
+    for batch in _chunks(object_ids):
+        pks.update(force_str(pk) for pk in model._base_manager.filter(pk__in=batch).values_list('pk', flat=True))
+    return pks
+
+
+def write_revision(entry: dict) -> Optional[Revision]:
+    """Saves a queued revision with bulk inserts, without the versions of the objects deleted since.
+
+    The unchanged objects are saved as copies of their latest version, a row that doesn't hold their data.
+    """
+    versions: Dict[type, List[Version]] = {}
+    copied: Dict[type, Dict[str, int]] = {}
+    for data in entry["versions"]:
+        model = apps.get_model(data["model"])
+        versions.setdefault(model, []).append(Version(
+            object_id=data["object_id"], content_type=ContentType.objects.get_for_model(model),
+            db=router.db_for_write(model), format=data["format"], serialized_data=data["serialized_data"],
+            object_repr=data["object_repr"]))
+    for label, copies in entry["copies"].items():
+        model = apps.get_model(label)
+        copied[model], current = _copies(model, copies)
+        versions.setdefault(model, []).extend(current)
+
+    existing, copies = [], []
+    for model, model_versions in versions.items():
+        pks = _existing(model, [version.object_id for version in model_versions])
+        existing.extend(version for version in model_versions if version.object_id in pks)
+    for model, model_copies in copied.items():
+        pks = _existing(model, list(model_copies))
+        copies.extend(VersionCopy(version_id=pk) for object_id, pk in model_copies.items() if object_id in pks)
+    if not existing and not copies:
+        return None
+    revision = Revision.objects.create(date_created=parse_datetime(entry["date_created"]), user_id=entry["user"],
+                                       comment=entry["comment"])
+    for version in chain(existing, copies):
+        version.revision = revision
+    Version.objects.bulk_create(existing, batch_size=BATCH_SIZE)
+    VersionCopy.objects.bulk_create(copies, batch_size=BATCH_SIZE)
+    return revision
+
+
+def flush_queue(queue: RevisionQueue = None, limit: int = None) -> Tuple[int, List[str]]:
+    """Writes the queued revisions in order, returns their count and the files that couldn't be written.
+
+    A file that fails, unreadable or rejected by the database (a deleted user, a lock that outlasted the busy
+    timeout), is logged, renamed to .failed and skipped, it would stop the queue otherwise. flush_revisions
+    --retry-failed puts the files back.
+    """
+    queue = queue or revision_queue
+    written, failed = 0, []
+    for name in queue.pending()[:limit]:
+        try:
+            with transaction.atomic():
+                write_revision(queue.read(name))
+        except (ValueError, KeyError, LookupError, DatabaseError):
+            logger.exception("Can't write the queued revision %s, renamed to %s%s", name, name, FAILED_SUFFIX)
+            queue.set_aside(name)
+            failed.append(name)
+            continue
+        queue.remove(name)
+        written += 1
+    return written, failed
+
+
+def _count(queryset: models.QuerySet, object_id: str) -> Coalesce:
+    return Coalesce(Subquery(queryset.order_by().values(object_id).annotate(count=Count('pk')).values('count'),
+                             output_field=models.IntegerField()), 0)
+
+
+def prunable_versions(model, days: int, keep: int) -> models.QuerySet:
+    """Versions of `model` older than `days`, except the `keep` latest versions of every object and the versions
+    that have copies.
+
+    Latest is by pk, as in reversion's Version.objects.get_for_object(), the copies of the object in later
+    revisions count as later versions. The rank is a correlated count, deleting older versions doesn't change it.
+    """
+    content_type = ContentType.objects.get_for_model(model)
+    newer = Version.objects.filter(content_type=content_type, object_id=OuterRef('object_id'), pk__gt=OuterRef('pk'))
+    newer_copies = VersionCopy.objects.filter(version__content_type=content_type,
+                                              version__object_id=OuterRef('object_id'),
+                                              revision__gt=OuterRef('revision'))
+    return Version.objects.filter(content_type=content_type,
+                                  revision__date_created__lt=timezone.now() - timedelta(days=days)).annotate(
+        newer=_count(newer, 'object_id') + _count(newer_copies, 'version__object_id'),
+        copied=Exists(VersionCopy.objects.filter(version=OuterRef('pk')))).filter(newer__gte=keep, copied=False)
+
+
+def prunable_copies(model, days: int, keep: int) -> models.QuerySet:
+    """Copies of the versions of `model` older than `days`, except the `keep` latest versions of every object,
+    the copies ranked by their revision."""
+    content_type = ContentType.objects.get_for_model(model)
+    newer = Version.objects.filter(content_type=content_type, object_id=OuterRef('version__object_id'),
+                                   revision__gt=OuterRef('revision'))
+    newer_copies = VersionCopy.objects.filter(version__content_type=content_type,
+                                              version__object_id=OuterRef('version__object_id'),
+                                              revision__gt=OuterRef('revision'))
+    return VersionCopy.objects.filter(version__content_type=content_type,
+                                      revision__date_created__lt=timezone.now() - timedelta(days=days)).annotate(
+        newer=_count(newer, 'object_id') + _count(newer_copies, 'version__object_id')).filter(newer__gte=keep)
+
+
+def compact_versions(model, days: int, batch_size: int = BATCH_SIZE, pause: float = 0) -> int:
+    """Turns the versions of `model` older than `days` that equal the previous version of their object into
+    copies of the first version of the run, returns their count.
+
+    The objects are walked by object_id, the versions of a batch of objects are compacted in one transaction.
+    """
+    versions = Version.objects.filter(content_type=ContentType.objects.get_for_model(model),
+                                      revision__date_created__lt=timezone.now() - timedelta(days=days))
+    objects = versions.order_by().values('object_id').annotate(count=Count('pk')).filter(count__gt=1)
+    compacted, last = 0, None
+    while True:
+        with transaction.atomic():
+            batch = objects.filter(object_id__gt=last) if last is not None else objects
+            object_ids = list(batch.order_by('object_id').values_list('object_id', flat=True)[:batch_size])
+            if not object_ids:
+                return compacted
+            first: Dict[str, Tuple[int, str, str]] = {}
+            copies, replaced = [], {}
+            for pk, object_id, revision_id, format, data in versions.filter(object_id__in=object_ids).order_by(
+                    'object_id', 'pk').values_list('pk', 'object_id', 'revision', 'format', 'serialized_data'):
+                if object_id in first and first[object_id][1:] == (format, data):
+                    copies.append(VersionCopy(revision_id=revision_id, version_id=first[object_id][0]))
+                    replaced.setdefault(first[object_id][0], []).append(pk)
+                else:
+                    first[object_id] = (pk, format, data)
+            for pk, pks in replaced.items():
+                for pks_batch in _chunks(pks):
+                    VersionCopy.objects.filter(version__in=pks_batch).update(version=pk)
+            VersionCopy.objects.bulk_create(copies, batch_size=BATCH_SIZE)
+            for pks_batch in _chunks(list(chain.from_iterable(replaced.values()))):
+                compacted += Version.objects.filter(pk__in=pks_batch).delete()[1].get(Version._meta.label, 0)
+        last = object_ids[-1]
+        if pause:
+            time.sleep(pause)
+
+
+def empty_revisions(days: int) -> models.QuerySet:
+    return Revision.objects.filter(version__isnull=True, copies__isnull=True,
+                                   date_created__lt=timezone.now() - timedelta(days=days))
+
+
+def delete_in_batches(queryset: models.QuerySet, batch_size: int = BATCH_SIZE, pause: float = 0) -> int:
+    """Deletes the rows of the queryset in short transactions, `pause` seconds apart, so that writers aren't
+    locked out. The rows are walked by pk, a batch is read and deleted in its own transaction."""
+    deleted, last = 0, 0
+    while True:
+        with transaction.atomic():
+            pks = list(queryset.filter(pk__gt=last).order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                return deleted
+            deleted += queryset.model.objects.filter(pk__in=pks).delete()[1].get(queryset.model._meta.label, 0)
+        last = pks[-1]
+        if pause:
+            time.sleep(pause)
+
+
+def registered_model(label: str):
+    model = apps.get_model(label)
+    if not is_registered(model):
+        raise LookupError("{} isn't registered with reversion".format(label))
+    return model
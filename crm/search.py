@@ -0,0 +1,200 @@
+import re
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+
+from django.db import connection, transaction
+from django.db.models.expressions import RawSQL
+
+from crm.models import SpoolModel, ReducerModel
+
+# every document is a spool or a reducer, the kind is the lowest bit of the document id
+KINDS = ("spool", "reducer")
+TABLE = "crm_search"
+BATCH_SIZE = 500
+# matches ranked per query, a broad prefix like "s" matches most of the catalog and ranking all of it
+# takes hundreds of milliseconds, only the first matches in id order are ranked
+RANK_WINDOW = 1000
+
+_TERM = re.compile(r"[\w.]+")
+_DECIMAL = re.compile(r"^\d*\.\d+$")
+
+
+class SearchHit(NamedTuple):
+    kind: str
+    id: int
+    label: str
+
+
+def terms(text: str) -> List[str]:
+    """Words, numbers and line specs of a text: "0.3-150" is "0.3" and "150"."""
+    return [term.strip(".").lower() for term in _TERM.findall(text or "") if term.strip(".")]
+
+
+def _batches(ids: List[int]):
+    return (ids[start:start + BATCH_SIZE] for start in range(0, len(ids), BATCH_SIZE))
+
+
+def is_prefix(word: str) -> bool:
+    """Words are prefix matched, decimals exactly: "0.3" mustn't find the 0.35 mm lines."""
+    return not _DECIMAL.match(word)
+
+
+def doc_id(kind: str, object_id: int) -> int:
+    return object_id * 2 + KINDS.index(kind)
+
+
+class SqliteBackend:
+    """FTS5 table, prefix indexes make the prefix queries of every term an index lookup."""
+
+    def create(self, cursor):
+        cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5(body, label UNINDEXED, "
+                       "tokenize=\"unicode61 remove_diacritics 2 tokenchars '.'\", prefix='1 2 3')".format(TABLE))
+
+    def delete(self, cursor, ids: List[int]):
+        cursor.executemany("DELETE FROM {} WHERE rowid = %s".format(TABLE), [(pk,) for pk in ids])
+
+    def insert(self, cursor, docs: List[tuple]):
+        cursor.executemany("INSERT INTO {} (rowid, body, label) VALUES (%s, %s, %s)".format(TABLE), docs)
+
+    def match(self, words: List[str], kind: Optional[str]) -> Tuple[str, list]:
+        where = "" if kind is None else " AND rowid %% 2 = {:d}".format(KINDS.index(kind))
+        return "{0} MATCH %s{1}".format(TABLE, where), [
+            " ".join('"{}"{}'.format(word, "*" if is_prefix(word) else "") for word in words)]
+
+    def ids(self, words: List[str], kind: Optional[str]) -> Tuple[str, list]:
+        where, params = self.match(words, kind)
+        return "SELECT rowid / 2 FROM {} WHERE {}".format(TABLE, where), params
+
+    def query(self, cursor, words: List[str], kind: Optional[str], limit: int):
+        where, params = self.match(words, kind)
+        cursor.execute("SELECT rowid, label FROM (SELECT rowid, label, rank FROM {} WHERE {} "
+                       "LIMIT %s) ORDER BY rank LIMIT %s".format(TABLE, where),
+                       params + [max(RANK_WINDOW, limit), limit])
+        return cursor.fetchall()
+
+
+class PostgresBackend:
+    """Table with a tsvector of the same terms and a GIN index, the terms are prefix matched as well."""
+
+    def create(self, cursor):
+        cursor.execute("CREATE TABLE IF NOT EXISTS {} (id bigint PRIMARY KEY, label text NOT NULL, "
+                       "body tsvector NOT NULL)".format(TABLE))
+        cursor.execute("CREATE INDEX IF NOT EXISTS {0}_body_idx ON {0} USING gin (body)".format(TABLE))
+
+    def delete(self, cursor, ids: List[int]):
+        cursor.execute("DELETE FROM {} WHERE id = ANY(%s)".format(TABLE), [ids])
+
+    def insert(self, cursor, docs: List[tuple]):
+        cursor.executemany("INSERT INTO {} (id, body, label) VALUES (%s, to_tsvector('simple', %s), %s)".format(
+            TABLE), docs)
+
+    @staticmethod
+    def _tsquery(words: List[str]) -> str:
+        return " & ".join("'{}'{}".format(word, ":*" if is_prefix(word) else "") for word in words)
+
+    def ids(self, words: List[str], kind: Optional[str]) -> Tuple[str, list]:
+        where = "" if kind is None else " AND id %% 2 = {:d}".format(KINDS.index(kind))
+        return "SELECT id / 2 FROM {} WHERE body @@ to_tsquery('simple', %s){}".format(TABLE, where), [
+            self._tsquery(words)]
+
+    def query(self, cursor, words: List[str], kind: Optional[str], limit: int):
+        where = "" if kind is None else "AND id %% 2 = {:d}".format(KINDS.index(kind))
+        cursor.execute("SELECT id, label FROM (SELECT id, label, ts_rank(body, query) AS rank "
+                       "FROM {0}, to_tsquery('simple', %s) query WHERE body @@ query {1} LIMIT %s) matches "
+                       "ORDER BY rank DESC LIMIT %s".format(TABLE, where),
+                       [self._tsquery(words), max(RANK_WINDOW, limit), limit])
+        return cursor.fetchall()
+
+
+class SearchIndex:
+    """Full-text index of the spool and reducer names with their reel model, manufacturer, size and line.
+
+    migrate creates the table and fills it from the catalog (the post_migrate receiver calls create()),
+    the signal receivers keep it up to date with update() and delete(), rebuild_search_index fills it again.
+    """
+
+    def __init__(self, conn=connection):
+        self.connection = conn
+
+    @property
+    def backend(self):
+        return PostgresBackend() if self.connection.vendor == "postgresql" else SqliteBackend()
+
+    def _run(self, operation):
+        with transaction.atomic(using=self.connection.alias), self.connection.cursor() as cursor:
+            return operation(cursor)
+
+    def create(self) -> bool:
+        """Creates and fills the table if it doesn't exist."""
+        if TABLE in self.connection.introspection.table_names():
+            return False
+        self.rebuild()
+        return True
+
+    def rebuild(self) -> int:
+        with transaction.atomic(using=self.connection.alias), self.connection.cursor() as cursor:
+            cursor.execute("DROP TABLE IF EXISTS {}".format(TABLE))
+            self.backend.create(cursor)
+            count = 0
+            for kind, model in zip(KINDS, (SpoolModel, ReducerModel)):
+                for ids in _batches(list(model.objects.order_by('pk').values_list('pk', flat=True))):
+                    docs = self._docs(kind, ids)
+                    self.backend.insert(cursor, docs)
+                    count += len(docs)
+        return count
+
+    def update(self, spool_ids: Iterable[int] = (), reducer_ids: Iterable[int] = ()):
+        keys = [("spool", pk) for pk in set(spool_ids)] + [("reducer", pk) for pk in set(reducer_ids)]
+        if keys:
+            self._run(lambda cursor: self._write(cursor, keys))
+
+    def delete(self, spool_ids: Iterable[int] = (), reducer_ids: Iterable[int] = ()):
+        ids = [doc_id("spool", pk) for pk in spool_ids] + [doc_id("reducer", pk) for pk in reducer_ids]
+        if ids:
+            self._run(lambda cursor: self.backend.delete(cursor, ids))
+
+    def filter(self, queryset, text: str, kind: str):
+        """The rows of a spool/reducer queryset matching `text`, all of them, the queryset paginates them."""
+        words = terms(text)
+        if not words:
+            return queryset.none()
+        return queryset.filter(pk__in=RawSQL(*self.backend.ids(words, kind)))
+
+    def search(self, text: str, kind: Optional[str] = None, limit: int = 20) -> List[SearchHit]:
+        words = terms(text)
+        if not words:
+            return []
+        rows = self._run(lambda cursor: self.backend.query(cursor, words, kind, limit))
+        return [SearchHit(KINDS[pk % 2], pk // 2, label) for pk, label in rows]
+
+    def _write(self, cursor, keys):
+        for kind in KINDS:
+            for ids in _batches([pk for key_kind, pk in keys if key_kind == kind]):
+                self.backend.delete(cursor, [doc_id(kind, pk) for pk in ids])
+                self.backend.insert(cursor, self._docs(kind, ids))
+
+    @staticmethod
+    def _docs(kind: str, ids: List[int]) -> List[tuple]:
+        """(document id, body, label) of the spools/reducers that exist."""
+        if kind == "spool":
+            rows = SpoolModel.objects.filter(pk__in=ids).order_by().values_list(
+                'pk', 'reel_model__reel_manufacturer__name', 'reel_model__name', 'name', 'size', 'description')
+            docs = []
+            for pk, manufacturer, reel_model, name, size, description in rows:
+                label = "{} {} {}".format(manufacturer, reel_model, name or "").strip()
+                docs.append((doc_id(kind, pk), _body(label, size, description), label))
+            return docs
+        rows = ReducerModel.objects.filter(pk__in=ids).order_by().values_list(
+            'pk', 'spool_model__reel_model__reel_manufacturer__name', 'spool_model__reel_model__name',
+            'spool_model__name', 'spool_model__size', 'line__diameter', 'line__length', 'description')
+        docs = []
+        for pk, manufacturer, reel_model, name, size, diameter, length, description in rows:
+            label = "{} {} {} {}-{}".format(manufacturer, reel_model, name or "", diameter, length)
+            docs.append((doc_id(kind, pk), _body(label, size, description), label))
+        return docs
+
+
+def _body(label: str, size, description) -> str:
+    return " ".join(terms("{} {} {}".format(label, size or "", description or "")))
+
+
+search_index = SearchIndex()
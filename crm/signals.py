@@ -0,0 +1,275 @@
+import reversion
+from django.core.signals import request_started
+from django.db.models.signals import post_delete, post_init, post_migrate, post_save, pre_delete, pre_save
+from django.db import connections, transaction
+from django.dispatch import Signal, receiver
+from django.test.signals import setting_changed
+
+from crm.api import invalidate_manufacturers
+from crm.catalog import catalog_cache
+from crm.names import item_name, reducer_name, spool_name, update_item_names, update_reducer_names, \
+    update_spool_names
+from crm import revisions
+from crm.search import SearchIndex, search_index
+from crm.models import CatalogChange, ExchangeRate, OrderBucket, OrderGroup, OrderItem, Price, SpoolModel, SpoolDimension, \
+    ReducerModel, ReducerDimension, Line, SpoolModelImage, ReducerModelImage, ReelManufacturer, ReelModel
+from crm.thumbnails import schedule_thumbnails
+from crm.totals import update_bucket_totals, update_group_totals
+
+# sent by writes that bypass the model signals (bulk inserts, queryset updates) of catalog rows,
+# with the `manufacturer_ids` and `spool_ids` they touched and `lines` when lines were added
+catalog_bulk_changed = Signal()
+
+
+@receiver(post_init, sender=OrderItem)
+def remember_item_order(sender, instance, **kwargs):
+    instance._loaded_order_id = instance.order_id
+
+
+@receiver(post_init, sender=OrderBucket)
+def remember_bucket_group(sender, instance, **kwargs):
+    instance._loaded_order_group_id = instance.order_group_id
+
+
+@receiver(post_save, sender=OrderItem)
+@receiver(post_delete, sender=OrderItem)
+def item_changed(sender, instance, **kwargs):
+    update_bucket_totals({instance.order_id, instance._loaded_order_id} - {None})
+    instance._loaded_order_id = instance.order_id
+
+
+@receiver(post_save, sender=Price)
+def price_changed(sender, instance, created, **kwargs):
+    if not created:
+        update_bucket_totals(OrderItem.objects.filter(price=instance).values('order'))
+
+
+@receiver(post_save, sender=OrderBucket)
+@receiver(post_delete, sender=OrderBucket)
+def bucket_changed(sender, instance, **kwargs):
+    # save() writes the total loaded with the instance back, so the bucket itself is recalculated as well
+    group_ids = {instance.order_group_id, instance._loaded_order_group_id} - {None}
+    if 'created' in kwargs:
+        update_bucket_totals([instance.pk])
+        group_ids.discard(instance.order_group_id)
+    if group_ids:
+        update_group_totals(group_ids)
+    instance._loaded_order_group_id = instance.order_group_id
+
+
+@receiver(post_save, sender=OrderGroup)
+def group_saved(sender, instance, **kwargs):
+    update_group_totals([instance.pk])
+
+
+@receiver(post_save, sender=ExchangeRate)
+@receiver(post_delete, sender=ExchangeRate)
+def rate_changed(sender, instance, **kwargs):
+    update_bucket_totals(OrderItem.objects.filter(price__currency=instance.currency).values('order'))
+
+
+@receiver(pre_save, sender=SpoolModel)
+@receiver(pre_save, sender=ReducerModel)
+@receiver(pre_save, sender=OrderItem)
+def set_display_name(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    if sender is SpoolModel:
+        instance.display_name = spool_name(instance.reel_model_id, instance.name)
+    elif sender is ReducerModel:
+        instance.display_name = reducer_name(instance.spool_model_id, instance.line_id)
+    else:
+        instance.display_name = item_name(instance.reducer_model_id, instance.amount, instance.price_id)
+
+
+@receiver(post_save, sender=ReelManufacturer)
+@receiver(post_save, sender=ReelModel)
+@receiver(post_save, sender=SpoolModel)
+@receiver(post_save, sender=Line)
+@receiver(post_save, sender=ReducerModel)
+@receiver(post_save, sender=Price)
+def display_name_parts_changed(sender, instance, created, raw=False, **kwargs):
+    # a new row has no children yet, a saved one may have been renamed
+    if created or raw:
+        return
+    if sender is ReelManufacturer:
+        update_spool_names(SpoolModel.objects.filter(reel_model__reel_manufacturer=instance.pk))
+    elif sender is ReelModel:
+        update_spool_names(SpoolModel.objects.filter(reel_model=instance.pk))
+    elif sender is SpoolModel:
+        update_reducer_names(ReducerModel.objects.filter(spool_model=instance.pk))
+    elif sender is Line:
+        update_reducer_names(ReducerModel.objects.filter(line=instance.pk))
+    elif sender is ReducerModel:
+        update_item_names(OrderItem.objects.filter(reducer_model=instance.pk))
+    else:
+        update_item_names(OrderItem.objects.filter(price=instance.pk))
+
+
+@receiver(post_save, sender=SpoolModelImage)
+@receiver(post_save, sender=ReducerModelImage)
+def image_saved(sender, instance, **kwargs):
+    if instance.image and instance.image_hash:
+        schedule_thumbnails(instance.image.name, instance.image_hash, instance.image.storage)
+
+
+# path from every catalog model to the manufacturer its API payload is cached under
+_MANUFACTURER_PATHS = {
+    ReelManufacturer: 'pk',
+    ReelModel: 'reel_manufacturer_id',
+    SpoolModel: 'reel_model__reel_manufacturer_id',
+    SpoolDimension: 'spool_model__reel_model__reel_manufacturer_id',
+    SpoolModelImage: 'spool_model__reel_model__reel_manufacturer_id',
+    ReducerModel: 'spool_model__reel_model__reel_manufacturer_id',
+    ReducerDimension: 'reducer_model__spool_model__reel_model__reel_manufacturer_id',
+    ReducerModelImage: 'reducer_model__spool_model__reel_model__reel_manufacturer_id',
+}
+
+
+def _stored_manufacturers(sender, pk):
+    if pk is None:
+        return set()
+    return set(sender.objects.filter(pk=pk).values_list(_MANUFACTURER_PATHS[sender], flat=True))
+
+
+def _invalidate_api(manufacturer_ids, index=False):
+    # again after the commit, a request in between may have cached the data of the open transaction
+    invalidate_manufacturers(manufacturer_ids, index)
+    transaction.on_commit(lambda: invalidate_manufacturers(manufacturer_ids, index))
+
+
+def _remember_manufacturers(sender, instance, **kwargs):
+    # the row may move to another manufacturer, the payload it leaves is invalidated as well
+    instance._api_manufacturer_ids = _stored_manufacturers(sender, instance.pk)
+
+
+def _catalog_saved(sender, instance, **kwargs):
+    manufacturer_ids = getattr(instance, '_api_manufacturer_ids', set()) | _stored_manufacturers(sender, instance.pk)
+    _invalidate_api(manufacturer_ids, index=sender in (ReelManufacturer, ReelModel))
+
+
+def _catalog_deleted(sender, instance, **kwargs):
+    _invalidate_api(getattr(instance, '_api_manufacturer_ids', set()), index=sender in (ReelManufacturer, ReelModel))
+
+
+for _model in _MANUFACTURER_PATHS:
+    pre_save.connect(_remember_manufacturers, sender=_model, dispatch_uid="api_pre_save")
+    pre_delete.connect(_remember_manufacturers, sender=_model, dispatch_uid="api_pre_delete")
+    post_save.connect(_catalog_saved, sender=_model, dispatch_uid="api_post_save")
+    post_delete.connect(_catalog_deleted, sender=_model, dispatch_uid="api_post_delete")
+
+
+@receiver(post_save, sender=Line)
+def line_saved(sender, instance, created, **kwargs):
+    if not created:
+        _invalidate_api(set(ReducerModel.objects.filter(line=instance).order_by()
+                            .values_list(_MANUFACTURER_PATHS[ReducerModel], flat=True).distinct()))
+
+
+@receiver(catalog_bulk_changed)
+def catalog_bulk_written(sender, manufacturer_ids=(), spool_ids=(), lines=False, **kwargs):
+    _invalidate_api(set(manufacturer_ids), index=True)
+    spool_ids = set(spool_ids)
+    search_index.update(spool_ids,
+                        ReducerModel.objects.filter(spool_model_id__in=spool_ids).values_list('pk', flat=True))
+    _invalidate_catalog_cache()
+
+
+def _invalidate_catalog_cache(**kwargs):
+    # again after the commit, another worker may have cached the tree before the commit
+    catalog_cache.invalidate()
+    transaction.on_commit(catalog_cache.invalidate)
+
+
+for _model in (ReelManufacturer, ReelModel, SpoolModel, ReducerModel, Line, Price):
+    post_save.connect(_invalidate_catalog_cache, sender=_model, dispatch_uid="catalog_cache_post_save")
+    post_delete.connect(_invalidate_catalog_cache, sender=_model, dispatch_uid="catalog_cache_post_delete")
+
+# the generation is read once per request
+request_started.connect(catalog_cache.expire, dispatch_uid="catalog_cache_request_started")
+
+
+@receiver(setting_changed)
+def catalog_cache_dir_changed(setting, **kwargs):
+    if setting == "CRM_CATALOG_CACHE_DIR":
+        catalog_cache.expire()
+
+
+# record of the delta sync every catalog model is logged as: kind and the attribute with the record id
+_CHANGE_KINDS = {
+    ReelManufacturer: (CatalogChange.Kind.MANUFACTURER, 'pk'),
+    ReelModel: (CatalogChange.Kind.REEL_MODEL, 'pk'),
+    SpoolModel: (CatalogChange.Kind.SPOOL, 'pk'),
+    SpoolDimension: (CatalogChange.Kind.SPOOL, 'spool_model_id'),
+    SpoolModelImage: (CatalogChange.Kind.SPOOL, 'spool_model_id'),
+    ReducerModel: (CatalogChange.Kind.REDUCER, 'pk'),
+    ReducerDimension: (CatalogChange.Kind.REDUCER, 'reducer_model_id'),
+    ReducerModelImage: (CatalogChange.Kind.REDUCER, 'reducer_model_id'),
+    Line: (CatalogChange.Kind.LINE, 'pk'),
+}
+
+
+def _log_change(sender, instance, **kwargs):
+    kind, attr = _CHANGE_KINDS[sender]
+    # only the records themselves leave tombstones, a deleted dimension/image changes its record
+    deleted = 'created' not in kwargs and attr == 'pk'
+    ids = [getattr(instance, attr)]
+    if attr != 'pk':
+        ids.append(getattr(instance, '_loaded_owner_id', None))
+        instance._loaded_owner_id = ids[0]
+    CatalogChange.record(kind, set(ids) - {None}, deleted=deleted)
+
+
+def _remember_owner(sender, instance, **kwargs):
+    # a dimension/image moved to another spool/reducer changes both
+    instance._loaded_owner_id = getattr(instance, _CHANGE_KINDS[sender][1])
+
+
+for _model in _CHANGE_KINDS:
+    post_save.connect(_log_change, sender=_model, dispatch_uid="catalog_change_post_save")
+    post_delete.connect(_log_change, sender=_model, dispatch_uid="catalog_change_post_delete")
+    if _CHANGE_KINDS[_model][1] != 'pk':
+        post_init.connect(_remember_owner, sender=_model, dispatch_uid="catalog_change_post_init")
+
+
+@receiver(post_save, sender=ReelManufacturer)
+@receiver(post_save, sender=ReelModel)
+@receiver(post_save, sender=SpoolModel)
+@receiver(post_save, sender=ReducerModel)
+@receiver(post_save, sender=Line)
+def search_text_changed(sender, instance, created, **kwargs):
+    # the documents contain the names of the parents and the line, a rename reindexes everything below
+    if sender is ReducerModel:
+        return search_index.update(reducer_ids=[instance.pk])
+    if created and sender is not SpoolModel:
+        return
+    if sender is Line:
+        spools, reducers = SpoolModel.objects.none(), ReducerModel.objects.filter(line=instance)
+    else:
+        path = {ReelManufacturer: 'reel_model__reel_manufacturer', ReelModel: 'reel_model', SpoolModel: 'pk'}[sender]
+        spools = SpoolModel.objects.filter(**{path: instance.pk})
+        reducers = ReducerModel.objects.filter(**{'spool_model__' + path: instance.pk})
+    search_index.update(spools.values_list('pk', flat=True), reducers.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=SpoolModel)
+@receiver(post_delete, sender=ReducerModel)
+def search_document_deleted(sender, instance, **kwargs):
+    if sender is SpoolModel:
+        search_index.delete(spool_ids=[instance.pk])
+    else:
+        search_index.delete(reducer_ids=[instance.pk])
+
+
+@receiver(post_migrate)
+def create_search_index(sender, app_config, using, **kwargs):
+    # the crm migrations are generated on every install (clean_db.sh), the search table can't be one of them
+    if app_config.label == "crm":
+        SearchIndex(connections[using]).create()
+
+
+@receiver(post_save)
+def capture_revision_object(sender, instance, **kwargs):
+    # the post_save receiver of reversion, for the revisions queued by crm.revisions.deferred_revision
+    if revisions.is_capturing() and reversion.is_registered(sender):
+        revisions.capture(instance)
@@ -0,0 +1,32 @@
+import os
+import tempfile
+import zipfile
+from typing import Dict, Optional
+
+import numpy as np
+
+from crm.catalog import catalog_cache
+
+
+def snapshot_path(name: str) -> str:
+    """A snapshot file of the current database, next to the catalog snapshots."""
+    return os.path.join(catalog_cache.directory, name)
+
+
+def save_arrays(path: str, **arrays: np.ndarray):
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, 'wb') as fh:
+        np.savez(fh, **arrays)
+    # the rename is atomic, a reader opens either no file or a complete one
+    os.replace(tmp_name, path)
+
+
+def load_arrays(path: str) -> Optional[Dict[str, np.ndarray]]:
+    """The arrays saved by save_arrays(), None when the file is missing or unreadable."""
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            return {name: data[name] for name in data.files}
+    except (OSError, ValueError, EOFError, zipfile.BadZipFile):
+        return None
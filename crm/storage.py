@@ -0,0 +1,77 @@
+import os
+import time
+from typing import Optional
+
+from django.apps import apps
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+from crm.thumbnails import THUMBNAIL_DIR, content_hash
+
+IMAGE_MODELS = ("SpoolModelImage", "ReducerModelImage")
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """Stores every file once, under the sha256 of its content: `<prefix>/<ab>/<sha256>.<ext>`.
+
+    The upload_to directory and the file name of the upload are ignored, saving content that is
+    stored already returns the name of the existing blob without writing anything, it only touches it.
+    A blob can be shared by several rows, nothing deletes it when a row lets go of it: the request that
+    uploads the same content may be about to commit a row that references it. `dedupe_images --prune`
+    deletes the blobs that no row references and that weren't saved for a grace period.
+    Names that are addressed already (blobs and the thumbnails derived from them) are saved as they are.
+    """
+
+    def __init__(self, prefix="images", **kwargs):
+        self.prefix = prefix
+        super().__init__(**kwargs)
+
+    def blob_name(self, digest: str, ext: str) -> str:
+        return "{}/{}/{}{}".format(self.prefix, digest[:2], digest, ext.lower())
+
+    def addressed(self, name: str) -> bool:
+        return name.startswith(self.prefix + "/") or os.path.basename(os.path.dirname(name)) == THUMBNAIL_DIR
+
+    def save(self, name, content, max_length=None):
+        if self.addressed(name):
+            return super().save(name, content, max_length)
+        if not hasattr(content, "chunks"):
+            content = File(content, name)
+        name = self.blob_name(content_hash(content), os.path.splitext(name)[1])
+        if self.exists(name):
+            # the mtime is the last save, a prune spares the blob until the row of this upload committed
+            os.utime(self.path(name))
+            return name
+        saved = super().save(name, content, max_length)
+        if saved != name:
+            # another process stored the same content in the meantime, the copy isn't needed
+            super().delete(saved)
+        return name
+
+    def digest(self, name: str) -> str:
+        return os.path.splitext(os.path.basename(name))[0]
+
+    def blob_digest(self, name: str) -> Optional[str]:
+        """The content hash of a blob name, None for the other names."""
+        return self.digest(name) if name.startswith(self.prefix + "/") else None
+
+
+image_storage = ContentAddressedStorage()
+
+
+def unreferenced(names):
+    """Names that no image row references, in one query per image model."""
+    names = set(names) - {""}
+    referenced = set()
+    for model in IMAGE_MODELS:
+        referenced.update(apps.get_model("crm", model).objects.filter(image__in=names)
+                          .values_list("image", flat=True))
+    return names - referenced
+
+
+def prunable(names, grace: float, storage=image_storage):
+    """The blobs of `names` saved more than `grace` seconds ago that no image row references."""
+    saved_before = time.time() - grace
+    return {name for name in unreferenced(names) if os.path.getmtime(storage.path(name)) < saved_before}
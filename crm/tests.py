@@ -1,3 +1,1497 @@
-from django.test import TestCase
+import hashlib
+import json
+import multiprocessing
+import os
+import queue
+import shutil
+import tempfile
+import time
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from io import BytesIO, StringIO
+from itertools import chain
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, OperationalError, connection, transaction
+from unittest import mock, skipUnless
+
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+import numpy as np
+from PIL import Image
+import reversion
+from reversion.models import Revision, Version
+
+from crm import api, thumbnails
+from crm.capacity import PACKING, CapacityMatrix, fill_volume, line_capacity, reducer_fill_volume
+from crm.catalog import CatalogCache
+from crm.db import update_statistics
+from crm.export import CONTENT_TYPES
+from crm.fit import FitIndex
+from crm.importer import CsvSource, ImportRecordError, parse_jobs
+from crm.ids import NameGenerator
+from crm.orders import duplicate_group, update_orders
+from crm.revisions import RevisionQueue
+from crm.models import Line, ReelManufacturer, ReelModel, SpoolModel, SpoolDimension, ReducerModel, ReducerDimension, \
+    OrderBucket, OrderGroup, OrderItem, Price, ExchangeRate, SpoolModelImage, CatalogChange, ImportCheckpoint, \
+    ImportFingerprint, CompactRevision, VersionCopy, order_name
+from crm.search import search_index
+from crm.signals import catalog_bulk_changed
+from crm.storage import ContentAddressedStorage, image_storage
+from crm.thumbnails import content_hash, make_thumbnails, thumbnail_name
+
+
+_catalog_cache_dir = None
+
+
+def setUpModule():
+    # the snapshots of the test databases stay out of the real CRM_CATALOG_CACHE_DIR
+    global _catalog_cache_dir
+    _catalog_cache_dir = override_settings(CRM_CATALOG_CACHE_DIR=tempfile.mkdtemp())
+    _catalog_cache_dir.enable()
+
+
+def tearDownModule():
+    _catalog_cache_dir.disable()
+    shutil.rmtree(_catalog_cache_dir.options["CRM_CATALOG_CACHE_DIR"], ignore_errors=True)
+
+
+def create_catalog(spools=10, lines=3):
+    manufacturer = ReelManufacturer.objects.create(name="Shimano")
+    reel_model = ReelModel.objects.create(reel_manufacturer=manufacturer, name="Stradic")
+    line_objs = [Line.objects.create(length=100 + i * 50, diameter=0.1 * (i + 1)) for i in range(lines)]
+    for i in range(spools):
+        spool = SpoolModel.objects.create(reel_model=reel_model, name="C{}".format(1000 + i))
+        SpoolDimension.objects.create(spool_model=spool, D1=50 + i, D2=40, H1=10, actual=True)
+        for line in line_objs:
+            reducer = ReducerModel.objects.create(spool_model=spool, line=line)
+            ReducerDimension.objects.create(reducer_model=reducer, D3=45, D4=42 + i, H2=9, actual=True)
+
+
+class ReducerModelChangelistTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_catalog(spools=20)
+        cls.user = User.objects.create_superuser("admin", "admin@example.com", "admin")
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.model_admin = admin.site._registry[ReducerModel]
+        self.url = reverse("admin:crm_reducermodel_changelist")
+
+    def _count_queries(self, per_page, params=None):
+        self.model_admin.list_per_page = per_page
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(self.url, params or {})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context["cl"].result_list), per_page)
+        return len(ctx)
+
+    def tearDown(self):
+        self.model_admin.list_per_page = admin.ModelAdmin.list_per_page
+
+    def test_query_count_is_flat(self):
+        self.assertEqual(self._count_queries(5), self._count_queries(50))
+
+    def test_dimensions_are_annotated(self):
+        self.model_admin.list_per_page = 100
+        response = self.client.get(self.url, {"o": "3"})
+        reducers = response.context["cl"].result_list
+        self.assertEqual([r.spool_d1 for r in reducers], sorted(r.spool_d1 for r in reducers))
+        self.assertTrue(all(r.reducer_h2 == 9 for r in reducers))
+
+    def test_filter_by_dimension(self):
+        self.model_admin.list_per_page = 100
+        response = self.client.get(self.url, {"spool_d1": "50.0-52.0"})
+        self.assertEqual(len(response.context["cl"].result_list), 3 * 3)
+
+
+@skipUnless(connection.vendor == "sqlite", "EXPLAIN QUERY PLAN output of SQLite")
+class QueryPlanTest(TestCase):
+    """The hot admin queries are served by indexes, without full scans or temporary sorts."""
+
+    @classmethod
+    def setUpTestData(cls):
+        create_catalog(spools=5)
+        cls.user = User.objects.create_superuser("admin", "admin@example.com", "admin")
+        cls.create_large_catalog()
+        # the plans depend on the table sizes, as after an import
+        update_statistics(connection)
+
+    @staticmethod
+    def create_large_catalog(manufacturers=20, reel_models=10, spools=10):
+        ReelManufacturer.objects.bulk_create(ReelManufacturer(name="M{}".format(i)) for i in range(manufacturers))
+        ReelModel.objects.bulk_create(ReelModel(reel_manufacturer=manufacturer, name="R{}".format(i))
+                                      for manufacturer in ReelManufacturer.objects.all() for i in range(reel_models))
+        SpoolModel.objects.bulk_create(SpoolModel(reel_model=reel_model, name="S{}".format(i))
+                                       for reel_model in ReelModel.objects.filter(name__startswith="R")
+                                       for i in range(spools))
+        lines = list(Line.objects.all())
+        ReducerModel.objects.bulk_create(ReducerModel(spool_model=spool, line=line)
+                                         for spool in SpoolModel.objects.filter(name__startswith="S") for line in lines)
+        price = Price.objects.create(price=10, currency=settings.CRM_REPORTING_CURRENCY)
+        OrderGroup.objects.bulk_create(OrderGroup(name="G{}".format(i)) for i in range(manufacturers))
+        OrderBucket.objects.bulk_create(OrderBucket(order_group=group, name="{}-{}".format(group.name, i))
+                                        for group in OrderGroup.objects.all() for i in range(reel_models))
+        reducers = list(ReducerModel.objects.values_list('pk', flat=True)[:spools])
+        OrderItem.objects.bulk_create(OrderItem(order=order, reducer_model_id=reducer, price=price)
+                                      for order in OrderBucket.objects.all() for reducer in reducers)
+
+    def assertIndexed(self, qs):
+        sql, params = qs.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+            plan = [row[-1] for row in cursor.fetchall()]
+        for step in plan:
+            # the reducers of a spool model are sorted by line, a join no index covers: only the few rows
+            # of a spool model are sorted at a time ("RIGHT PART"), the walk still stops at LIMIT
+            if step != "USE TEMP B-TREE FOR RIGHT PART OF ORDER BY":
+                self.assertNotIn("TEMP B-TREE", step, msg="{}\n{}".format(sql, "\n".join(plan)))
+            if " WHERE " in sql:
+                # a plain scan without a filter streams the rows in rowid order, LIMIT stops it
+                self.assertNotRegex(step, r"^SCAN \S+$", msg="{}\n{}".format(sql, "\n".join(plan)))
+
+    def test_changelists(self):
+        request = RequestFactory().get("/")
+        request.user = self.user
+        for model, model_admin in admin.site._registry.items():
+            if model._meta.app_label != "crm":
+                continue
+            with self.subTest(model=model.__name__):
+                changelist = model_admin.get_changelist_instance(request)
+                self.assertIndexed(changelist.queryset[:model_admin.list_per_page])
+
+    def test_inlines_and_lookups(self):
+        self.assertIndexed(OrderBucket.objects.filter(order_group_id=1, sent=False))
+        self.assertIndexed(OrderBucket.objects.filter(order_group_id=1, sent=True))
+        self.assertIndexed(ReducerModel.objects.filter(spool_model_id=1))
+        self.assertIndexed(SpoolDimension.objects.filter(spool_model_id=1, actual=False))
+        self.assertIndexed(ReducerDimension.objects.filter(reducer_model_id=1, actual=False))
+
+
+@skipUnless(connection.vendor == "sqlite", "SQLite pragmas")
+class SqlitePragmaTest(TestCase):
+    def test_pragmas_are_applied(self):
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA synchronous")
+            self.assertEqual(cursor.fetchone()[0], 1)  # NORMAL
+            cursor.execute("PRAGMA busy_timeout")
+            self.assertEqual(cursor.fetchone()[0], settings.CRM_SQLITE_PRAGMAS["busy_timeout"])
+
+
+class BenchmarkOrdersTest(TransactionTestCase):
+    def test_benchmark_leaves_no_rows(self):
+        create_catalog(spools=1, lines=1)
+        out = StringIO()
+        call_command("benchmark_orders", "--workers", "2", "--orders", "2", stdout=out, stderr=StringIO())
+        self.assertIn("orders/s", out.getvalue())
+        self.assertFalse(Price.objects.exists())
+        self.assertFalse(OrderGroup.objects.exists())
+        self.assertFalse(OrderItem.objects.exists())
+
+
+class ActualDimensionTest(TestCase):
+    def setUp(self):
+        create_catalog(spools=1, lines=1)
+        self.spool = SpoolModel.objects.get()
+
+    def test_pointer_follows_actual_dimension(self):
+        first = self.spool.spooldimension_set.get()
+        second = SpoolDimension.objects.create(spool_model=self.spool, D1=60, D2=40, H1=10, actual=True)
+        first.refresh_from_db()
+        self.spool.refresh_from_db()
+        self.assertFalse(first.actual)
+        self.assertEqual(self.spool.actual_dimension, second)
+
+        second.actual = False
+        second.save()
+        self.spool.refresh_from_db()
+        self.assertIsNone(self.spool.actual_dimension)
+
+    def test_one_actual_dimension_per_model(self):
+        with self.assertRaises(IntegrityError):
+            SpoolDimension.objects.filter(spool_model=self.spool).update(actual=False)
+            SpoolDimension.objects.bulk_create([SpoolDimension(spool_model=self.spool, actual=True) for _ in range(2)])
+
+
+class OrderTotalsTest(TestCase):
+    def setUp(self):
+        create_catalog(spools=1, lines=1)
+        self.reducer = ReducerModel.objects.get()
+        self.price = Price.objects.create(price=100)
+        self.group = OrderGroup.objects.create(name="group")
+        self.bucket = OrderBucket.objects.create(name="order", order_group=self.group)
+
+    def assertTotals(self, bucket_total, group_total):
+        self.bucket.refresh_from_db()
+        self.group.refresh_from_db()
+        self.assertEqual((self.bucket.total, self.group.total), (bucket_total, group_total))
+
+    def test_totals_follow_items_and_prices(self):
+        item = OrderItem.objects.create(order=self.bucket, reducer_model=self.reducer, price=self.price, amount=2)
+        OrderItem.objects.create(order=self.bucket, reducer_model=self.reducer, price=self.price, amount=1)
+        self.assertTotals(300, 300)
+        self.assertEqual(self.bucket.get_order_sum(), 300)
+
+        self.price.price = 50
+        self.price.save()
+        self.assertTotals(150, 150)
+
+        item.delete()
+        self.assertTotals(50, 50)
+
+    def test_moving_bucket_updates_both_groups(self):
+        OrderItem.objects.create(order=self.bucket, reducer_model=self.reducer, price=self.price, amount=2)
+        other = OrderGroup.objects.create(name="other")
+        self.bucket.order_group = other
+        self.bucket.save()
+        other.refresh_from_db()
+        self.assertTotals(200, 0)
+        self.assertEqual(other.total, 200)
+
+    def test_totals_convert_currencies(self):
+        usd = Price.objects.create(price=10, currency=Price.Currency.USD)
+        OrderItem.objects.create(order=self.bucket, reducer_model=self.reducer, price=self.price, amount=1)
+        # a USD item without a USD rate would drop out of the totals
+        with self.assertRaisesMessage(ValidationError, "No exchange rate of USD"):
+            OrderItem(order=self.bucket, reducer_model=self.reducer, price=usd, amount=2).full_clean()
+
+        rate = ExchangeRate.objects.create(currency=Price.Currency.USD, date=date(2000, 1, 1), rate=40)
+        OrderItem.objects.create(order=self.bucket, reducer_model=self.reducer, price=usd, amount=2)
+        self.assertTotals(900, 900)
+        self.assertEqual(self.bucket.get_currency_totals(), [
+            {"price__currency": "UAH", "total": 100, "converted": 100.0},
+            {"price__currency": "USD", "total": 20, "converted": 800.0},
+        ])
+        rate.currency = Price.Currency.EUR
+        with self.assertRaisesMessage(ValidationError, "The orders in USD need an exchange rate"):
+            rate.full_clean()
+
+        # the admin refuses to delete the last rate, alone or in the delete action
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "admin"))
+        response = self.client.post(reverse("admin:crm_exchangerate_delete", args=[rate.pk]), {"post": "yes"})
+        self.assertContains(response, "The orders in USD need an exchange rate")
+        other = ExchangeRate.objects.create(currency=Price.Currency.USD, date=date(2001, 1, 1), rate=41)
+        response = self.client.post(reverse("admin:crm_exchangerate_changelist"), {
+            "action": "delete_selected", "_selected_action": [rate.pk, other.pk], "post": "yes"})
+        self.assertContains(response, "The orders in USD need an exchange rate")
+        self.assertEqual(ExchangeRate.objects.count(), 2)
+        self.client.post(reverse("admin:crm_exchangerate_delete", args=[rate.pk]), {"post": "yes"})
+        self.assertEqual(list(ExchangeRate.objects.all()), [other])
+
+    def test_totals_use_the_rate_of_the_day_the_order_was_placed(self):
+        ExchangeRate.objects.create(currency=Price.Currency.USD, date=date(2020, 1, 1), rate=30)
+        ExchangeRate.objects.create(currency=Price.Currency.USD, date=date(2021, 1, 1), rate=40)
+        usd = Price.objects.create(price=10, currency=Price.Currency.USD)
+        OrderItem.objects.create(order=self.bucket, reducer_model=self.reducer, price=usd, amount=1)
+        self.assertTotals(400, 400)
+
+        self.bucket.placed = date(2020, 6, 1)
+        self.bucket.save()
+        self.assertTotals(300, 300)
+        # saving the order again keeps its rate
+        self.bucket.description = "changed"
+        self.bucket.save()
+        self.assertTotals(300, 300)
+        # an order placed before the first rate is converted at that rate, not dropped
+        self.bucket.placed = date(2010, 1, 1)
+        self.bucket.save()
+        self.assertTotals(300, 300)
+
+
+class FitIndexTest(TestCase):
+    def setUp(self):
+        create_catalog(spools=5, lines=2)
+        self.index = FitIndex()
+
+    def test_nearest_fit(self):
+        fits = self.index.search((52.2, 40, 10), (100, 0.1), tolerance=1, limit=2)
+        self.assertEqual([fit.spool for fit in fits], [(52.0, 40.0, 10.0), (53.0, 40.0, 10.0)])
+        self.assertTrue(all(fit.line == (100, 0.1) for fit in fits))
+        self.assertEqual(self.index.search((70, 40, 10)), [])
+
+    def test_refresh_after_dimension_change(self):
+        self.index.load()
+        spool = SpoolModel.objects.get(name="C1000")
+        SpoolDimension.objects.create(spool_model=spool, D1=70, D2=40, H1=10, actual=True)
+        # the two reducers of the spool are read again, not the other eight
+        self.assertEqual(self.index.refresh(), 2)
+        self.assertEqual(self.index.refresh(), 0)
+        fits = self.index.search_many([(70, 40, 10), (50, 40, 10)], [None, None], tolerance=0.5, limit=5)
+        self.assertEqual(len(fits[0]), 2)
+        self.assertEqual(fits[1], [])
+        self.assertEqual(len(self.index.ids), 10)
+
+        reducer = ReducerModel.objects.get(spool_model=spool, line__length=100)
+        reducer.delete()
+        Line.objects.filter(pk=reducer.line_id).update(diameter=0.15)
+        self.assertEqual(self.index.refresh(), 0)
+        Line.objects.get(pk=reducer.line_id).save()
+        self.assertEqual(self.index.refresh(), 4)
+        self.assertEqual(sorted(self.index.ids.tolist()), sorted(ReducerModel.objects.values_list('pk', flat=True)))
+        self.assertEqual(self.index.search((53, 40, 10), (0, 0.15), tolerance=0.1)[0].line, (100, 0.15))
+
+    def test_snapshot(self):
+        path = os.path.join(tempfile.mkdtemp(), FitIndex.SNAPSHOT)
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        self.assertFalse(FitIndex.open(path)._loaded)
+        self.index.save(path)
+        SpoolDimension.objects.create(spool_model=SpoolModel.objects.get(name="C1004"), D1=60, D2=40, H1=10,
+                                      actual=True)
+        index = FitIndex.open(path)
+        self.assertEqual(len(index.ids), 10)
+        with self.assertNumQueries(2):
+            # the changes since the snapshot and the two rows of the spool
+            self.assertEqual(index.refresh(), 2)
+        self.assertEqual(len(index.search((60, 40, 10), limit=5)), 2)
+
+        CatalogChange.objects.all().delete()
+        self.assertFalse(FitIndex.open(path)._loaded)
+
+class CapacityTest(TestCase):
+    def setUp(self):
+        create_catalog(spools=2, lines=2)
+        self.matrix = CapacityMatrix()
+
+    def test_capacity(self):
+        # 0.1 mm line between 50 and 40 mm over 10 mm
+        self.assertAlmostEqual(float(line_capacity(50, 40, 10, 0.1)), PACKING * (50 ** 2 - 40 ** 2) * 10 / 0.01 / 1000)
+        self.assertEqual(float(line_capacity(40, 50, 10, 0.1)), 0)
+        self.assertAlmostEqual(float(fill_volume(50, 40, 10)), np.pi / 4 * (50 ** 2 - 40 ** 2) * 10 / 1000)
+        self.assertAlmostEqual(float(reducer_fill_volume(50, 10, 45, 9, 1)), float(fill_volume(48, 45, 9)))
+
+    def test_matrix_reads_the_current_dimensions(self):
+        self.matrix.load()
+        self.assertEqual(self.matrix.spools.shape, (2, 2))
+        self.assertEqual(self.matrix.reducers.shape, (4, 2))
+        spool = SpoolModel.objects.get(name="C1000")
+        SpoolDimension.objects.create(spool_model=spool, D1=60, D2=40, H1=10, actual=True)
+        self.matrix.load()
+        row = list(self.matrix.spool_rows[:, 0]).index(spool.pk)
+        self.assertAlmostEqual(self.matrix.spools[row, 0], float(line_capacity(60, 40, 10, 0.1)))
+        self.assertEqual(self.matrix.reducers.shape, (4, 2))
+
+    def test_refresh_recomputes_the_changed_rows(self):
+        self.matrix.load()
+        spool = SpoolModel.objects.get(name="C1000")
+        SpoolDimension.objects.create(spool_model=spool, D1=60, D2=40, H1=10, actual=True)
+        # the spool and its two reducers
+        self.assertEqual(self.matrix.refresh(), 3)
+        self.assertEqual(self.matrix.refresh(), 0)
+        self.assertEqual(self.matrix.spool_rows[:, 0].tolist(), sorted(self.matrix.spool_rows[:, 0].tolist()))
+        row = self.matrix.spool_rows[:, 0].tolist().index(spool.pk)
+        self.assertAlmostEqual(self.matrix.spool_volumes[row], float(fill_volume(60, 40, 10)))
+        self.assertAlmostEqual(self.matrix.spools[row, 0], float(line_capacity(60, 40, 10, 0.1)))
+
+        line = Line.objects.get(diameter=0.2)
+        line.diameter = 0.3
+        line.save()
+        with self.assertNumQueries(2):
+            # the changes and the lines, the dimensions aren't read again
+            self.assertEqual(self.matrix.refresh(), 0)
+        expected = CapacityMatrix()
+        expected.load()
+        for name in CapacityMatrix._ARRAYS:
+            np.testing.assert_array_equal(getattr(self.matrix, name), getattr(expected, name))
+
+        ReducerModel.objects.filter(spool_model=spool).first().delete()
+        self.assertEqual(self.matrix.refresh(), 0)
+        self.assertEqual(self.matrix.reducers.shape, (3, 2))
+
+    def test_snapshot(self):
+        path = os.path.join(tempfile.mkdtemp(), CapacityMatrix.SNAPSHOT)
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        self.matrix.save(path)
+        SpoolDimension.objects.create(spool_model=SpoolModel.objects.get(name="C1001"), D1=60, D2=40, H1=10,
+                                      actual=True)
+        matrix = CapacityMatrix.open(path)
+        self.assertEqual(matrix.refresh(), 3)
+        self.matrix.load()
+        for name in CapacityMatrix._ARRAYS:
+            np.testing.assert_array_equal(getattr(matrix, name), getattr(self.matrix, name))
+
+
+class ThumbnailTest(TestCase):
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media)
+        self.storage = ContentAddressedStorage(location=self.media, base_url="/media/")
+        out = BytesIO()
+        Image.new("RGB", (400, 200), "red").save(out, "PNG")
+        self.content = out.getvalue()
+
+    def test_thumbnails_are_named_by_content(self):
+        name = self.storage.save("spool_images/reel.png", ContentFile(self.content))
+        self.assertEqual(name, self.storage.blob_name(self.storage.digest(name), ".png"))
+        with self.storage.open(name, "rb") as fh:
+            digest = content_hash(fh)
+
+        self.assertEqual(make_thumbnails(name, digest, storage=self.storage), 2)
+        self.assertEqual(make_thumbnails(name, digest, storage=self.storage), 0)
+        with self.storage.open(thumbnail_name(name, digest, "webp"), "rb") as fh:
+            thumb = Image.open(fh)
+            self.assertEqual((thumb.format, thumb.size), ("WEBP", (200, 100)))
+
+    def create_image(self, name="reel.png"):
+        spool, _ = SpoolModel.objects.get_or_create(reel_model=ReelModel.objects.get_or_create(
+            reel_manufacturer=ReelManufacturer.objects.get_or_create(name="Daiwa")[0], name="Ninja")[0], name="LT2500")
+        image = SpoolModelImage(spool_model=spool)
+        image.image.save(name, ContentFile(self.content), save=False)
+        image.save()
+        return image
+
+    def test_image_hash_is_kept_on_save(self):
+        self.patch_storage(SpoolModelImage._meta.get_field("image"))
+        with mock.patch("crm.signals.schedule_thumbnails") as schedule:
+            image = self.create_image()
+        schedule.assert_called_once_with(image.image.name, image.image_hash, self.storage)
+
+        self.assertEqual(image.image_hash, content_hash(ContentFile(self.content)))
+        self.assertIsNone(image.thumbnail_url())
+        make_thumbnails(image.image.name, image.image_hash, storage=self.storage)
+        self.assertTrue(image.thumbnail_url("webp").endswith("_h100.webp"))
+
+    def test_upload_is_hashed_once(self):
+        self.patch_storage(SpoolModelImage._meta.get_field("image"))
+        spool = self.create_image().spool_model
+        with mock.patch("crm.thumbnails.hashlib.sha256", wraps=hashlib.sha256) as sha256:
+            image = SpoolModelImage.objects.create(spool_model=spool, image=ContentFile(self.content, "other.png"))
+        self.assertEqual(sha256.call_count, 1)
+        self.assertEqual(image.image.name, self.storage.blob_name(image.image_hash, ".png"))
+
+        # a closed file is closed again, an open one stays open
+        saved = SpoolModelImage.objects.get(pk=image.pk).image
+        self.assertEqual(content_hash(saved), image.image_hash)
+        self.assertTrue(saved.closed)
+        with self.storage.open(image.image.name, "rb") as fh:
+            self.assertEqual(content_hash(fh), image.image_hash)
+            self.assertFalse(fh.closed)
+
+    def test_identical_uploads_share_one_blob(self):
+        self.patch_storage(SpoolModelImage._meta.get_field("image"))
+        first, second = self.create_image("front.png"), self.create_image("copy.png")
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertEqual(self.storage.listdir(os.path.dirname(first.image.name))[1], [os.path.basename(first.image.name)])
+
+        first.delete()
+        second.delete()
+        self.assertTrue(self.storage.exists(second.image.name))
+
+    def test_failed_background_render_is_logged_and_built_later(self):
+        with override_settings(MEDIA_ROOT=self.media):
+            image = self.create_image()
+            with mock.patch("crm.thumbnails.Image.open", side_effect=OSError("truncated")), \
+                    self.assertLogs("crm.thumbnails", "ERROR") as logs:
+                thumbnails._render(image.image.name, image.image_hash, image.image.storage)
+            self.assertIn(image.image.name, logs.output[0])
+            self.assertIsNone(SpoolModelImage.objects.get(pk=image.pk).thumbnail_url())
+            call_command("build_thumbnails", "--workers", "1", stdout=StringIO())
+            self.assertIsNotNone(SpoolModelImage.objects.get(pk=image.pk).thumbnail_url())
+
+    def test_prune_spares_recently_saved_blobs(self):
+        with override_settings(MEDIA_ROOT=self.media):
+            first = self.create_image()
+            first.delete()
+            os.utime(image_storage.path(first.image.name), (0, 0))
+            # an upload of the same content whose row isn't committed yet
+            name = image_storage.save("spool_images/again.png", ContentFile(self.content))
+            call_command("dedupe_images", "--prune", stdout=StringIO())
+            self.assertTrue(image_storage.exists(name))
+            call_command("dedupe_images", "--prune", "--grace", "-1", stdout=StringIO())
+            self.assertFalse(image_storage.exists(name))
+
+    def test_dedupe_images_moves_legacy_files(self):
+        legacy = FileSystemStorage(location=self.media)
+        with override_settings(MEDIA_ROOT=self.media):
+            spool = self.create_image().spool_model
+            for name in ("spool_images/a.png", "spool_images/b.png"):
+                SpoolModelImage.objects.create(spool_model=spool, image=legacy.save(name, ContentFile(self.content)))
+            call_command("dedupe_images", "--prune", stdout=StringIO())
+
+        names = set(SpoolModelImage.objects.values_list("image", flat=True))
+        self.assertEqual(len(names), 1)
+        self.assertTrue(names.pop().startswith("images/"))
+        self.assertEqual(legacy.listdir("spool_images")[1], [])
+
+    def patch_storage(self, field):
+        storage = field.storage
+        field.storage = self.storage
+        self.addCleanup(setattr, field, "storage", storage)
+
+
+class CatalogApiTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_catalog(spools=3, lines=2)
+        cls.manufacturer = ReelManufacturer.objects.get()
+        cls.url = reverse("crm:manufacturer-detail", args=[cls.manufacturer.pk])
+
+    def setUp(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, True)
+        caches = dict(settings.CACHES, default=dict(settings.CACHES["default"], LOCATION=cache_dir))
+        override = override_settings(CACHES=caches)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_invalidation_reaches_the_other_workers(self):
+        self.client.get(self.url)
+        # a catalog change saved by another worker process
+        worker = multiprocessing.get_context("fork").Process(target=api.invalidate_manufacturers,
+                                                             args=([self.manufacturer.pk],))
+        worker.start()
+        worker.join()
+        self.assertEqual(worker.exitcode, 0)
+        with self.assertNumQueries(6):
+            self.client.get(self.url)
+
+    def test_tree(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        spools = response.json()["reel_models"][0]["spools"]
+        self.assertEqual(len(spools), 3)
+        self.assertEqual(spools[0]["dimension"], {"D1": 50.0, "D2": 40.0, "H1": 10.0})
+        self.assertEqual(len(spools[0]["reducers"]), 2)
+        self.assertEqual(spools[0]["reducers"][0]["dimension"]["D3"], 45.0)
+        self.assertEqual(self.client.get(reverse("crm:manufacturer-list")).json(),
+                         [{"id": self.manufacturer.pk, "name": "Shimano", "reel_models": 1}])
+        self.assertEqual(self.client.get(reverse("crm:manufacturer-detail", args=[0])).status_code, 404)
+
+    def test_query_count_is_constant(self):
+        with self.assertNumQueries(6):
+            self.client.get(self.url)
+        with self.assertNumQueries(0):
+            self.client.get(self.url)
+        spool = SpoolModel.objects.create(reel_model=ReelModel.objects.get(), name="C5000")
+        ReducerModel.objects.create(spool_model=spool, line=Line.objects.first())
+        with self.assertNumQueries(6):
+            self.client.get(self.url)
+
+    def test_revalidation(self):
+        response = self.client.get(self.url)
+        etag, last_modified = response["ETag"], response["Last-Modified"]
+        self.assertFalse(etag.startswith("W/"))
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+
+        dimension = SpoolDimension.objects.filter(actual=True).first()
+        dimension.D1 = 99
+        dimension.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_one_payload_per_request(self):
+        with mock.patch("crm.views.get_payload", wraps=api.get_payload) as get_payload:
+            response = self.client.get(self.url)
+            self.assertEqual(get_payload.call_count, 1)
+            self.client.get(reverse("crm:manufacturer-list"))
+            self.assertEqual(get_payload.call_count, 2)
+        self.assertEqual(response["ETag"], '"{}"'.format(hashlib.sha1(response.content).hexdigest()))
+
+    def test_other_manufacturers_stay_cached(self):
+        other = ReelManufacturer.objects.create(name="Daiwa")
+        self.client.get(self.url)
+        ReelModel.objects.create(reel_manufacturer=other, name="Ninja")
+        with self.assertNumQueries(0):
+            self.client.get(self.url)
+
+
+class CatalogChangesTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_catalog(spools=3, lines=2)
+        cls.url = reverse("crm:catalog-changes")
+
+    def sync(self, cursor=0, limit=500):
+        changes = []
+        while True:
+            page = self.client.get(self.url, {"cursor": cursor, "limit": limit}).json()
+            changes += page["changes"]
+            cursor = page["cursor"]
+            if not page["more"]:
+                return changes, cursor
+
+    def test_full_sync_in_pages(self):
+        changes, cursor = self.sync(limit=4)
+        kinds = [(change["kind"], change["id"]) for change in changes]
+        self.assertEqual(len([kind for kind, _ in kinds if kind == "reducer"]), 6)
+        self.assertEqual(cursor, CatalogChange.objects.latest("pk").pk)
+        spool = next(change["record"] for change in changes if change["kind"] == "spool")
+        self.assertEqual(spool["dimension"], {"D1": 50.0, "D2": 40.0, "H1": 10.0})
+
+    def test_delta_after_edit(self):
+        _, cursor = self.sync()
+        dimension = ReducerDimension.objects.filter(actual=True).first()
+        dimension.D3 = 44
+        dimension.save()
+        spool_id = SpoolModel.objects.last().pk
+        SpoolModel.objects.filter(pk=spool_id).delete()
+
+        # the log, the reducers and spools and their images
+        with self.assertNumQueries(5):
+            changes, _ = self.sync(cursor)
+        self.assertEqual(changes[0], {"kind": "reducer", "id": dimension.reducer_model_id, "deleted": False,
+                                      "record": changes[0]["record"]})
+        self.assertEqual(changes[0]["record"]["dimension"]["D3"], 44.0)
+        self.assertIn({"kind": "spool", "id": spool_id, "deleted": True}, changes)
+        self.assertEqual(self.sync(cursor)[0], changes)
+
+    def test_recent_changes_are_held_back(self):
+        _, cursor = self.sync()
+        spool = SpoolModel.objects.first()
+        spool.description = "edited"
+        spool.save()
+        with override_settings(CRM_CHANGES_SETTLE_SECONDS=60):
+            self.assertEqual(self.sync(cursor), ([], cursor))
+            # once it settled the change is sent
+            CatalogChange.objects.filter(pk__gt=cursor).update(created=timezone.now() - timedelta(seconds=61))
+            changes, _ = self.sync(cursor)
+        self.assertEqual([(change["kind"], change["id"]) for change in changes], [("spool", spool.pk)])
+
+    def test_compaction_keeps_the_latest_state(self):
+        spool = SpoolModel.objects.first()
+        spool.description = "edited"
+        spool.save()
+        before, _ = self.sync()
+        call_command("catalog_changes", "--compact", stderr=StringIO())
+        self.assertEqual(CatalogChange.objects.filter(kind="spool", object_id=spool.pk).count(), 1)
+        self.assertCountEqual(self.sync()[0], before)
+
+
+class SearchTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_catalog(spools=3, lines=2)
+        cls.user = User.objects.create_superuser("admin", "admin@example.com", "admin")
+
+    def test_names_and_line_specs(self):
+        hits = search_index.search("shimano strad c1001", kind="spool")
+        self.assertEqual([hit.label for hit in hits], ["Shimano Stradic C1001"])
+        hits = search_index.search("c1002 0.2-150", kind="reducer")
+        self.assertEqual([hit.label for hit in hits], ["Shimano Stradic C1002 0.2-150"])
+        self.assertEqual(search_index.search("0.25"), [])
+
+    def test_index_follows_changes(self):
+        ReelModel.objects.update(name="Vanford")
+        ReelModel.objects.get().save()
+        self.assertEqual(len(search_index.search("vanford")), 3 + 3 * 2)
+        spool = SpoolModel.objects.get(name="C1000")
+        spool.delete()
+        self.assertEqual(len(search_index.search("vanford c1000")), 0)
+
+    def test_admin_and_api(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse("admin:crm_spoolmodel_changelist"), {"q": "c1001"})
+        self.assertEqual([str(spool) for spool in response.context["cl"].result_list], ["Shimano Stradic C1001"])
+        response = self.client.get(reverse("crm:catalog-search"), {"q": "stradic 0.1", "kind": "reducer"})
+        self.assertEqual(len(response.json()["results"]), 3)
+
+    def test_admin_search_paginates_every_match(self):
+        self.client.force_login(self.user)
+        model_admin = admin.site._registry[ReducerModel]
+        self.addCleanup(setattr, model_admin, "list_per_page", model_admin.list_per_page)
+        model_admin.list_per_page = 4
+        response = self.client.get(reverse("admin:crm_reducermodel_changelist"), {"q": "stradic", "p": 1})
+        self.assertEqual(response.context["cl"].result_count, 3 * 2)
+        self.assertEqual(len(response.context["cl"].result_list), 2)
+        self.assertFalse(search_index.create())
+
+
+def catalog_snapshot():
+    spool_dims = {}
+    for spool in SpoolModel.objects.select_related('reel_model__reel_manufacturer', 'actual_dimension'):
+        spool_dims[spool.pk] = (str(spool), spool.size, spool.description,
+                                frozenset(spool.spooldimension_set.values_list('D1', 'D2', 'H1', 'actual')),
+                                spool.actual_dimension and spool.actual_dimension.D1)
+    return {(spool_dims[r.spool_model_id], r.line.length, r.line.diameter, r.description,
+             frozenset(r.reducerdimension_set.values_list('D3', 'D4', 'H2', 'description', 'actual')),
+             r.actual_dimension and r.actual_dimension.D3)
+            for r in ReducerModel.objects.select_related('line', 'actual_dimension')}
+
+
+class ExportTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_catalog(spools=3, lines=3)
+        for spool in SpoolModel.objects.all():
+            spool.size = int(spool.name[1:])
+            spool.save()
+        reducer = ReducerModel.objects.first()
+        ReducerDimension.objects.create(reducer_model=reducer, D3=45.5, D4=41.25, H2=9, description="long, wide")
+        ReducerDimension.objects.create(reducer_model=reducer, D3=46, D4=41, H2=8, description="long, wide",
+                                        actual=True)
+        ReducerDimension.objects.create(reducer_model=reducer, D3=47, D4=41, H2=8, description="")
+        spool = SpoolModel.objects.earliest('pk')
+        SpoolDimension.objects.create(spool_model=spool, D1=60, D2=40, H1=10, actual=True)
+        SpoolModel.objects.filter(pk=spool.pk).update(description="")
+        SpoolModel.objects.exclude(pk=spool.pk).update(description="sold, in \"boxes\"")
+        ReducerModel.objects.filter(pk=reducer.pk).update(description="tight")
+        ReducerDimension.objects.filter(reducer_model__line__length=150).update(description=None)
+        group = OrderGroup.objects.create(name="group")
+        order = OrderBucket.objects.create(order_group=group, name="order")
+        price = Price.objects.create(currency=Price.Currency.UAH, price=150)
+        OrderItem.objects.create(order=order, reducer_model=reducer, price=price, amount=2)
+        cls.user = User.objects.create_superuser("admin", "admin@example.com", "admin")
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def test_catalog_round_trip(self):
+        before = catalog_snapshot()
+        path = os.path.join(self.tmp_dir, "catalog.csv")
+        stderr = StringIO()
+        call_command("export_catalog", "--output", path, "--batch-size", "4", stdout=StringIO(), stderr=stderr)
+        self.assertEqual(stderr.getvalue(), "")
+
+        for options in (["--bulk"], []):
+            OrderGroup.objects.all().delete()
+            ReelManufacturer.objects.all().delete()
+            Line.objects.all().delete()
+            call_command("import_models", path, *options, stdout=StringIO())
+            self.assertEqual(catalog_snapshot(), before)
+        # the NULL descriptions stay NULL, a later import of the file finds them
+        self.assertEqual(ReducerDimension.objects.filter(description__isnull=True).count(), 3)
+        counts = ReducerDimension.objects.count()
+        call_command("import_models", path, stdout=StringIO())
+        self.assertEqual(ReducerDimension.objects.count(), counts)
+
+        again = os.path.join(self.tmp_dir, "again.csv")
+        call_command("export_catalog", "--output", again, stdout=StringIO())
+        with open(path) as first, open(again) as second:
+            self.assertEqual(first.read(), second.read())
+
+    def test_warns_about_rows_import_reads_differently(self):
+        SpoolModel.objects.filter(name="C1000").update(size=None)
+        SpoolModel.objects.create(reel_model=ReelModel.objects.get(), name="C5000", size=5000)
+        stderr = StringIO()
+        call_command("export_catalog", "--output", os.path.join(self.tmp_dir, "catalog.csv"), stdout=StringIO(),
+                     stderr=stderr)
+        self.assertIn("Shimano_Stradic_C1000", stderr.getvalue())
+        self.assertIn("Shimano Stradic C5000: spool without reducers", stderr.getvalue())
+
+    def test_orders(self):
+        out = StringIO()
+        call_command("export_orders", stdout=out)
+        header, row = out.getvalue().splitlines()
+        self.assertEqual(header.split(",")[-3:], ["amount", "item_sum", "order_total"])
+        self.assertEqual(row.split(",")[-4:], ["150", "2", "300", "300"])
+
+    def test_admin_actions_stream(self):
+        self.client.force_login(self.user)
+        response = self.client.post(reverse("admin:crm_spoolmodel_changelist"), {
+            "action": "export_catalog_csv", "_selected_action": [SpoolModel.objects.get(name="C1001").pk]})
+        self.assertTrue(response.streaming)
+        rows = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(rows), 1 + 3)
+        self.assertTrue(all(row.startswith("Shimano_Stradic_C1001,") for row in rows[1:]))
+
+        response = self.client.post(reverse("admin:crm_ordergroup_changelist"), {
+            "action": "export_orders_xlsx", "_selected_action": [OrderGroup.objects.get().pk]})
+        self.assertEqual(response["Content-Type"], CONTENT_TYPES["xlsx"])
+        self.assertTrue(b"".join(response.streaming_content).startswith(b"PK"))
+
+
+IMPORT_CSV = """model,line,d1,d2,h1,d3,d4,h2,description
+Shimano_Stradic_C3000,0.2-150,50/52,40,10,45,41,9,first
+,,,,,46,,8,
+Shimano_Stradic_4000,0.25-200,55,44,11,48,43,10,
+,,,,,,,,
+Daiwa_Ninja_LT 2500,0.2-150,48,38,9,44,40,8,x
+"""
+
+
+class ImportTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.path = self._write("catalog.csv", IMPORT_CSV)
+
+    def _write(self, name, content):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, "w") as fh:
+            fh.write(content)
+        return path
+
+    def _import(self, *args):
+        call_command("import_models", *args, stdout=StringIO())
+        return catalog_snapshot()
+
+    def _reset(self):
+        ReelManufacturer.objects.all().delete()
+        Line.objects.all().delete()
+
+    def test_csv_source_resumes_at_its_offset(self):
+        records, positions = [], []
+        source = CsvSource(self.path)
+        for record in source:
+            records.append(record)
+            positions.append((source.offset, source.state, source.row))
+        self.assertEqual([r.spool for r in records], ["C3000", "C3000", "4000", "Lt 2500"])
+        self.assertEqual(records[1].reducer_dims, ((46.0, 41.0, 8.0),))
+        self.assertEqual((records[3].size, records[3].line), (2500, (150, 0.2)))
+        self.assertEqual(positions[-1][0], os.path.getsize(self.path))
+        for i, (offset, state, row) in enumerate(positions):
+            self.assertEqual(list(CsvSource(self.path, offset, state, row)), records[i + 1:])
+
+    def test_parse_errors_name_the_row(self):
+        path = self._write("broken.csv", "model,line,d1,d2,h1,d3,d4,h2,description\nShimano,0.2-150,1,1,1,1,1,1,\n")
+        with self.assertRaisesMessage(ImportRecordError, "row 1: Can't parse manufacturer"):
+            list(CsvSource(path))
+
+    def test_modes_import_the_same_catalog(self):
+        serial = self._import(self.path)
+        self.assertEqual(len(serial), 3)
+        self._reset()
+        self.assertEqual(self._import(self.path, "--bulk", "--batch-size", "2"), serial)
+        self._reset()
+        self.assertEqual(self._import(self.path, "--chunk-size", "2"), serial)
+        self._reset()
+        head, tail = IMPORT_CSV.split("Shimano_Stradic_4000")
+        parts = os.path.join(self.tmp_dir, "parts")
+        os.mkdir(parts)
+        with open(os.path.join(parts, "1.csv"), "w") as fh:
+            fh.write(head)
+        with open(os.path.join(parts, "2.csv"), "w") as fh:
+            fh.write("model,line,d1,d2,h1,d3,d4,h2,description\nShimano_Stradic_4000" + tail)
+        self.assertEqual(self._import(parts, "--workers", "2"), serial)
+        self._reset()
+        self.assertEqual(self._import(parts, "--workers", "2", "--batch-size", "1"), serial)
+
+    def test_workers_stream_the_chunks(self):
+        broken = self._write("broken.csv", "model,line,d1,d2,h1,d3,d4,h2,description\nShimano,0.2-150,1,1,1,1,1,1,\n")
+        jobs = [(self.path, 0, None, 0, 1), (broken, 0, None, 0, 1)]
+        queues = [queue.Queue(), queue.Queue()]
+        parse_jobs(jobs, queues, multiprocessing.Value('i', 0))
+        chunks = [queues[0].get() for _ in range(queues[0].qsize())]
+        self.assertEqual([len(chunk.records) for chunk in chunks[:-1]], [1] * 4)
+        self.assertIsNone(chunks[-1])
+        self.assertIsInstance(queues[1].get(), ImportRecordError)
+        with self.assertRaisesMessage(CommandError, "row 1: Can't parse manufacturer"):
+            self._import(self.path, broken, "--workers", "2")
+
+    def _interrupted_import(self):
+        broken = IMPORT_CSV.replace("Daiwa_Ninja_LT 2500", "Daiwa")
+        self._write("catalog.csv", broken)
+        out, err = StringIO(), StringIO()
+        with self.assertRaises(CommandError):
+            call_command("import_models", self.path, "--chunk-size", "1", stdout=out, stderr=err)
+        self.assertNotIn("Imported", out.getvalue())
+        self.assertIn("Import failed after 3 rows", err.getvalue())
+        checkpoint = ImportCheckpoint.objects.get()
+        # the blank row 4 is read with the next record
+        self.assertEqual((checkpoint.rows, checkpoint.offset), (3, broken.index(",,,,,,,,")))
+        return broken
+
+    def test_failed_import_reports_the_rollback(self):
+        self._write("catalog.csv", IMPORT_CSV.replace("Daiwa_Ninja_LT 2500", "Daiwa"))
+        out, err = StringIO(), StringIO()
+        with self.assertRaises(CommandError):
+            call_command("import_models", self.path, "--bulk", "--batch-size", "1", stdout=out, stderr=err)
+        self.assertEqual(out.getvalue(), "")
+        self.assertIn("rolled back, nothing was imported", err.getvalue())
+        self.assertFalse(SpoolModel.objects.exists())
+
+    def test_chunked_import_resumes_after_the_checkpoint(self):
+        expected = self._import(self.path)
+        self._reset()
+        broken = self._interrupted_import()
+        self._write("catalog.csv", broken.replace("Daiwa", "Daiwa_Ninja_LT 2500"))
+        out = StringIO()
+        call_command("import_models", self.path, "--chunk-size", "1", stdout=out)
+        self.assertIn("Resuming {} after row 3".format(self.path), out.getvalue())
+        self.assertIn("Imported 1 rows", out.getvalue())
+        self.assertEqual(catalog_snapshot(), expected)
+        self.assertFalse(ImportCheckpoint.objects.exists())
+
+    def test_changed_file_drops_the_checkpoint(self):
+        self._interrupted_import()
+        # a new first row moves every offset, resuming would start in the middle of a row
+        header = "model,line,d1,d2,h1,d3,d4,h2,description\n"
+        changed = IMPORT_CSV.replace(header, header + "Okuma_Ceymar_C30,0.3-100,1,1,1,1,1,1,\n")
+        self._write("catalog.csv", changed)
+        out = StringIO()
+        call_command("import_models", self.path, "--chunk-size", "1", stdout=out)
+        self.assertIn("changed since the checkpoint", out.getvalue())
+        self.assertNotIn("Resuming", out.getvalue())
+        self.assertEqual(SpoolModel.objects.count(), 4)
+
+    def test_resumed_incremental_import_continues_the_row_keys(self):
+        self._import(self.path, "--incremental")
+        expected = set(ImportFingerprint.objects.values_list('row_key', 'digest'))
+        ImportFingerprint.objects.all().delete()
+        self._reset()
+        # the second C3000 0.2-150 row fails, the resumed run must count it as the second occurrence
+        self._write("catalog.csv", IMPORT_CSV.replace(",,,,,46,,8,", ",,,,,x,,8,"))
+        with self.assertRaises(CommandError):
+            self._import(self.path, "--incremental", "--chunk-size", "1")
+        self.assertEqual(ImportCheckpoint.objects.get().rows, 1)
+        self._write("catalog.csv", IMPORT_CSV)
+        self._import(self.path, "--incremental", "--chunk-size", "1")
+        self.assertEqual(set(ImportFingerprint.objects.values_list('row_key', 'digest')), expected)
+
+    def test_incremental_import_restores_deleted_rows(self):
+        expected = self._import(self.path, "--incremental")
+        ReducerModel.objects.filter(spool_model__name="4000").delete()
+        SpoolDimension.objects.filter(spool_model__name="C3000", D1=52).delete()
+        out = StringIO()
+        call_command("import_models", self.path, "--incremental", stdout=out)
+        self.assertIn("Skipped 2 of 4 rows", out.getvalue())
+        self.assertEqual(catalog_snapshot(), expected)
+
+    def _diff(self, *args):
+        out = StringIO()
+        call_command("import_models", *args, "--dry-run", stdout=out)
+        return json.loads(out.getvalue())
+
+    @staticmethod
+    def _counts():
+        return [model.objects.count() for model in (Line, ReelManufacturer, ReelModel, SpoolModel, SpoolDimension,
+                                                     ReducerModel, ReducerDimension)]
+
+    def test_dry_run_reports_what_the_import_writes(self):
+        report = self._diff(self.path)
+        self.assertEqual(self._counts(), [0] * 7)
+        self.assertEqual(report["new"]["reel_manufacturer"], [{"manufacturer": "Daiwa"}, {"manufacturer": "Shimano"}])
+        self.assertIn({"manufacturer": "Shimano", "reel_model": "Stradic", "spool": "C3000", "length": 150,
+                       "diameter": 0.2, "D3": 46.0, "D4": 41.0, "H2": 8.0, "description": ""},
+                      report["new"]["reducer_dimension"])
+        self.assertEqual(report["description_changed"], [])
+
+        self._import(self.path)
+        self.assertEqual([report["summary"][level] for level in ("line", "reel_manufacturer", "reel_model",
+                                                                 "spool_model", "spool_dimension", "reducer_model",
+                                                                 "reducer_dimension")], self._counts())
+        # the same file again has nothing to add
+        report = self._diff(self.path)
+        self.assertEqual(set(report["summary"].values()), {0})
+        self.assertEqual((set(map(len, report["new"].values())), report["description_changed"]), ({0}, []))
+
+    def test_dry_run_reports_changed_descriptions_to_a_file(self):
+        self._import(self.path)
+        counts = self._counts()
+        path = self._write("changed.csv", IMPORT_CSV.replace(",first", ",second"))
+        report_path = os.path.join(self.tmp_dir, "report.json")
+        out = StringIO()
+        call_command("import_models", path, "--diff", "--report", report_path, stdout=out)
+        self.assertEqual(out.getvalue(), "")
+        with open(report_path) as fh:
+            report = json.load(fh)
+        self.assertEqual(report["summary"]["reducer_dimension"], 0)
+        self.assertEqual(report["summary"]["description_changed"], 1)
+        self.assertEqual(report["description_changed"], [
+            {"manufacturer": "Shimano", "reel_model": "Stradic", "spool": "C3000", "length": 150, "diameter": 0.2,
+             "D3": 45.0, "D4": 41.0, "H2": 9.0, "description": "second", "existing_descriptions": ["first"]}])
+        self.assertEqual(self._counts(), counts)
+
+    def test_bulk_import_preloads_keys_and_logs_changes(self):
+        sent = []
+
+        def receiver(**kwargs):
+            sent.append(kwargs)
+
+        catalog_bulk_changed.connect(receiver)
+        self.addCleanup(catalog_bulk_changed.disconnect, receiver)
+        self._import(self.path, "--bulk")
+        self.assertEqual(len(sent), 1)
+        self.assertEqual((sent[0]["spool_ids"], sent[0]["lines"]),
+                         (set(SpoolModel.objects.values_list('pk', flat=True)), True))
+        self.assertEqual(CatalogChange.objects.filter(kind=CatalogChange.Kind.REDUCER).count(), 3)
+        self.assertEqual(set(SpoolModel.objects.values_list('display_name', flat=True)),
+                         {"Shimano Stradic C3000", "Shimano Stradic 4000", "Daiwa Ninja Lt 2500"})
+
+        # every key is resolved from the preloaded maps, a second import only reads them
+        changes = CatalogChange.objects.count()
+        out = StringIO()
+        with CaptureQueriesContext(connection) as ctx:
+            call_command("import_models", self.path, "--bulk", stdout=out)
+        self.assertIn("created: nothing", out.getvalue())
+        self.assertFalse([q for q in ctx.captured_queries if q['sql'].startswith("INSERT")])
+        self.assertEqual((CatalogChange.objects.count(), len(sent)), (changes, 1))
+
+
+class AdminAutocompleteTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_superuser("admin", "admin@example.com", "admin")
+        self.client.force_login(self.user)
+
+    def _order_page_queries(self, spools):
+        create_catalog(spools=spools, lines=3)
+        price, _ = Price.objects.get_or_create(currency=Price.Currency.UAH, price=100)
+        order = OrderBucket.objects.create(order_group=OrderGroup.objects.create(name="group {}".format(spools)),
+                                           name="order {}".format(spools))
+        for reducer in ReducerModel.objects.all()[:10]:
+            OrderItem.objects.create(order=order, reducer_model=reducer, price=price)
+        url = reverse("admin:crm_orderbucket_change", args=[order.pk])
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "Shimano Stradic C1000 0.1-100")
+        self.assertNotContains(response, "C1004 0.1-100")
+        return len(ctx.captured_queries)
+
+    def test_order_page_does_not_list_the_catalog(self):
+        queries = self._order_page_queries(spools=5)
+        ReelManufacturer.objects.all().delete()
+        Line.objects.all().delete()
+        self.assertEqual(self._order_page_queries(spools=40), queries)
+
+    def test_autocomplete_labels_in_one_query(self):
+        create_catalog(spools=10, lines=3)
+        url = reverse("admin:crm_reducermodel_autocomplete")
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url, {"term": ""})
+        results = response.json()["results"]
+        self.assertEqual(len(results), 20)
+        self.assertTrue(response.json()["pagination"]["more"])
+        self.assertEqual(results[0]["text"], "Shimano Stradic C1000 0.1-100")
+        # session and user, count, page
+        self.assertEqual(len(ctx.captured_queries), 4)
+
+        response = self.client.get(url, {"term": "c1003 0.2"})
+        self.assertEqual([r["text"] for r in response.json()["results"]], ["Shimano Stradic C1003 0.2-150"])
+        response = self.client.get(reverse("admin:crm_line_autocomplete"), {"term": "0.2-150"})
+        self.assertEqual([r["text"] for r in response.json()["results"]], ["0.2-150"])
+        response = self.client.get(reverse("admin:crm_line_autocomplete"), {"term": "100"})
+        self.assertEqual([r["text"] for r in response.json()["results"]], ["0.1-100"])
+
+
+class CatalogCacheTest(TransactionTestCase):
+    def setUp(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        settings_override = override_settings(CRM_CATALOG_CACHE_DIR=tmp_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        create_catalog(spools=3, lines=2)
+        Price.objects.create(currency=Price.Currency.USD, price=5)
+
+    def test_read_through_and_invalidation(self):
+        cache = CatalogCache()
+        with self.assertNumQueries(6):
+            catalog = cache.get()
+        with self.assertNumQueries(0):
+            self.assertIs(cache.get(), catalog)
+        for model in (ReelManufacturer, ReelModel, SpoolModel, ReducerModel, Line, Price):
+            for instance in model.objects.all():
+                self.assertEqual(cache.label(instance), str(instance))
+
+        spool = SpoolModel.objects.get(name="C1001")
+        spool.name = "C1001 HG"
+        spool.save()
+        # the signals invalidate the process-wide cache, this one reads the generation with the next request
+        cache.expire()
+        reducer = ReducerModel.objects.filter(spool_model=spool).first()
+        self.assertEqual(cache.label(reducer), "Shimano Stradic C1001 HG 0.1-100")
+        # the second get() and the 14 labels
+        self.assertEqual((cache.hits, cache.loads, cache.misses), (1 + 14, 0, 2))
+
+    def test_workers_share_the_snapshot(self):
+        worker, other = CatalogCache(), CatalogCache()
+        worker.get()
+        with self.assertNumQueries(0):
+            catalog = other.get()
+        self.assertEqual(catalog.spool_label(SpoolModel.objects.get(name="C1002").pk), "Shimano Stradic C1002")
+        self.assertEqual(other.stats()["loads"], 1)
+
+    def test_rolled_back_writes_are_not_kept(self):
+        cache = CatalogCache()
+        manufacturer = ReelManufacturer.objects.get()
+        try:
+            with transaction.atomic():
+                manufacturer.name = "Daiwa"
+                manufacturer.save()
+                self.assertEqual(cache.label(manufacturer), "Daiwa")
+                self.assertEqual(cache.get().manufacturer_label(manufacturer.pk), "Daiwa")
+                raise IntegrityError
+        except IntegrityError:
+            pass
+        self.assertEqual(cache.get().manufacturer_label(manufacturer.pk), "Shimano")
+
+    def test_generation_is_read_once_per_request(self):
+        cache = CatalogCache()
+        catalog = cache.get()
+        # another worker changes the catalog, this process sees it with the next request
+        other = CatalogCache()
+        other.invalidate()
+        self.assertIs(cache.get(), catalog)
+        cache.expire()
+        self.assertIsNot(cache.get(), catalog)
+        with mock.patch("crm.catalog.os.stat", wraps=os.stat) as stat:
+            for _ in range(10):
+                cache.get()
+        self.assertEqual(stat.call_count, 0)
+
+    def test_invalidations_in_one_clock_tick(self):
+        cache = CatalogCache()
+        generations = [cache.generation()]
+        with mock.patch("crm.catalog.time.time_ns", return_value=generations[0] + 10 ** 9):
+            for _ in range(5):
+                cache.invalidate()
+                generations.append(cache.generation())
+        self.assertEqual(generations, sorted(set(generations)))
+
+    def test_stats_view(self):
+        user = User.objects.create_superuser("admin", "admin@example.com", "admin")
+        self.client.force_login(user)
+        response = self.client.get(reverse("crm:catalog-cache"))
+        self.assertEqual(set(response.json()), {"pid", "generation", "hits", "loads", "misses"})
+
+
+class DisplayNameTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_catalog(spools=2, lines=2)
+        cls.price = Price.objects.create(currency=Price.Currency.USD, price=7)
+        ExchangeRate.objects.create(currency=Price.Currency.USD, rate=40)
+        order = OrderBucket.objects.create(order_group=OrderGroup.objects.create(name="group"), name="order")
+        cls.item = OrderItem.objects.create(order=order, reducer_model=ReducerModel.objects.first(), price=cls.price,
+                                            amount=3)
+
+    def test_names_need_no_queries(self):
+        items = list(OrderItem.objects.all())
+        reducers = list(ReducerModel.objects.all())
+        with self.assertNumQueries(0):
+            self.assertEqual(str(items[0]), "Shimano Stradic C1000 0.1-100 - 3x7 USD")
+            self.assertEqual(str(reducers[-1]), "Shimano Stradic C1001 0.2-150")
+
+    def test_renames_cascade(self):
+        manufacturer = ReelManufacturer.objects.get()
+        manufacturer.name = "Daiwa"
+        manufacturer.save()
+        line = Line.objects.get(length=100)
+        line.length = 120
+        line.save()
+        self.price.price = 8
+        self.price.save()
+        self.assertEqual(str(SpoolModel.objects.get(name="C1001")), "Daiwa Stradic C1001")
+        self.assertEqual(str(OrderItem.objects.get()), "Daiwa Stradic C1000 0.1-120 - 3x8 USD")
+        self.assertEqual(sorted(ReducerModel.objects.values_list('display_name', flat=True)),
+                         ["Daiwa Stradic C1000 0.1-120", "Daiwa Stradic C1000 0.2-150",
+                          "Daiwa Stradic C1001 0.1-120", "Daiwa Stradic C1001 0.2-150"])
+
+    def test_command_restores_the_names(self):
+        expected = {obj.pk: str(obj) for obj in OrderItem.objects.all()}
+        SpoolModel.objects.update(display_name="")
+        ReducerModel.objects.update(display_name="stale")
+        OrderItem.objects.update(display_name="")
+        out = StringIO()
+        call_command("update_display_names", stdout=out)
+        self.assertEqual(out.getvalue().strip(), "Updated 7 display names")
+        self.assertEqual({obj.pk: obj.display_name for obj in OrderItem.objects.all()}, expected)
+
+
+class OrderActionsTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_catalog(spools=2, lines=2)
+        cls.user = User.objects.create_superuser("admin", "admin@example.com", "admin")
+        price = Price.objects.create(currency=Price.Currency.UAH, price=10)
+        cls.group = OrderGroup.objects.create(name="June")
+        cls.other = OrderGroup.objects.create(name="July")
+        for i, reducer in enumerate(ReducerModel.objects.all()):
+            order = OrderBucket.objects.create(order_group=cls.group, name="order {}".format(i))
+            OrderItem.objects.create(order=order, reducer_model=reducer, price=price, amount=i + 1)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def _action(self, model, action, pks, **data):
+        url = reverse("admin:crm_{}_changelist".format(model._meta.model_name))
+        return self.client.post(url, dict(data, action=action, _selected_action=pks), follow=True)
+
+    def test_mark_sent_is_one_update_and_one_revision(self):
+        pks = list(OrderBucket.objects.values_list('pk', flat=True))
+        with CaptureQueriesContext(connection) as ctx:
+            self._action(OrderBucket, "mark_sent", pks)
+        self.assertEqual(OrderBucket.objects.filter(sent=True).count(), 4)
+        self.assertEqual(sum(query['sql'].startswith('UPDATE "crm_orderbucket"') for query in ctx.captured_queries), 1)
+        revision = Revision.objects.get()
+        self.assertEqual((revision.comment, revision.user, revision.version_set.count()),
+                         ("Mark as sent", self.user, 4))
+
+        self._action(OrderGroup, "mark_payed_orders", [self.group.pk])
+        self.assertEqual(OrderBucket.objects.filter(payed=True).count(), 4)
+
+    def test_move_orders_updates_the_group_totals(self):
+        moved = OrderBucket.objects.filter(name__in=["order 0", "order 1"])
+        self._action(OrderBucket, "move_to_group", list(moved.values_list('pk', flat=True)), order_group=self.other.pk)
+        self.assertEqual(OrderBucket.objects.filter(order_group=self.other).count(), 2)
+        self.assertEqual(OrderGroup.objects.get(pk=self.other.pk).total, 10 + 20)
+        self.assertEqual(OrderGroup.objects.get(pk=self.group.pk).total, 30 + 40)
+
+    def test_duplicate_group(self):
+        self._action(OrderGroup, "duplicate_groups", [self.group.pk])
+        self._action(OrderGroup, "duplicate_groups", [self.group.pk])
+        copy = OrderGroup.objects.get(name="June copy 2")
+        self.assertEqual(sorted(copy.orderbucket_set.values_list('name', flat=True)),
+                         ["order 0 copy 2", "order 1 copy 2", "order 2 copy 2", "order 3 copy 2"])
+        self.assertEqual(copy.total, 100)
+        self.assertEqual(str(OrderItem.objects.filter(order__order_group=copy).order_by('pk').first()),
+                         str(OrderItem.objects.filter(order__order_group=self.group).order_by('pk').first()))
+        self.assertEqual(Revision.objects.order_by('pk').last().version_set.count(), 1 + 4)
+
+    def test_duplicate_keeps_the_day_and_fits_the_names(self):
+        ExchangeRate.objects.create(currency=Price.Currency.USD, rate=40, date=date(2026, 1, 1))
+        ExchangeRate.objects.create(currency=Price.Currency.USD, rate=42, date=date.today())
+        price = Price.objects.create(currency=Price.Currency.USD, price=1)
+        group = OrderGroup.objects.create(name="g" * 200)
+        for name in ("a" * 200, "a" * 199 + "b", "order"):
+            order = OrderBucket.objects.create(order_group=group, name=name, placed=date(2026, 2, 1))
+            OrderItem.objects.create(order=order, reducer_model=ReducerModel.objects.first(), price=price, amount=1)
+        group.refresh_from_db()
+
+        copy = duplicate_group(group)
+        self.assertEqual(copy.name, "g" * 195 + " copy")
+        self.assertEqual(copy.total, group.total)
+        self.assertEqual(copy.total, 3 * 40)
+        buckets = list(copy.orderbucket_set.order_by('pk'))
+        self.assertEqual([bucket.placed for bucket in buckets], [date(2026, 2, 1)] * 3)
+        self.assertEqual(buckets[0].name, "a" * 195 + " copy")
+        self.assertTrue(buckets[1].name.startswith("Order-"))
+        self.assertEqual(buckets[2].name, "order copy")
+        self.assertEqual(duplicate_group(group).name, "g" * 193 + " copy 2")
+
+    def test_mark_items_printed(self):
+        pks = list(OrderItem.objects.values_list('pk', flat=True)[:2])
+        self._action(OrderItem, "mark_printed", pks)
+        self.assertEqual(set(OrderItem.objects.filter(printed=True).values_list('pk', flat=True)), set(pks))
+        revision = Revision.objects.order_by('pk').last()
+        versions = Version.objects.get_for_model(OrderItem).filter(revision=revision)
+        self.assertEqual(sorted(int(version.object_id) for version in versions), sorted(pks))
+        self.assertTrue(all(version.field_dict["printed"] for version in versions))
+        self.assertTrue(Version.objects.get_for_model(OrderBucket).filter(revision=revision).exists())
+
+
+def _generate_names(count):
+    return [order_name() for _ in range(count)]
+
+
+class NameGeneratorTest(TestCase):
+    def test_names_are_unique_and_increasing_across_processes(self):
+        processes, count = 4, 5000
+        start = time.monotonic()
+        with multiprocessing.get_context("fork").Pool(processes) as pool:
+            batches = pool.map(_generate_names, [count] * processes)
+        elapsed = time.monotonic() - start
+        self.assertEqual(len(set(chain.from_iterable(batches))), processes * count)
+        for batch in batches:
+            self.assertEqual(batch, sorted(batch))
+        self.assertGreater(processes * count / elapsed, 1000)
+
+    @override_settings(CRM_NODE_ID="shop")
+    def test_containers_with_the_same_node_id_and_pid(self):
+        # every container runs its worker as pid 1 under the same host name
+        with mock.patch("crm.ids.os.getpid", return_value=1), \
+                mock.patch("crm.ids.socket.gethostname", return_value="app"), \
+                mock.patch("crm.ids.time.time", return_value=1000.0):
+            batches = [[generator.next("Order") for _ in range(3)]
+                       for generator in (NameGenerator() for _ in range(100))]
+        names = list(chain.from_iterable(batches))
+        self.assertEqual(len(set(names)), len(names))
+        self.assertTrue(all(name.split("-")[-2].startswith("shop.") for name in names))
+
+    def test_clock_going_back_keeps_names_increasing(self):
+        generator = NameGenerator(node="test")
+        with mock.patch("crm.ids.time.time", side_effect=[1000.5, 999.0, 1001.0]):
+            first, second, third = (generator.next("Order") for _ in range(3))
+        self.assertLess(first, second)
+        self.assertLess(second, third)
+        self.assertTrue(second.endswith("-test-0001"))
+
+    def test_names_increase_across_the_end_of_daylight_saving_time(self):
+        # 03:15 local time happens twice in Kyiv on 2026-10-25, an hour apart
+        first_0315 = datetime(2026, 10, 25, 0, 15, tzinfo=dt_timezone.utc).timestamp()
+        generator = NameGenerator(node="test")
+        with mock.patch("crm.ids.time.time", side_effect=[first_0315, first_0315 + 3600]):
+            first, second = generator.next("Order"), generator.next("Order")
+        self.assertEqual(first, "Order-2026-10-25_00:15:00Z-test-0000")
+        self.assertEqual(second, "Order-2026-10-25_01:15:00Z-test-0000")
+
+    def test_orders_created_in_the_same_second(self):
+        group = OrderGroup.objects.create()
+        OrderBucket.objects.bulk_create([OrderBucket(order_group=group) for _ in range(2000)])
+        OrderBucket.objects.create(order_group=group)
+        self.assertEqual(OrderBucket.objects.values('name').distinct().count(), 2001)
+
+
+class RevisionQueueTest(TransactionTestCase):
+    def setUp(self):
+        self.queue_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.queue_dir, True)
+        self.user = User.objects.create_superuser("admin", "admin@example.com", "admin")
+        self.client.force_login(self.user)
+        self.group = OrderGroup.objects.create(name="June")
+        for i in range(3):
+            OrderBucket.objects.create(order_group=self.group, name="order {}".format(i))
+
+    def _change_group(self, **data):
+        orders = list(self.group.orderbucket_set.order_by('pk'))
+        post = {"name": "June", "description": "", "payed_sum": 0,
+                "orderbucket_set-TOTAL_FORMS": len(orders), "orderbucket_set-INITIAL_FORMS": len(orders),
+                "orderbucket_set-2-TOTAL_FORMS": 0, "orderbucket_set-2-INITIAL_FORMS": 0}
+        for i, order in enumerate(orders):
+            # the name has a callable default, the form compares it with a hidden initial value
+            post.update({"orderbucket_set-{}-id".format(i): order.pk, "orderbucket_set-{}-name".format(i): order.name,
+                         "initial-orderbucket_set-{}-name".format(i): order.name,
+                         "orderbucket_set-{}-order_group".format(i): self.group.pk})
+        post.update(data)
+        response = self.client.post(reverse("admin:crm_ordergroup_change", args=[self.group.pk]), post)
+        self.assertEqual(response.status_code, 302)
+
+    def test_admin_revisions_are_queued_and_flushed(self):
+        with override_settings(CRM_REVISION_QUEUE_DIR=self.queue_dir):
+            self._change_group(description="first")
+            self._change_group(description="first", **{"orderbucket_set-0-name": "renamed"})
+            self.assertEqual(Version.objects.count(), 0)
+            self.assertEqual(len(os.listdir(self.queue_dir)), 2)
+            call_command("flush_revisions", stdout=StringIO())
+        self.assertEqual(os.listdir(self.queue_dir), [])
+        first, second = Revision.objects.order_by('pk')
+        self.assertEqual((first.user, first.version_set.count()), (self.user, 4))
+        # both were queued before the first was written, there was no version to copy
+        self.assertEqual(second.version_set.count(), 4)
+        self.assertIn("renamed", second.version_set.get(object_id=str(self.group.orderbucket_set.earliest('pk').pk),
+                                                         content_type__model="orderbucket").serialized_data)
+
+        first.revert(delete=True)
+        self.assertEqual(OrderGroup.objects.get().description, "first")
+        self.assertEqual(OrderBucket.objects.filter(name="renamed").count(), 0)
+        self.assertEqual(OrderBucket.objects.count(), 3)
+
+    def test_queued_revision_keeps_the_state_of_the_request(self):
+        with override_settings(CRM_REVISION_QUEUE_DIR=self.queue_dir):
+            self._change_group(description="first")
+            call_command("flush_revisions", stdout=StringIO())
+            # an unversioned change of an order is serialized, the others are copies of their versions
+            OrderBucket.objects.filter(name="order 1").update(description="changed")
+            self._change_group(description="second")
+            # the versions an order action writes before the flush are newer than the queued revision
+            update_orders(OrderBucket.objects.all(), self.user, "Mark as sent", sent=True)
+            call_command("flush_revisions", stdout=StringIO())
+        queued = Revision.objects.get(version__serialized_data__contains="second")
+        orders = {version.object_repr: version.field_dict for version in
+                  CompactRevision.objects.get(pk=queued.pk).versions() if version.content_type.model == "orderbucket"}
+        self.assertEqual({name: fields["sent"] for name, fields in orders.items()},
+                         {"order 0": False, "order 1": False, "order 2": False})
+        self.assertEqual(orders["order 1"]["description"], "changed")
+
+    def test_unchanged_inline_rows_take_no_versions(self):
+        OrderBucket.objects.bulk_create([OrderBucket(order_group=self.group, name="order {}".format(i))
+                                         for i in range(3, 50)])
+        with override_settings(CRM_REVISION_QUEUE_DIR=self.queue_dir):
+            for data in ({"description": "first"}, {"description": "second"},
+                         {"description": "third", "orderbucket_set-0-name": "renamed"}):
+                self._change_group(**data)
+                call_command("flush_revisions", stdout=StringIO())
+        first, second, third = Revision.objects.order_by('pk')
+        self.assertEqual((first.version_set.count(), first.copies.count()), (51, 0))
+        # the changed group and order are the only versions, whatever the number of unchanged orders
+        self.assertEqual((second.version_set.count(), second.copies.count()), (1, 50))
+        self.assertEqual((third.version_set.count(), third.copies.count()), (2, 49))
+
+        history = self.client.get(reverse("admin:crm_ordergroup_history", args=[self.group.pk]))
+        self.assertEqual(len(history.context["action_list"]), 3)
+        order = OrderBucket.objects.get(name="renamed")
+        history = self.client.get(reverse("admin:crm_orderbucket_history", args=[order.pk]))
+        urls = [action["url"] for action in history.context["action_list"]]
+        self.assertEqual(urls[1], reverse("admin:crm_orderbucket_revision_copy",
+                                          args=[order.pk, second.copies.get(version__object_id=order.pk).pk]))
+        self.assertEqual(self.client.get(urls[1]).status_code, 200)
+        # the page reverts in a transaction it rolls back
+        self.assertTrue(OrderBucket.objects.filter(name="renamed").exists())
+
+        CompactRevision.objects.get(pk=second.pk).revert(delete=True)
+        self.assertEqual(OrderGroup.objects.get().description, "second")
+        self.assertEqual(OrderBucket.objects.filter(name="order 0").count(), 1)
+        self.assertEqual(OrderBucket.objects.count(), 50)
+
+    def test_failed_revisions_are_set_aside(self):
+        queue = RevisionQueue(self.queue_dir)
+        with override_settings(CRM_REVISION_QUEUE_DIR=self.queue_dir):
+            self._change_group(description="first")
+            entry = queue.read(queue.pending()[0])
+            queue.put(dict(entry, user=self.user.pk + 100))
+            queue.put(entry)
+            err = StringIO()
+            with self.assertLogs("crm.revisions", "ERROR"):
+                call_command("flush_revisions", stdout=StringIO(), stderr=err)
+            self.assertEqual((Revision.objects.count(), len(queue), len(queue.failed())), (2, 0, 1))
+            self.assertIn("can't be written", err.getvalue())
+
+            with self.assertLogs("crm.revisions", "ERROR"):
+                call_command("flush_revisions", "--retry-failed", stdout=StringIO(), stderr=StringIO())
+            self.assertEqual(len(queue.failed()), 1)
+
+    def test_flush_worker_survives_database_errors(self):
+        with override_settings(CRM_REVISION_QUEUE_DIR=self.queue_dir):
+            self._change_group(description="first")
+            with mock.patch("crm.management.commands.flush_revisions.flush_queue",
+                            side_effect=[OperationalError("database is locked"), (1, [])]) as flush, \
+                    mock.patch("crm.management.commands.flush_revisions.time.sleep",
+                               side_effect=[None, KeyboardInterrupt]), \
+                    self.assertLogs("crm.management.commands.flush_revisions", "ERROR"):
+                with self.assertRaises(KeyboardInterrupt):
+                    call_command("flush_revisions", "--interval", "1", stdout=StringIO())
+        self.assertEqual(flush.call_count, 2)
+
+    def test_revisions_are_written_in_the_request_without_a_queue(self):
+        self._change_group(description="first")
+        self.assertEqual(Revision.objects.get().version_set.count(), 4)
+
+    def test_prune_revisions(self):
+        for i in range(3):
+            with reversion.create_revision():
+                self.group.description = str(i)
+                self.group.save()
+        Revision.objects.update(date_created=timezone.now() - timedelta(days=100))
+        with reversion.create_revision():
+            OrderBucket.objects.first().save()
+        out = StringIO()
+        call_command("prune_revisions", "--model", "crm.OrderGroup", "--days", "30", "--keep", "2", "--dry-run",
+                     stdout=out)
+        self.assertIn("crm.OrderGroup: 1 versions would be deleted", out.getvalue())
+        call_command("prune_revisions", "--model", "crm.OrderGroup", "--days", "30", "--keep", "1", "--batch-size", "1",
+                     "--pause", "0", stdout=StringIO())
+        group_versions = Version.objects.filter(content_type__model="ordergroup")
+        self.assertEqual([version.field_dict["description"] for version in group_versions], ["2"])
+        # the old revisions still hold the versions of the orders the group follows
+        self.assertEqual(Revision.objects.count(), 4)
+        call_command("prune_revisions", "--days", "30", "--pause", "0", stdout=StringIO())
+        self.assertEqual(Revision.objects.count(), 2)
+
+    def test_compact_revisions(self):
+        for i in range(3):
+            with reversion.create_revision():
+                self.group.description = str(i)
+                self.group.save()
+        Revision.objects.update(date_created=timezone.now() - timedelta(days=100))
+        first = Revision.objects.earliest('pk')
+        out = StringIO()
+        call_command("prune_revisions", "--compact", "--days", "30", "--keep", "3", "--batch-size", "2", "--pause", "0",
+                     stdout=out)
+        self.assertIn("crm.OrderBucket: 6 versions compacted", out.getvalue())
+        self.assertIn("crm.OrderGroup: 0 versions compacted", out.getvalue())
+        # the orders keep their first version, the later revisions copy it
+        self.assertEqual(Version.objects.filter(content_type__model="orderbucket", revision=first).count(), 3)
+        self.assertEqual(Version.objects.filter(content_type__model="orderbucket").count(), 3)
+        self.assertEqual(VersionCopy.objects.count(), 6)
+
+        OrderBucket.objects.filter(name="order 0").update(description="changed")
+        CompactRevision.objects.latest('pk').revert()
+        self.assertIsNone(OrderBucket.objects.get(name="order 0").description)
+
+        # the copies are pruned before the versions they copy
+        call_command("prune_revisions", "--days", "30", "--keep", "1", "--pause", "0", stdout=StringIO())
+        self.assertEqual(VersionCopy.objects.count(), 3)
+        self.assertEqual(Version.objects.filter(content_type__model="orderbucket").count(), 3)
+        self.assertEqual(Revision.objects.count(), 2)
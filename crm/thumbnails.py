@@ -0,0 +1,105 @@
+import hashlib
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.db import transaction
+from PIL import Image, ImageOps
+
+THUMBNAIL_HEIGHT = 100
+THUMBNAIL_DIR = "thumbs"
+THUMBNAIL_FORMATS = {"jpg": ("JPEG", {"quality": 85, "optimize": True}), "webp": ("WEBP", {"quality": 80})}
+
+# uploads only schedule the work, the thumbnails are rendered off the request thread
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="thumbnails")
+logger = logging.getLogger(__name__)
+
+
+def content_hash(file) -> str:
+    """sha256 of the content of `file`, kept on the File: the model and the storage hash an upload once."""
+    # a FieldFile hashes the File it wraps
+    content = getattr(file, "_file", None) or file
+    digest = getattr(content, "_content_hash", None)
+    if digest:
+        return digest
+    # a saved FieldFile is closed, an upload that is not saved yet has to stay open for the storage
+    opened = False
+    if getattr(file, "closed", False):
+        file.open("rb")
+        opened = True
+    try:
+        digest = hashlib.sha256()
+        file.seek(0)
+        for chunk in file.chunks() if hasattr(file, "chunks") else iter(lambda: file.read(65536), b""):
+            digest.update(chunk)
+        file.seek(0)
+    finally:
+        if opened:
+            file.close()
+    digest = digest.hexdigest()
+    try:
+        (getattr(file, "_file", None) or file)._content_hash = digest
+    except AttributeError:
+        # a raw file object without a __dict__
+        pass
+    return digest
+
+
+def thumbnail_name(name: str, digest: str, ext: str, height: int = THUMBNAIL_HEIGHT) -> str:
+    """Thumbnails live in a thumbs/ directory next to the original and are named by its content hash."""
+    return os.path.join(os.path.dirname(name), THUMBNAIL_DIR, "{}_h{}.{}".format(digest, height, ext))
+
+
+def make_thumbnails(name: str, digest: str, storage, height: int = THUMBNAIL_HEIGHT, force: bool = False) -> int:
+    """Renders the missing thumbnails of the image `name` into the `storage` of its field."""
+    names = {ext: thumbnail_name(name, digest, ext, height) for ext in THUMBNAIL_FORMATS}
+    missing = {ext: thumb for ext, thumb in names.items() if force or not storage.exists(thumb)}
+    if not missing:
+        return 0
+    with storage.open(name, "rb") as fh:
+        image = ImageOps.exif_transpose(Image.open(fh))
+        image.thumbnail((image.width * height // max(image.height, 1) or 1, height))
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+    for ext, thumb in missing.items():
+        image_format, params = THUMBNAIL_FORMATS[ext]
+        out = BytesIO()
+        (image.convert("RGB") if image_format == "JPEG" else image).save(out, image_format, **params)
+        if storage.exists(thumb):
+            storage.delete(thumb)
+        storage.save(thumb, ContentFile(out.getvalue()))
+    return len(missing)
+
+
+def _render(name: str, digest: str, storage):
+    # nothing waits for the future, its exception would be dropped
+    try:
+        make_thumbnails(name, digest, storage)
+    except Exception:
+        logger.exception("Can't render the thumbnails of %s, build_thumbnails renders the missing ones", name)
+
+
+def schedule_thumbnails(name: str, digest: str, storage):
+    transaction.on_commit(lambda: _executor.submit(_render, name, digest, storage))
+
+
+class ThumbnailMixin:
+    """Image model part: keeps `image_hash` of `image` and knows the names of its thumbnails."""
+
+    def save(self, *args, **kwargs):
+        if self.image and (not self.image._committed or not self.image_hash):
+            # the blob name of a content addressed storage is its hash, an upload is hashed once for both
+            blob_digest = getattr(self.image.storage, "blob_digest", None)
+            digest = blob_digest(self.image.name) if self.image._committed and blob_digest else None
+            self.image_hash = digest or content_hash(self.image)
+        elif not self.image:
+            self.image_hash = ""
+        super().save(*args, **kwargs)
+
+    def thumbnail_url(self, ext: str = "jpg"):
+        if not self.image or not self.image_hash:
+            return None
+        name = thumbnail_name(self.image.name, self.image_hash, ext)
+        return self.image.storage.url(name) if self.image.storage.exists(name) else None
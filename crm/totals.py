@@ -0,0 +1,36 @@
+from typing import Iterable
+
+from django.db.models import IntegerField, OuterRef, Subquery, Sum
+from django.db.models.functions import Cast, Coalesce, Round
+
+from crm.models import OrderBucket, OrderGroup, OrderItem
+
+# cached totals are kept in settings.CRM_REPORTING_CURRENCY, items are converted at the rate of their order date
+
+
+def _bucket_total():
+    return Coalesce(Cast(Round(Subquery(
+        OrderItem.objects.filter(order=OuterRef('pk')).order_by().values('order')
+        .annotate(total=Sum(OrderItem.converted_sum())).values('total'))), IntegerField()), 0)
+
+
+def _group_total():
+    return Coalesce(Subquery(
+        OrderBucket.objects.filter(order_group=OuterRef('pk')).order_by().values('order_group')
+        .annotate(total=Sum('total')).values('total')), 0)
+
+
+def update_bucket_totals(bucket_ids: Iterable[int] = None):
+    """Recalculates the cached totals of the buckets and of their groups, every level is one UPDATE."""
+    buckets = OrderBucket.objects.all() if bucket_ids is None else OrderBucket.objects.filter(pk__in=bucket_ids)
+    buckets.update(total=_bucket_total())
+    update_group_totals(None if bucket_ids is None else buckets.values('order_group'))
+
+
+def update_group_totals(group_ids: Iterable[int] = None):
+    groups = OrderGroup.objects.all() if group_ids is None else OrderGroup.objects.filter(pk__in=group_ids)
+    groups.update(total=_group_total())
+
+
+def group_currency_totals(group_id: int):
+    return OrderItem.currency_totals(OrderItem.objects.filter(order__order_group_id=group_id))
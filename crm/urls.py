@@ -0,0 +1,13 @@
+from django.urls import path
+
+from crm import views
+
+app_name = 'crm'
+
+urlpatterns = [
+    path('manufacturers/', views.manufacturer_list, name='manufacturer-list'),
+    path('manufacturers/<int:pk>/', views.manufacturer_detail, name='manufacturer-detail'),
+    path('changes/', views.catalog_changes, name='catalog-changes'),
+    path('search/', views.catalog_search, name='catalog-search'),
+    path('catalog-cache/', views.catalog_cache_stats, name='catalog-cache'),
+]
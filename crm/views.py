@@ -1,3 +1,74 @@
-from django.shortcuts import render
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse
+from django.views.decorators.http import condition, require_GET
 
-# Create your views here.
+from crm.api import DEFAULT_PAGE_SIZE, INDEX_KEY, build_index, build_manufacturer, changes_page, get_payload, \
+    manufacturer_key
+from crm.catalog import catalog_cache
+from crm.search import KINDS, search_index
+
+
+def _payload(request, key, build):
+    # condition() asks for the ETag and Last-Modified before the view asks for the body, one payload per request
+    # keeps the three of them from different cached payloads when an invalidation lands in between
+    payloads = request.__dict__.setdefault("_crm_payloads", {})
+    if key not in payloads:
+        payloads[key] = get_payload(key, build)
+    return payloads[key]
+
+
+def _index_payload(request):
+    return _payload(request, INDEX_KEY, build_index)
+
+
+def _manufacturer_payload(request, pk):
+    return _payload(request, manufacturer_key(pk), lambda: build_manufacturer(pk))
+
+
+def _json(payload):
+    return HttpResponse(payload.body, content_type="application/json")
+
+
+# condition() answers If-None-Match/If-Modified-Since with a 304 before the view runs
+@require_GET
+@condition(etag_func=lambda request: _index_payload(request).etag,
+           last_modified_func=lambda request: _index_payload(request).last_modified)
+def manufacturer_list(request):
+    return _json(_index_payload(request))
+
+
+@require_GET
+@condition(etag_func=lambda request, pk: _manufacturer_payload(request, pk).etag,
+           last_modified_func=lambda request, pk: _manufacturer_payload(request, pk).last_modified)
+def manufacturer_detail(request, pk):
+    return _json(_manufacturer_payload(request, pk))
+
+
+@require_GET
+def catalog_changes(request):
+    try:
+        cursor = int(request.GET.get("cursor", 0))
+        limit = int(request.GET.get("limit", DEFAULT_PAGE_SIZE))
+    except ValueError:
+        return HttpResponseBadRequest("cursor and limit must be integers")
+    return JsonResponse(changes_page(cursor, limit))
+
+
+@require_GET
+def catalog_search(request):
+    kind = request.GET.get("kind") or None
+    if kind is not None and kind not in KINDS:
+        return HttpResponseBadRequest("kind must be one of {}".format(", ".join(KINDS)))
+    try:
+        limit = max(1, min(int(request.GET.get("limit", 20)), 100))
+    except ValueError:
+        return HttpResponseBadRequest("limit must be an integer")
+    hits = search_index.search(request.GET.get("q", ""), kind, limit)
+    return JsonResponse({"results": [hit._asdict() for hit in hits]})
+
+
+@require_GET
+@staff_member_required
+def catalog_cache_stats(request):
+    """Counters of the catalog cache of the worker process that answers."""
+    return JsonResponse(catalog_cache.stats())